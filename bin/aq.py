@@ -520,6 +520,25 @@ if __name__ == "__main__":
         # is silently dropped.
         status_thread.join(10)
 
+    if res.status == httplib.OK and not transport.expect and res.chunked:
+        # Large results are streamed by the broker; print them as they arrive
+        format = globalOptions.get("format", None)
+        received = False
+        try:
+            while res.fp:
+                pageData = res.read_chunk()
+                if pageData:
+                    sys.stdout.write(pageData)
+                    received = True
+        except (httplib.HTTPException, socket.error), e:
+            sys.stdout.flush()
+            print >>sys.stderr, "\nError: incomplete response from the " \
+                    "broker: %s" % repr(e)
+            sys.exit(1)
+        if received and format != "proto" and format != "csv":
+            sys.stdout.write("\n")
+        sys.exit(0)
+
     pageData = res.read()
 
     if res.status != httplib.OK:
@@ -0,0 +1,110 @@
+// ex: set expandtab softtabstop=4 shiftwidth=4:
+//
+// Copyright (C) 2013  Contributor
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+//
+// Persistent compile worker for the broker.  Runs the targets of build.xml
+// inside a single JVM, so the startup cost of the JVM and of ant is paid
+// only once.  See lib/python2.6/aquilon/worker/compiler.py for the protocol.
+//
+// Usage: jrunscript -cp $ANT_HOME/lib/ant.jar:$ANT_HOME/lib/ant-launcher.jar \
+//            -f compile_worker.js
+
+importPackage(java.io);
+importPackage(org.apache.tools.ant);
+
+// The protocol uses the real standard output, anything printed by the tasks
+// themselves is redirected to the build log.
+var protocol = new PrintStream(new FileOutputStream(FileDescriptor.out), true);
+var input = new BufferedReader(new InputStreamReader(java.lang.System["in"]));
+
+function send(kind, text) {
+    protocol.println(kind + " " + text);
+}
+
+function sendLines(kind, buffer) {
+    var lines = String(buffer.toString()).split("\n");
+    for (var i = 0; i < lines.length; i++) {
+        if (i == lines.length - 1 && lines[i] == "") {
+            break;
+        }
+        send(kind, lines[i].replace(/\r$/, ""));
+    }
+}
+
+function runJob(buildfile, target, properties) {
+    var out = new ByteArrayOutputStream();
+    var err = new ByteArrayOutputStream();
+    var project = new Project();
+    var logger = new DefaultLogger();
+    logger.setOutputPrintStream(new PrintStream(out, true));
+    logger.setErrorPrintStream(new PrintStream(err, true));
+    logger.setMessageOutputLevel(Project.MSG_INFO);
+    project.addBuildListener(logger);
+
+    var savedOut = java.lang.System.out;
+    var savedErr = java.lang.System.err;
+    java.lang.System.setOut(new PrintStream(new DemuxOutputStream(project, false)));
+    java.lang.System.setErr(new PrintStream(new DemuxOutputStream(project, true)));
+    var code = 0;
+    try {
+        project.fireBuildStarted();
+        project.init();
+        for (var name in properties) {
+            project.setUserProperty(name, properties[name]);
+        }
+        project.setUserProperty("ant.file", buildfile);
+        ProjectHelper.configureProject(project, new File(buildfile));
+        project.executeTarget(target);
+        project.fireBuildFinished(null);
+    } catch (e) {
+        code = 1;
+        var error = e.javaException;
+        if (!error) {
+            error = new BuildException(String(e));
+        }
+        project.fireBuildFinished(error);
+    } finally {
+        java.lang.System.setOut(savedOut);
+        java.lang.System.setErr(savedErr);
+    }
+
+    sendLines("out", out);
+    sendLines("err", err);
+    send("done", code);
+}
+
+var buildfile = null;
+var target = null;
+var properties = {};
+var line;
+while ((line = input.readLine()) != null) {
+    line = String(line);
+    var sep = line.indexOf(" ");
+    var kind = sep < 0 ? line : line.substring(0, sep);
+    var arg = sep < 0 ? "" : line.substring(sep + 1);
+    if (kind == "buildfile") {
+        buildfile = arg;
+    } else if (kind == "target") {
+        target = arg;
+    } else if (kind == "property") {
+        var eq = arg.indexOf("=");
+        properties[arg.substring(0, eq)] = arg.substring(eq + 1);
+    } else if (kind == "run") {
+        runJob(buildfile, target, properties);
+        buildfile = null;
+        target = null;
+        properties = {};
+    }
+}
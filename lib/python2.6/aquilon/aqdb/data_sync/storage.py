@@ -16,7 +16,9 @@
 # limitations under the License.
 """ Routines to query information about NAS shares """
 
+import os
 from collections import namedtuple
+from threading import Lock
 
 from aquilon.config import Config
 
@@ -24,68 +26,99 @@ from aquilon.config import Config
 ShareInfo = namedtuple('ShareInfo', ['server', 'mount'])
 
 
-# Utility functions for service / resource based disk mounts
-# This should come from some external API...?
-def cache_storage_data(only=None):
+def parse_storage_data(datafile):
     """
-    Scan a storeng-style data file, checking each line as we go
+    Scan a storeng-style data file, and return the shares it describes
 
     Storeng-style data files are blocks of data. Each block starts
     with a comment describing the fields for all subsequent lines. A
     block can start at any time. Fields are separated by '|'.
-    This function will invoke the function after parsing every data
-    line. The function will be called with a dict of the fields. If the
-    function returns True, then we stop scanning the file, else we continue
-    on until there is nothing left to parse.
-
-    dbshare can be a Share
+    Returns a dict mapping the names of the shares to ShareInfo objects.
     """
 
-    config = Config()
     sharedata = {}
     found_header = False
     header_idx = {}
-    with open(config.get("broker", "sharedata")) as datafile:
-        for line in datafile:
-            if line[0] == '#':
-                # A header line
-                found_header = True
-                hdr = line[1:].rstrip().split('|')
-
-                header_idx = {}
-                for idx, name in enumerate(hdr):
-                    header_idx[name] = idx
-
-                # Silently discard lines that don't have all the required info
-                for k in ["objtype", "pshare", "server", "dg"]:
-                    if k not in header_idx:
-                        found_header = False
-            elif not found_header:
-                # We haven't found the right header line
+    for line in datafile:
+        if line[0] == '#':
+            # A header line
+            found_header = True
+            hdr = line[1:].rstrip().split('|')
+
+            header_idx = {}
+            for idx, name in enumerate(hdr):
+                header_idx[name] = idx
+
+            # Silently discard lines that don't have all the required info
+            for k in ["objtype", "pshare", "server", "dg"]:
+                if k not in header_idx:
+                    found_header = False
+        elif not found_header:
+            # We haven't found the right header line
+            continue
+        else:
+            fields = line.rstrip().split('|')
+            if len(fields) != len(header_idx):  # Silently ignore invalid lines
                 continue
-            else:
-                fields = line.rstrip().split('|')
-                if len(fields) != len(header_idx):  # Silently ignore invalid lines
-                    continue
-                if fields[header_idx["objtype"]] != "pshare":
-                    continue
+            if fields[header_idx["objtype"]] != "pshare":
+                continue
+
+            sharedata[fields[header_idx["pshare"]]] = ShareInfo(
+                server=fields[header_idx["server"]],
+                mount="/vol/%s/%s" % (fields[header_idx["dg"]],
+                                      fields[header_idx["pshare"]])
+            )
 
-                sharedata[fields[header_idx["pshare"]]] = ShareInfo(
-                    server=fields[header_idx["server"]],
-                    mount="/vol/%s/%s" % (fields[header_idx["dg"]],
-                                          fields[header_idx["pshare"]])
-                )
+    return sharedata
+
+
+class ShareCatalogue(object):
+    """
+    The contents of the share data file, shared between requests
+
+    The file is parsed only when it has changed since the last time, based
+    on its modification time, size and inode number. Replacing the file by
+    renaming a new version over it is also detected this way.
+    """
 
-                # Take a shortcut if we need just a single entry
-                if only and only == fields[header_idx["pshare"]]:
-                    break
+    def __init__(self):
+        self.lock = Lock()
+        self.filename = None
+        self.stamp = None
+        self.shares = {}
 
-        return sharedata
+    def get(self):
+        """ Return the dict of shares. The caller must not modify it. """
+        filename = Config().get("broker", "sharedata")
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        with self.lock:
+            if self.filename != filename or self.stamp != stamp:
+                with open(filename) as datafile:
+                    self.shares = parse_storage_data(datafile)
+                self.filename = filename
+                self.stamp = stamp
+            return self.shares
+
+
+share_catalogue = ShareCatalogue()
+
+
+# Utility functions for service / resource based disk mounts
+# This should come from some external API...?
+def cache_storage_data(only=None):  # pylint: disable=W0613
+    """
+    Return the contents of the share data file
+
+    The returned dict is shared and must not be modified. The only
+    argument is not needed anymore, since the whole file is kept in memory.
+    """
+    return share_catalogue.get()
 
 
 def find_storage_data(dbshare, cache=None):
-    if not cache:
-        cache = cache_storage_data(only=dbshare.name)
+    if cache is None:
+        cache = share_catalogue.get()
     if dbshare.name in cache:
         return cache[dbshare.name]
     else:
@@ -62,6 +62,38 @@ def convert_resources(resources):
             resmap[name].append(value)
     return resmap
 
+
+def evaluate_capacity(func, memory_values, overcommit=None):
+    """ Evaluate a capacity function for every member of a cluster
+
+        Returns the list of results, in the same order as memory_values.
+
+        Capacity functions can only use their arguments and the restricted
+        built-ins, so the result depends on the arguments only.  Members of
+        a cluster are usually identical, so the function is evaluated only
+        once for every distinct amount of memory.  The returned dicts may be
+        shared between members, and must not be modified.
+    """
+    # No access for anything except built-in functions
+    global_vars = {'__builtins__': restricted_builtins}
+
+    results = {}
+    for memory in set(memory_values):
+        # This is the list of variables we want to pass to the capacity
+        # function
+        local_vars = {'memory': memory}
+        if func:
+            rec = eval(func, global_vars, local_vars)
+        else:
+            rec = local_vars
+
+        # Apply the memory overcommit factor. Force the result to be
+        # an integer since it looks better on display
+        if overcommit is not None and 'memory' in rec:
+            rec['memory'] = int(rec['memory'] * overcommit)
+        results[memory] = rec
+    return [results[memory] for memory in memory_values]
+
 # Cluster is a reserved word in Oracle
 _TN = 'clstr'
 _ETN = 'esx_cluster'
@@ -408,25 +440,10 @@ class EsxCluster(Cluster):
         else:
             overcommit = 1
 
-        # No access for anything except built-in functions
-        global_vars = {'__builtins__': restricted_builtins}
-
-        resources = []
-        for host in self.hosts:
-            # This is the list of variables we want to pass to the capacity
-            # function
-            local_vars = {'memory': host.machine.memory}
-            if func:
-                rec = eval(func, global_vars, local_vars)
-            else:
-                rec = local_vars
-
-            # Apply the memory overcommit factor. Force the result to be
-            # an integer since it looks better on display
-            if 'memory' in rec:
-                rec['memory'] = int(rec['memory'] * overcommit)
-
-            resources.append(rec)
+        resources = evaluate_capacity(func,
+                                      [host.machine.memory
+                                       for host in self.hosts],
+                                      overcommit)
 
         # Convert the list of dicts to a dict of lists
         resmap = convert_resources(resources)
@@ -453,18 +470,9 @@ class EsxCluster(Cluster):
         """ Return the amount of resources used by the virtual machines """
         func = self.virtmachine_capacity_function
 
-        # No access for anything except built-in functions
-        global_vars = {'__builtins__': restricted_builtins}
-
         resmap = {}
-        for machine in self.machines:
-            # This is the list of variables we want to pass to the capacity
-            # function
-            local_vars = {'memory': machine.memory}
-            if func:
-                res = eval(func, global_vars, local_vars)
-            else:
-                res = local_vars
+        for res in evaluate_capacity(func, [machine.memory
+                                            for machine in self.machines]):
             for name, value in res.items():
                 if name not in resmap:
                     resmap[name] = value
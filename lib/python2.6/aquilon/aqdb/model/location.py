@@ -17,18 +17,25 @@
 """ How we represent location data in Aquilon """
 
 from datetime import datetime
+from itertools import chain
+from threading import Lock
+
 from sqlalchemy import (Integer, DateTime, Sequence, String, Column,
                         ForeignKey, UniqueConstraint, PrimaryKeyConstraint,
-                        Index)
+                        Index, event)
 
 from sqlalchemy.orm import (relation, backref, object_session, deferred,
                             reconstructor)
+from sqlalchemy.orm.session import Session
 from sqlalchemy.sql import and_, or_, desc
 
 from aquilon.aqdb.model import Base, DnsDomain
 from aquilon.aqdb.column_types import AqStr
 from aquilon.exceptions_ import AquilonError
 
+# Oracle does not allow more than 1000 elements in an IN list
+_MAX_ID_LIST = 1000
+
 
 class Location(Base):
     """ How we represent location data in Aquilon """
@@ -63,7 +70,7 @@ class Location(Base):
     def get_p_dict(self, loc_type):
         if self._parent_dict is None:
             self._parent_dict = {str(self.location_type): self}
-            for node in self.parents:
+            for node in self._get_parents():
                 self._parent_dict[str(node.location_type)] = node
         return self._parent_dict.get(loc_type, None)
 
@@ -107,7 +114,49 @@ class Location(Base):
     def chassis(self):
         return self.get_p_dict('chassis')
 
+    def _use_closure(self):
+        session = object_session(self)
+        return session is not None and self.id is not None and \
+                location_closure.usable(session)
+
+    def _get_parents(self):
+        """ Same as self.parents, but using the closure cache if possible """
+        if "parents" in self.__dict__ or not self._use_closure():
+            return self.parents
+        session = object_session(self)
+        parent_ids = location_closure.get_parent_ids(session, self.id)
+
+        # Parents already in the session do not need a query
+        parents = {}
+        missing = []
+        for parent_id in parent_ids:
+            parent = session.identity_map.get((Location, (parent_id,)))
+            if parent is not None:
+                parents[parent_id] = parent
+            else:
+                missing.append(parent_id)
+        if missing:
+            q = session.query(Location).filter(Location.id.in_(missing))
+            parents.update([(loc.id, loc) for loc in q])
+        if len(parents) != len(parent_ids):  # pragma: no cover
+            # Deleted in the meantime
+            return self.parents
+        return [parents[parent_id] for parent_id in parent_ids]
+
+    def ancestor_ids(self):
+        """ Return the IDs of the parents, starting from the root """
+        if self._use_closure():
+            return location_closure.get_parent_ids(object_session(self),
+                                                   self.id)[:]
+        return [parent.id for parent in self.parents]
+
     def offspring_ids(self):
+        if self._use_closure():
+            ids = location_closure.get_offspring_ids(object_session(self),
+                                                     self.id)
+            if len(ids) <= _MAX_ID_LIST:
+                return ids[:]
+
         session = object_session(self)
         q = session.query(Location.id)
         q = q.join((LocationLink, Location.id == LocationLink.child_id))
@@ -117,6 +166,12 @@ class Location(Base):
         return q.subquery()
 
     def parent_ids(self):
+        if self._use_closure():
+            ids = location_closure.get_parent_ids(object_session(self),
+                                                  self.id)
+            if len(ids) < _MAX_ID_LIST:
+                return ids + [self.id]
+
         session = object_session(self)
         q = session.query(Location.id)
         q = q.join((LocationLink, Location.id == LocationLink.parent_id))
@@ -136,7 +191,7 @@ class Location(Base):
         return str('.'.join(names))
 
     def get_parts(self):
-        parts = list(self.parents)
+        parts = list(self._get_parents())
         parts.append(self)
         return parts
 
@@ -279,3 +334,94 @@ Location.parent = relation(Location, uselist=False,
                                             LocationLink.distance == 1),
                            secondaryjoin=Location.id == LocationLink.parent_id,
                            viewonly=True)
+
+
+class LocationClosure(object):
+    """ Cache of the ancestors and descendants of locations.
+
+        Searching by location needs the IDs of all locations below the given
+        one, and deriving the building, city etc. of a location needs its
+        parents. Both used to be queried from LocationLink every time. They
+        are now loaded once per location, and kept until a transaction that
+        changes locations or the links between them commits. Such a
+        transaction does not use the cache itself until then, since it would
+        not see its own changes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # location id -> list of parent ids, starting from the root
+        self.parents = {}
+        # location id -> sorted list of the ids of the location itself and
+        # all of its descendants
+        self.offspring = {}
+        # Bumped whenever the cache is dropped, to avoid caching results which
+        # were stale already when queried
+        self.epoch = 0
+
+    def usable(self, session):
+        """ Check whether the cache reflects what the session sees """
+        # Same as what running a query would do
+        session._autoflush()  # pylint: disable=W0212
+        return not getattr(session, "_aq_locations_changed", False)
+
+    def _get(self, cache, location_id, loader):
+        with self.lock:
+            ids = cache.get(location_id)
+            epoch = self.epoch
+        if ids is None:
+            ids = loader()
+            with self.lock:
+                if self.epoch == epoch:
+                    cache[location_id] = ids
+        return ids
+
+    def get_parent_ids(self, session, location_id):
+        def loader():
+            q = session.query(LocationLink.parent_id)
+            q = q.filter_by(child_id=location_id)
+            q = q.order_by(desc(LocationLink.distance))
+            return [row.parent_id for row in q]
+        return self._get(self.parents, location_id, loader)
+
+    def get_offspring_ids(self, session, location_id):
+        def loader():
+            q = session.query(LocationLink.child_id)
+            q = q.filter_by(parent_id=location_id)
+            ids = [row.child_id for row in q]
+            ids.append(location_id)
+            ids.sort()
+            return ids
+        return self._get(self.offspring, location_id, loader)
+
+    def clear(self):
+        with self.lock:
+            self.parents.clear()
+            self.offspring.clear()
+            self.epoch += 1
+
+    def before_flush(self, session, flush_context, instances):
+        # pylint: disable=W0613
+        for obj in chain(session.new, session.deleted):
+            if isinstance(obj, (Location, LocationLink)):
+                session._aq_locations_changed = True
+                return
+        for obj in session.dirty:
+            if isinstance(obj, LocationLink):
+                session._aq_locations_changed = True
+                return
+
+    def after_commit(self, session):
+        if getattr(session, "_aq_locations_changed", False):
+            session._aq_locations_changed = False
+            self.clear()
+
+    def after_rollback(self, session):
+        session._aq_locations_changed = False
+
+
+location_closure = LocationClosure()
+
+event.listen(Session, "before_flush", location_closure.before_flush)
+event.listen(Session, "after_commit", location_closure.after_commit)
+event.listen(Session, "after_rollback", location_closure.after_rollback)
@@ -17,6 +17,9 @@
 """ The module governing tables and objects that represent IP networks in
     Aquilon. """
 from datetime import datetime
+from bisect import bisect_right
+from itertools import chain
+from threading import Lock
 from ipaddr import (IPv4Address, IPv4Network, AddressValueError,
                     NetmaskValueError)
 import logging
@@ -25,6 +28,7 @@ from sqlalchemy import (Column, Integer, Sequence, String, DateTime, ForeignKey,
                         UniqueConstraint, CheckConstraint, Index, desc, event)
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relation, deferred, reconstructor, validates
+from sqlalchemy.orm.session import Session
 from sqlalchemy.pool import Pool
 from sqlalchemy.sql import and_
 
@@ -328,17 +332,102 @@ network.info['unique_fields'] = ['network_environment', 'ip']
 network.info['extra_search_fields'] = ['name', 'cidr']
 
 
-def get_net_id_from_ip(session, ip, network_environment=None):
-    """Requires a session, and will return the Network for a given ip."""
-    if ip is None:
-        return None
+class NetworkIndex(object):
+    """ Sorted interval index of the networks of every network environment.
+
+        Finding the network containing an IP address used to need a query
+        for every address. The start and end addresses of the networks of a
+        network environment are loaded once instead, and lookups are done
+        with bisect.
+
+        The index is dropped when a transaction that added, changed or
+        deleted networks commits. Such a transaction does not use the index
+        itself until then, since it would not see its own changes.
+    """
 
+    def __init__(self):
+        self.lock = Lock()
+        # network environment id -> (sorted list of start addresses,
+        #                             list of (end address, network id))
+        self.environments = {}
+        # Bumped whenever the index is dropped, to avoid caching results
+        # which were stale already when queried
+        self.epoch = 0
+
+    def _load(self, session, dbnet_env):
+        with self.lock:
+            entry = self.environments.get(dbnet_env.id)
+            epoch = self.epoch
+        if entry is not None:
+            return entry
+
+        q = session.query(Network.ip, Network.cidr, Network.id)
+        q = q.filter_by(network_environment=dbnet_env)
+        q = q.order_by(Network.ip)
+        starts = []
+        ends = []
+        for ip, cidr, net_id in q:
+            starts.append(int(ip))
+            ends.append((int(ip) + (1 << (32 - cidr)) - 1, net_id))
+        entry = (starts, ends)
+
+        with self.lock:
+            if self.epoch == epoch:
+                self.environments[dbnet_env.id] = entry
+        return entry
+
+    def usable(self, session):
+        """ Check whether the index reflects what the session sees """
+        # Same as what running a query would do
+        session._autoflush()  # pylint: disable=W0212
+        return not getattr(session, "_aq_networks_changed", False)
+
+    def lookup_ids(self, session, dbnet_env, ips):
+        """ Return a dict mapping the addresses to network ids """
+        (starts, ends) = self._load(session, dbnet_env)
+        result = {}
+        for ip in ips:
+            idx = bisect_right(starts, int(ip)) - 1
+            if idx >= 0 and int(ip) <= ends[idx][0]:
+                result[ip] = ends[idx][1]
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.environments.clear()
+            self.epoch += 1
+
+    def before_flush(self, session, flush_context, instances):
+        # pylint: disable=W0613
+        for obj in chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, Network):
+                session._aq_networks_changed = True
+                return
+
+    def after_commit(self, session):
+        if getattr(session, "_aq_networks_changed", False):
+            session._aq_networks_changed = False
+            self.clear()
+
+    def after_rollback(self, session):
+        session._aq_networks_changed = False
+
+
+network_index = NetworkIndex()
+
+event.listen(Session, "before_flush", network_index.before_flush)
+event.listen(Session, "after_commit", network_index.after_commit)
+event.listen(Session, "after_rollback", network_index.after_rollback)
+
+
+def _get_net_env(session, network_environment):
     if isinstance(network_environment, NetworkEnvironment):
-        dbnet_env = network_environment
-    else:
-        dbnet_env = NetworkEnvironment.get_unique_or_default(session,
-                                                             network_environment)
+        return network_environment
+    return NetworkEnvironment.get_unique_or_default(session,
+                                                    network_environment)
+
 
+def _query_network(session, dbnet_env, ip):
     # Query the last network having an address smaller than the given ip. There
     # is no guarantee that the returned network does in fact contain the given
     # ip, so this must be checked separately.
@@ -351,6 +440,61 @@ def get_net_id_from_ip(session, ip, network_environment=None):
     q = q.filter(Network.ip == subq.as_scalar())
     net = q.first()
     if not net or not ip in net.network:
+        return None
+    return net
+
+
+def get_networks_from_ips(session, ips, network_environment=None):
+    """ Return a dict mapping the given IPs to the Networks containing them.
+
+        Addresses not contained by any network are left out of the result.
+    """
+    dbnet_env = _get_net_env(session, network_environment)
+    ips = set([ip for ip in ips if ip is not None])
+    result = {}
+    if not ips:
+        return result
+
+    if not network_index.usable(session):
+        for ip in ips:
+            net = _query_network(session, dbnet_env, ip)
+            if net:
+                result[ip] = net
+        return result
+
+    ids = network_index.lookup_ids(session, dbnet_env, ips)
+    # Networks already in the session do not need a query
+    networks = {}
+    missing = []
+    for net_id in set(ids.values()):
+        net = session.identity_map.get((Network, (net_id,)))
+        if net is not None:
+            networks[net_id] = net
+        else:
+            missing.append(net_id)
+    # Avoid too long IN clauses
+    for pos in range(0, len(missing), 1000):
+        q = session.query(Network)
+        q = q.filter(Network.id.in_(missing[pos:pos + 1000]))
+        networks.update([(net.id, net) for net in q])
+
+    for ip, net_id in ids.items():
+        net = networks.get(net_id)
+        if net is None:
+            # Deleted since the index was loaded
+            net = _query_network(session, dbnet_env, ip)
+        if net:
+            result[ip] = net
+    return result
+
+
+def get_net_id_from_ip(session, ip, network_environment=None):
+    """Requires a session, and will return the Network for a given ip."""
+    if ip is None:
+        return None
+
+    net = get_networks_from_ips(session, [ip], network_environment).get(ip)
+    if not net:
         raise NotFoundException("Could not determine network containing IP "
                                 "address %s." % ip)
     return net
@@ -17,10 +17,12 @@
 """ Configuration  Parameter data """
 
 from datetime import datetime
+from threading import Lock
 
 from sqlalchemy import (Column, Integer, DateTime, Sequence, String, ForeignKey,
-                        UniqueConstraint, Index)
+                        UniqueConstraint, Index, event)
 from sqlalchemy.orm import relation, backref, deferred
+from sqlalchemy.orm.session import object_session, Session
 
 from aquilon.aqdb.column_types import JSONEncodedDict, MutationDict
 from aquilon.aqdb.model import Base, Personality
@@ -30,6 +32,8 @@ from aquilon.aqdb.column_types import AqStr
 _TN = 'parameter'
 _PARAM_HOLDER = 'param_holder'
 PATH_SEP = '/'
+# Oracle does not allow more than 1000 elements in an IN-list
+MAX_IN_LIST = 1000
 
 
 class ParameterHolder(Base):
@@ -203,6 +207,7 @@ class Parameter(Base):
         ## coerce mutation of parameter since sqlalchemy
         ## cannot recognize parameter change
         self.value.changed()  # pylint: disable=E1101
+        _record(self, self.holder)
 
     def __del_path(self, path):
         """ method to do the actual deletion """
@@ -243,6 +248,7 @@ class Parameter(Base):
             ## coerce mutation of parameter since sqlalchemy
             ## cannot recognize parameter change
             self.value.changed()  # pylint: disable=E1101
+            _record(self, self.holder)
         except:
             if compel:
                 raise NotFoundException("No parameter of path=%s defined." % path)
@@ -265,3 +271,181 @@ class Parameter(Base):
 
 parameter = Parameter.__table__  # pylint: disable=C0103
 parameter.info['unique_fields'] = ['holder']
+
+
+def index_paths(value, prefix="", paths=None):
+    """
+    maps every path of a parameter value to the value it points to
+
+    e.g {'system': {'foo': 1}} returns {'system': {'foo': 1}, 'system/foo': 1}
+    """
+    if paths is None:
+        paths = {}
+    if not isinstance(value, dict):
+        return paths
+    for key, item in value.items():
+        # get_path() can't reach keys containing the separator either
+        if PATH_SEP in key:
+            continue
+        path = prefix + key
+        paths[path] = item
+        index_paths(item, path + PATH_SEP, paths)
+    return paths
+
+
+class ParameterIndex(object):
+    """ Cache of the parameter paths of parameter holders.
+
+        Searching a path across personalities, validating personalities and
+        generating personality plenaries look up the same few paths of many
+        holders. The committed values of each holder are decoded and indexed
+        by path once, and shared between sessions, so looking up a feature
+        parameter is a dict lookup of Parameter.feature_path(link, path).
+
+        Holders whose parameters the session has changed are indexed from the
+        session's own objects and are not cached. Their cached entries are
+        dropped when the transaction commits.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # holder id -> list of {path: value} dicts, one per parameter. The
+        # entries are handed out and read without holding the lock, so they
+        # must never be modified.
+        self.holders = {}
+        # Bumped whenever the committed parameters of a holder change, to
+        # avoid caching results which were stale already when queried
+        self.generations = {}
+
+    def _changes(self, session, create=False):
+        changes = getattr(session, "_aq_parameter_index", None)
+        if changes is None and create:
+            # ids of the holders changed by the transaction
+            changes = set()
+            session._aq_parameter_index = changes
+        return changes
+
+    def _stamp(self, holder_id):
+        return self.generations.get(holder_id, 0)
+
+    def _load(self, session, holder_ids):
+        loaded = dict((holder_id, []) for holder_id in holder_ids)
+        for start in range(0, len(holder_ids), MAX_IN_LIST):
+            q = session.query(Parameter.holder_id, Parameter.value)
+            q = q.filter(Parameter.holder_id.in_(holder_ids[start:start +
+                                                            MAX_IN_LIST]))
+            q = q.order_by(Parameter.id)
+            for holder_id, value in q:
+                loaded[holder_id].append(index_paths(value))
+        return loaded
+
+    def get(self, session, holders):
+        """Return the indexed paths of the parameters of each holder"""
+        result = {}
+        missing = {}
+        changes = self._changes(session) or set()
+        with self.lock:
+            for dbholder in holders:
+                if dbholder.id is None or dbholder.id in changes:
+                    continue
+                entry = self.holders.get(dbholder.id)
+                if entry is None:
+                    missing[dbholder.id] = self._stamp(dbholder.id)
+                else:
+                    result[dbholder] = entry
+
+        if missing:
+            loaded = self._load(session, missing.keys())
+            # Querying may have flushed changes of the session
+            changes = self._changes(session) or set()
+            with self.lock:
+                for holder_id, entry in loaded.items():
+                    if holder_id not in changes and \
+                       self._stamp(holder_id) == missing[holder_id]:
+                        self.holders[holder_id] = entry
+
+        for dbholder in holders:
+            if dbholder in result:
+                continue
+            if dbholder.id in missing and dbholder.id not in changes:
+                result[dbholder] = loaded[dbholder.id]
+            else:
+                result[dbholder] = [index_paths(dbparam.value)
+                                    for dbparam in dbholder.parameters]
+        return result
+
+    @staticmethod
+    def lookup(paths, path):
+        """Return the value of a path, or None if it is not defined"""
+        return paths.get(Parameter.topath(Parameter.path_parts(path)))
+
+    def drop(self, holder_id):
+        with self.lock:
+            self.holders.pop(holder_id, None)
+            self.generations[holder_id] = \
+                    self.generations.get(holder_id, 0) + 1
+
+    def record(self, session, holder_id):
+        if holder_id is None:
+            # A new holder, which has nothing cached yet
+            return
+        if not session:
+            # We can't follow the transaction, so just forget what we know
+            self.drop(holder_id)
+            return
+        self._changes(session, create=True).add(holder_id)
+
+    def after_commit(self, session):
+        changes = self._changes(session)
+        if not changes:
+            return
+        session._aq_parameter_index = None
+        for holder_id in changes:
+            self.drop(holder_id)
+
+    def after_rollback(self, session):
+        # Uncommitted values never get cached, so there is nothing to drop
+        session._aq_parameter_index = None
+
+
+parameter_index = ParameterIndex()
+
+
+def _record(dbparameter, dbholder):
+    if dbholder is None:
+        return
+    session = object_session(dbparameter) or object_session(dbholder)
+    parameter_index.record(session, dbholder.id)
+
+
+def _value_set(dbparameter, value, oldvalue, initiator):
+    # New parameters are recorded when they get their holder
+    if dbparameter.holder_id is not None:
+        parameter_index.record(object_session(dbparameter),
+                               dbparameter.holder_id)
+    return value
+
+
+def _holder_set(dbparameter, value, oldvalue, initiator):
+    _record(dbparameter, value)
+    if isinstance(oldvalue, ParameterHolder):
+        _record(dbparameter, oldvalue)
+    return value
+
+
+def _before_flush(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Parameter):
+            _record(obj, obj.holder)
+    for obj in session.deleted:
+        if isinstance(obj, Parameter):
+            _record(obj, obj.holder)
+        elif isinstance(obj, ParameterHolder):
+            parameter_index.record(session, obj.id)
+
+
+event.listen(Parameter.value, "set", _value_set, retval=True)
+event.listen(Parameter.holder, "set", _holder_set, retval=True)
+event.listen(Session, "before_flush", _before_flush)
+event.listen(Session, "after_commit", parameter_index.after_commit)
+event.listen(Session, "after_rollback", parameter_index.after_rollback)
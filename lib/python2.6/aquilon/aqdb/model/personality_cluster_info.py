@@ -31,6 +31,23 @@ _PCIABV = "pers_clst_info"
 _PECI = "personality_esx_cluster_info"
 _PECIABV = "pers_esxcl_info"
 
+# Compiled capacity functions, keyed by their text, shared between sessions.
+# The cache is keyed by the text, so changing the function of a personality
+# needs no invalidation.
+_compiled_functions = {}
+_MAX_COMPILED_FUNCTIONS = 1000
+
+
+def compile_capacity_function(text):
+    """ Compile a capacity function, reusing earlier results """
+    func = _compiled_functions.get(text)
+    if func is None:
+        func = compile(text, "<string>", "eval")
+        if len(_compiled_functions) >= _MAX_COMPILED_FUNCTIONS:
+            _compiled_functions.clear()
+        _compiled_functions[text] = func
+    return func
+
 
 class PersonalityClusterInfo(Base):
     """ Extra personality data specific to clusters """
@@ -94,7 +111,7 @@ class PersonalityESXClusterInfo(PersonalityClusterInfo):
         if self._compiled_vmhost:
             return self._compiled_vmhost
         if self._vmhost_capacity_function:
-            func = compile(self._vmhost_capacity_function, "<string>", "eval")
+            func = compile_capacity_function(self._vmhost_capacity_function)
         else:
             # TODO Get it from the configuration?
             func = None
@@ -16,19 +16,22 @@
 # limitations under the License.
 """ see class.__doc__ for description """
 from datetime import datetime
+from bisect import bisect_left, insort
+from threading import Lock
 import socket
 
 from sqlalchemy import (Column, Integer, Sequence, String, DateTime,
                         ForeignKey, UniqueConstraint, PrimaryKeyConstraint,
-                        Index)
+                        Index, event)
 from sqlalchemy.orm import (relation, contains_eager, column_property, backref,
                             deferred, undefer, aliased)
-from sqlalchemy.orm.session import object_session
+from sqlalchemy.orm.session import object_session, Session
 from sqlalchemy.sql.expression import or_
 from sqlalchemy.sql import select, func
 
 from aquilon.aqdb.model import (Base, Service, Host, DnsRecord, DnsDomain,
-                                Machine, Fqdn, Personality, Archetype)
+                                HardwareEntity, Machine, Fqdn, Personality,
+                                Archetype)
 from aquilon.aqdb.column_types.aqstr import AqStr
 from aquilon.aqdb.column_types import Enum
 from collections import defaultdict
@@ -80,61 +83,154 @@ class ServiceInstance(Base):
         as though max_members are bound.  The tricky bit is de-duplication.
 
         """
-        from aquilon.aqdb.model import Cluster, MetaCluster, MetaClusterMember
-
         session = object_session(self)
+        return ServiceInstance.get_client_counts(session, [self])[self]
+
+    @classmethod
+    def get_aligned_personalities(cls, session, dbservices):
+        """Return the IDs of the cluster personalities requiring services.
+
+        The result is a dict of service IDs to sets of personality IDs. If a
+        service is not present in the result, then it is not required by any
+        cluster personality.
+
+        """
+        from aquilon.aqdb.model.service import (ServiceListItem,
+                                                PersonalityServiceListItem)
+
+        service_ids = set([dbservice.id for dbservice in dbservices])
+        result = defaultdict(set)
+        if not service_ids:
+            return result
 
         # personalities by service
-        q = session.query(Personality.id)
-        q = q.join(Archetype).filter(Archetype.cluster_type != None)
-        q = q.filter(Personality.services.contains(self.service))
-        personality_ids = [p[0] for p in q]
+        q = session.query(PersonalityServiceListItem.service_id,
+                          Personality.id)
+        q = q.join((Personality, PersonalityServiceListItem.personality_id ==
+                    Personality.id), Archetype)
+        q = q.filter(Archetype.cluster_type != None)
+        q = q.filter(PersonalityServiceListItem.service_id.in_(service_ids))
+        for service_id, personality_id in q:
+            result[service_id].add(personality_id)
 
         # personalities by archetype service
-        q = session.query(Personality.id)
-        q = q.join(Archetype).filter(Archetype.cluster_type != None)
-        q = q.filter(Archetype.services.contains(self.service))
-        personality_ids.extend([p[0] for p in q])
+        q = session.query(ServiceListItem.service_id, Personality.id)
+        q = q.join((Archetype, ServiceListItem.archetype_id == Archetype.id))
+        q = q.join((Personality, Personality.archetype_id == Archetype.id))
+        q = q.filter(Archetype.cluster_type != None)
+        q = q.filter(ServiceListItem.service_id.in_(service_ids))
+        for service_id, personality_id in q:
+            result[service_id].add(personality_id)
 
-        if not personality_ids:
-            # By far, the common case.
-            return self._client_count
+        return result
 
-        clusters = {}
+    @classmethod
+    def get_client_counts(cls, session, instances, aligned=None):
+        """Return the number of clients of several instances at once.
 
-        # Meta
-        McAlias = aliased(MetaCluster)
-        q = session.query(Cluster.name, Cluster.max_hosts)
-        # Force orm to look for mc - service relation
-        q = q.join('_metacluster', (McAlias,
-                        MetaClusterMember.metacluster_id == McAlias.id))
-        q = q.filter(McAlias.service_bindings.contains(self))
-        q = q.filter(McAlias.personality_id.in_(personality_ids))
+        The result is a dict of instances to adjusted client counts, as
+        returned by client_count. The counts are calculated using a few
+        grouped queries, independent of the number of instances. aligned may
+        be the result of a previous get_aligned_personalities() call for the
+        services of the instances.
+
+        """
+        from aquilon.aqdb.model import Cluster, MetaClusterMember
+        from aquilon.aqdb.model.cluster import (ClusterServiceBinding,
+                                                HostClusterMember)
+
+        instances = set(instances)
+        if aligned is None:
+            aligned = cls.get_aligned_personalities(
+                session, set([si.service for si in instances]))
+
+        counts = {}
+        plain = {}
+        clustered = {}
+        for si in instances:
+            if si.service_id in aligned:
+                clustered[si.id] = si
+                continue
+            # By far, the common case.
+            count = client_roster.count(si)
+            if count is None and "_client_count" in si.__dict__:
+                count = si._client_count
+            if count is None:
+                plain[si.id] = si
+            else:
+                counts[si] = count
 
-        for name, max_host in q.all():
-            clusters[name] = max_host
+        if plain:
+            q = session.query(BuildItem.service_instance_id, func.count())
+            q = q.filter(BuildItem.service_instance_id.in_(plain.keys()))
+            q = q.group_by(BuildItem.service_instance_id)
+            for si_id, count in q:
+                counts[plain.pop(si_id)] = count
+            for si in plain.values():
+                counts[si] = 0
 
-        # Esx et al.
-        q = session.query(Cluster.name, Cluster.max_hosts)
-        q = q.filter(Cluster.cluster_type != 'meta')
-        q = q.filter(Cluster.service_bindings.contains(self))
-        q = q.filter(Cluster.personality_id.in_(personality_ids))
+        if not clustered:
+            return counts
 
-        for name, max_host in q.all():
-            clusters[name] = max_host
+        # Clusters bound to the instances, keyed by the cluster name to
+        # de-duplicate clusters bound both directly and through their
+        # metacluster
+        clusters = defaultdict(dict)
 
-        adjusted_count = sum(clusters.itervalues())
+        # Meta
+        McAlias = aliased(Cluster)
+        q = session.query(ClusterServiceBinding.service_instance_id,
+                          McAlias.personality_id, Cluster.name,
+                          Cluster.max_hosts)
+        q = q.join((McAlias,
+                    ClusterServiceBinding.cluster_id == McAlias.id))
+        q = q.join((MetaClusterMember,
+                    MetaClusterMember.metacluster_id == McAlias.id))
+        q = q.join((Cluster, MetaClusterMember.cluster_id == Cluster.id))
+        q = q.filter(McAlias.cluster_type == 'meta')
+        q = q.filter(ClusterServiceBinding.service_instance_id.in_(
+            clustered.keys()))
+        for si_id, personality_id, name, max_hosts in q:
+            if personality_id in aligned[clustered[si_id].service_id]:
+                clusters[si_id][name] = max_hosts
 
-        q = session.query(Host)
-        q = q.filter(Host.services_used.contains(self))
-        q = q.outerjoin('_cluster', 'cluster', from_joinpoint=True)
-        q = q.filter(or_(Cluster.id == None,
-                         ~Cluster.personality_id.in_(personality_ids)))
-        adjusted_count += q.count()
-        return adjusted_count
+        # Esx et al.
+        q = session.query(ClusterServiceBinding.service_instance_id,
+                          Cluster.personality_id, Cluster.name,
+                          Cluster.max_hosts)
+        q = q.join((Cluster, ClusterServiceBinding.cluster_id == Cluster.id))
+        q = q.filter(Cluster.cluster_type != 'meta')
+        q = q.filter(ClusterServiceBinding.service_instance_id.in_(
+            clustered.keys()))
+        for si_id, personality_id, name, max_hosts in q:
+            if personality_id in aligned[clustered[si_id].service_id]:
+                clusters[si_id][name] = max_hosts
+
+        for si_id, si in clustered.items():
+            counts[si] = sum(clusters[si_id].itervalues())
+
+        # Hosts are counted unless the cluster they're in is counted already
+        q = session.query(BuildItem.service_instance_id,
+                          Cluster.personality_id, func.count())
+        q = q.outerjoin((HostClusterMember,
+                         HostClusterMember.host_id == BuildItem.host_id))
+        q = q.outerjoin((Cluster, HostClusterMember.cluster_id == Cluster.id))
+        q = q.filter(BuildItem.service_instance_id.in_(clustered.keys()))
+        q = q.group_by(BuildItem.service_instance_id, Cluster.personality_id)
+        for si_id, personality_id, count in q:
+            si = clustered[si_id]
+            if personality_id is None or \
+               personality_id not in aligned[si.service_id]:
+                counts[si] += count
+
+        return counts
 
     @property
     def client_fqdns(self):
+        return client_roster.get(self)
+
+    def _query_client_names(self):
+        """Return the (DNS domain, short name) pairs of the clients."""
         session = object_session(self)
         q = session.query(DnsRecord)
         q = q.join(Machine, Host)
@@ -144,8 +240,8 @@ class ServiceInstance(Base):
         q = q.join((Fqdn, DnsRecord.fqdn_id == Fqdn.id), DnsDomain)
         q = q.options(contains_eager('fqdn'))
         q = q.options(contains_eager('fqdn.dns_domain'))
-        q = q.order_by(DnsDomain.name, Fqdn.name)
-        return [str(sys.fqdn) for sys in q.all()]
+        return [(str(sys.fqdn.dns_domain.name), str(sys.fqdn.name))
+                for sys in q.all()]
 
     @property
     def server_fqdns(self):
@@ -209,8 +305,7 @@ class ServiceInstance(Base):
         ## all relevant locations
         location_ids = []
         location_ids.append(dblocation.id)
-        for loc in reversed(dblocation.parents):
-            location_ids.append(loc.id)
+        location_ids.extend(reversed(dblocation.ancestor_ids()))
 
         search_maps = []
         if dbpersonality:
@@ -303,3 +398,234 @@ ServiceInstance._client_count = column_property(
     select([func.count()],
             BuildItem.service_instance_id == ServiceInstance.id)
     .label("_client_count"), deferred=True)
+
+
+def _client_name(dbhost):
+    if not dbhost.machine or not dbhost.machine.primary_name:
+        return None
+    dbfqdn = dbhost.machine.primary_name.fqdn
+    return (str(dbfqdn.dns_domain.name), str(dbfqdn.name))
+
+
+def _resolve(hosts):
+    """Return the names of the added and removed clients"""
+    added = []
+    removed = []
+    for dbhost, is_added in hosts.items():
+        name = _client_name(dbhost)
+        if name is None:
+            return None
+        if is_added:
+            added.append(name)
+        else:
+            removed.append(name)
+    return (added, removed)
+
+
+class ClientRoster(object):
+    """ Cache of the sorted client lists of service instances.
+
+        Building the client list of a big service instance means joining
+        and sorting tens of thousands of rows, and it is needed every time a
+        single client is bound or unbound. The committed client lists are
+        kept here instead, and updated from the changes of Host.services_used
+        when the transaction making them commits. Inside the transaction, the
+        uncommitted changes are applied on top of the cached list.
+
+        Renaming or deleting hosts drops the whole cache. Entries of service
+        instances changed by a transaction that got rolled back are dropped
+        as well.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # service instance id -> sorted list of (DNS domain, name) pairs.
+        # The lists are handed out and read without holding the lock, so
+        # they must never be modified; they are replaced instead.
+        self.rosters = {}
+        # Bumped whenever the committed client list of an instance changes,
+        # to avoid caching results which were stale already when queried
+        self.generations = {}
+        self.epoch = 0
+
+    def _changes(self, session, create=False):
+        changes = getattr(session, "_aq_client_roster", None)
+        if changes is None and create:
+            # service instance id -> {host: True (added) or False (removed)}
+            changes = {"instances": {}, "invalid": False}
+            session._aq_client_roster = changes
+        return changes
+
+    def _pending(self, dbinstance):
+        """Return the uncommitted changes of the instance's client list"""
+        changes = self._changes(object_session(dbinstance))
+        if not changes:
+            return ([], [])
+        if changes["invalid"]:
+            return None
+        if dbinstance.id not in changes["instances"]:
+            return ([], [])
+        return _resolve(changes["instances"][dbinstance.id])
+
+    def _stamp(self, instance_id):
+        return (self.epoch, self.generations.get(instance_id, 0))
+
+    def _load(self, dbinstance):
+        with self.lock:
+            names = self.rosters.get(dbinstance.id)
+            stamp = self._stamp(dbinstance.id)
+        pending = self._pending(dbinstance)
+        if names is None or pending is None:
+            names = dbinstance._query_client_names()
+            names.sort()
+            # Only cache the committed state, i.e. if the transaction did not
+            # touch the clients of the instance
+            if pending == ([], []):
+                with self.lock:
+                    if self._stamp(dbinstance.id) == stamp:
+                        self.rosters[dbinstance.id] = names[:]
+            return names
+        (added, removed) = pending
+        if added or removed:
+            return apply_changes(names, added, removed)
+        return names
+
+    def get(self, dbinstance):
+        return ["%s.%s" % (name, domain)
+                for (domain, name) in self._load(dbinstance)]
+
+    def count(self, dbinstance):
+        """Return the number of clients, if known without a query"""
+        with self.lock:
+            names = self.rosters.get(dbinstance.id)
+        if names is None:
+            return None
+        pending = self._pending(dbinstance)
+        if pending is None:
+            return None
+        return len(names) + len(pending[0]) - len(pending[1])
+
+    def drop(self, instance_id):
+        with self.lock:
+            self.rosters.pop(instance_id, None)
+            self.generations[instance_id] = \
+                    self.generations.get(instance_id, 0) + 1
+
+    def record(self, dbinstance, dbhost, is_added):
+        session = object_session(dbinstance) or object_session(dbhost)
+        if not session:
+            # We can't follow the transaction, so just forget what we know
+            if dbinstance.id is not None:
+                self.drop(dbinstance.id)
+            return
+        changes = self._changes(session, create=True)
+        if dbinstance.id is None:
+            # A new instance, which has no ID to track it by yet
+            changes["invalid"] = True
+            return
+        hosts = changes["instances"].setdefault(dbinstance.id, {})
+        if hosts.get(dbhost) == (not is_added):
+            # Adding and removing the same host cancel out
+            del hosts[dbhost]
+        else:
+            hosts[dbhost] = is_added
+
+    def invalidate(self, session):
+        changes = self._changes(session, create=True)
+        changes["invalid"] = True
+
+    def before_commit(self, session):
+        changes = self._changes(session)
+        if not changes or changes["invalid"]:
+            return
+        # The objects are expired after the commit, so resolve the names now
+        resolved = {}
+        for instance_id, hosts in changes["instances"].items():
+            resolved[instance_id] = _resolve(hosts)
+            if resolved[instance_id] is None:
+                changes["invalid"] = True
+                return
+        changes["resolved"] = resolved
+
+    def after_commit(self, session):
+        changes = self._changes(session)
+        if not changes:
+            return
+        session._aq_client_roster = None
+        with self.lock:
+            if changes["invalid"] or "resolved" not in changes:
+                self.rosters.clear()
+                self.epoch += 1
+                return
+            for instance_id, (added, removed) in changes["resolved"].items():
+                self.generations[instance_id] = \
+                        self.generations.get(instance_id, 0) + 1
+                if instance_id in self.rosters:
+                    self.rosters[instance_id] = \
+                            apply_changes(self.rosters[instance_id], added,
+                                          removed)
+
+    def after_rollback(self, session):
+        changes = self._changes(session)
+        if not changes:
+            return
+        session._aq_client_roster = None
+        for instance_id in changes["instances"].keys():
+            self.drop(instance_id)
+
+
+def apply_changes(names, added, removed):
+    """Return a copy of a sorted list with names added and removed"""
+    names = names[:]
+    for name in removed:
+        idx = bisect_left(names, name)
+        if idx < len(names) and names[idx] == name:
+            del names[idx]
+    for name in added:
+        idx = bisect_left(names, name)
+        if idx >= len(names) or names[idx] != name:
+            insort(names, name)
+    return names
+
+
+client_roster = ClientRoster()
+
+
+def _clients_append(dbinstance, dbhost, initiator):
+    client_roster.record(dbinstance, dbhost, True)
+    return dbhost
+
+
+def _clients_remove(dbinstance, dbhost, initiator):
+    client_roster.record(dbinstance, dbhost, False)
+
+
+def _client_renamed(target, value, oldvalue, initiator):
+    # Setting up new objects can't change the name of existing clients
+    session = object_session(target)
+    if session and target._sa_instance_state.has_identity:
+        client_roster.invalidate(session)
+    return value
+
+
+def _before_flush(session, flush_context, instances):
+    for obj in session.deleted:
+        if isinstance(obj, Host):
+            # The build items are removed without firing the remove events
+            client_roster.invalidate(session)
+        elif isinstance(obj, ServiceInstance):
+            client_roster.drop(obj.id)
+
+
+# Changes made through the Host.services_used backref fire these events too
+event.listen(ServiceInstance.clients, "append", _clients_append, retval=True)
+event.listen(ServiceInstance.clients, "remove", _clients_remove)
+event.listen(HardwareEntity.primary_name, "set", _client_renamed,
+             retval=True)
+event.listen(DnsRecord.fqdn, "set", _client_renamed, retval=True)
+event.listen(Fqdn.name, "set", _client_renamed, retval=True)
+event.listen(Fqdn.dns_domain, "set", _client_renamed, retval=True)
+event.listen(Session, "before_flush", _before_flush)
+event.listen(Session, "before_commit", client_roster.before_commit)
+event.listen(Session, "after_commit", client_roster.after_commit)
+event.listen(Session, "after_rollback", client_roster.after_rollback)
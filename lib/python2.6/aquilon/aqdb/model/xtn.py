@@ -17,6 +17,9 @@
 """ Xtn (transaction) is an audit trail of all broker activity """
 import logging
 from datetime import datetime
+from Queue import Queue, Empty
+from threading import Thread, Lock, Condition
+from time import time
 from dateutil.tz import tzutc
 
 from sqlalchemy import (Column, String, Integer, Boolean, ForeignKey,
@@ -138,6 +141,226 @@ if config.has_option('database', 'audit_schema'):  # pragma: no cover
     XtnDetail.__table__.schema = schema
 
 
+def _start_rows(xtn_id, username, command, is_readonly, details,
+                options_to_split=None):
+    xtn = {"xtn_id": xtn_id, "username": username, "command": command,
+           "is_readonly": is_readonly, "start_time": utcnow(None)}
+
+    rows = []
+    if options_to_split:
+        for option in options_to_split:
+            list_args = details.pop(option, None)
+            if not list_args:
+                continue
+            for item in list_args.strip().split('\n'):
+                item = item.strip()
+                if not item:
+                    continue
+                rows.append((option, item))
+    rows.extend(details.items())
+
+    # The same host may be listed more than once, but (xtn_id, name, value) is
+    # the primary key
+    seen = set()
+    xtn_details = []
+    for name, value in rows:
+        if (name, value) in seen:
+            continue
+        seen.add((name, value))
+        xtn_details.append({"xtn_id": xtn_id, "name": name, "value": value})
+    return (xtn, xtn_details)
+
+
+def _end_rows(xtn_id, return_code, results=None):
+    xtn_end = {"xtn_id": xtn_id, "return_code": return_code,
+               "end_time": utcnow(None)}
+    xtn_details = []
+    if results:
+        for name, value in results:
+            xtn_details.append({"xtn_id": xtn_id,
+                                "name": '__RESULT__:' + str(name),
+                                "value": str(value)})
+    return (xtn_end, xtn_details)
+
+
+def _insert(conn, xtns, xtn_details, xtn_ends):
+    # The order matters because of the foreign keys. Passing a list of rows
+    # makes execute() use executemany().
+    if xtns:
+        conn.execute(Xtn.__table__.insert(), xtns)
+    if xtn_details:
+        conn.execute(XtnDetail.__table__.insert(), xtn_details)
+    if xtn_ends:
+        conn.execute(XtnEnd.__table__.insert(), xtn_ends)
+
+
+class AuditWriter(object):
+    """ Write audit records from a background thread.
+
+        Records are queued, and written in batches using a dedicated
+        connection. If the queue is full, then callers block until there is
+        room again, so audit records are never dropped because of load. If
+        writing a batch fails, then the records are written again one at a
+        time, so only the records that really fail are lost. The end of a
+        command whose start was lost is dropped too, as it would just fail
+        the foreign key.
+    """
+
+    def __init__(self, engine, queue_size=10000, batch_size=1000,
+                 flush_interval=0.2):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue(queue_size)
+        self.conn = None
+        self.lock = Lock()
+        self.idle = Condition(self.lock)
+        # Number of records queued but not written yet
+        self.pending = 0
+        self.written = 0
+        self.failed = 0
+        # Commands whose start could not be written
+        self.lost = set()
+        self.thread = Thread(target=self.run, name="AuditWriter")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def submit(self, xtns=None, xtn_details=None, xtn_ends=None):
+        with self.lock:
+            self.pending += 1
+        self.queue.put((xtns or [], xtn_details or [], xtn_ends or []))
+
+    def flush(self, timeout=None):
+        """ Wait until everything queued so far has been written. """
+        deadline = timeout is not None and time() + timeout
+        with self.lock:
+            while self.pending:
+                if deadline:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return False
+                    self.idle.wait(remaining)
+                else:
+                    self.idle.wait()
+        return True
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(True, remaining))
+                except Empty:
+                    break
+            self.write(batch)
+            with self.lock:
+                self.pending -= len(batch)
+                if not self.pending:
+                    self.idle.notifyAll()
+
+    def _insert(self, items):
+        xtns = []
+        xtn_details = []
+        xtn_ends = []
+        for item in items:
+            xtns.extend(item[0])
+            xtn_details.extend(item[1])
+            xtn_ends.extend(item[2])
+        try:
+            if not self.conn:
+                self.conn = self.engine.connect()
+            trans = self.conn.begin()
+            try:
+                _insert(self.conn, xtns, xtn_details, xtn_ends)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        except:
+            # Start over with a new connection
+            if self.conn:
+                try:
+                    self.conn.close()
+                except Exception:  # pragma: no cover
+                    pass
+                self.conn = None
+            raise
+
+    def _skip_lost(self, items):
+        """ Drop the ends of the commands whose start was lost. """
+        result = []
+        for item in items:
+            lost = [xtn_end["xtn_id"] for xtn_end in item[2]
+                    if xtn_end["xtn_id"] in self.lost]
+            if not lost:
+                result.append(item)
+                continue
+            self.failed += 1
+            for xtn_id in lost:
+                # There is only one end per command
+                self.lost.discard(xtn_id)
+                log.error("Dropping the end of command %s, its start was "
+                          "not written" % xtn_id)
+        return result
+
+    def write(self, batch):
+        batch = self._skip_lost(batch)
+        if len(batch) > 1:
+            try:
+                self._insert(batch)
+                self.written += len(batch)
+                return
+            except Exception, e:
+                log.warning("Failed to write %d audit records, writing them "
+                            "one at a time: %s" % (len(batch), e))
+
+        # The start of a command is queued before its end, so by the time the
+        # end is written, it is known whether the start was lost
+        for item in batch:
+            if not self._skip_lost([item]):
+                continue
+            try:
+                self._insert([item])
+                self.written += 1
+            except Exception, e:
+                self.failed += 1
+                for xtn in item[0]:
+                    self.lost.add(xtn["xtn_id"])
+                log.error("Failed to write audit record: %s" % e)
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def get_audit_writer(engine):
+    """ Return the audit writer, or None if records are written inline. """
+    global _writer
+
+    if config.get('database', 'audit_mode') != 'async':
+        return None
+    with _writer_lock:
+        if not _writer:
+            _writer = AuditWriter(
+                engine,
+                queue_size=config.getint('database', 'audit_queue_size'),
+                batch_size=config.getint('database', 'audit_batch_size'),
+                flush_interval=config.getfloat('database',
+                                               'audit_flush_interval'))
+        return _writer
+
+
+def flush_audit(timeout=None):
+    """ Make sure the records queued so far are visible in the DB. """
+    if _writer:
+        return _writer.flush(timeout)
+    return True
+
+
 def start_xtn(session, xtn_id, username, command, is_readonly, details,
               options_to_split=None):
     """ Wrapper to log the start of a transaction (or running command).
@@ -150,31 +373,21 @@ def start_xtn(session, xtn_id, username, command, is_readonly, details,
     The options_to_split is a list of any options that need to be
     split on newlines.  Typically this is --list and/or --hostlist.
 
+    If audit_mode is "async", then the records are handed to the
+    background writer, otherwise they are committed before returning.
+
     """
 
-    # TODO: (maybe) use sql inserts instead of objects to avoid added overhead?
-    # We would be able to exploit executemany() for all the xtn_detail rows
-    x = Xtn(xtn_id=xtn_id, command=command, username=username,
-            is_readonly=is_readonly)
-    session.add(x)
+    (xtn, xtn_details) = _start_rows(xtn_id, username, command, is_readonly,
+                                     details, options_to_split)
 
-    if options_to_split:
-        for option in options_to_split:
-            list_args = details.pop(option, None)
-            if not list_args:
-                continue
-            for item in list_args.strip().split('\n'):
-                item = item.strip()
-                if not item:
-                    continue
-                x = XtnDetail(xtn_id=xtn_id, name=option, value=item)
-                session.add(x)
+    writer = get_audit_writer(session.bind)
+    if writer:
+        writer.submit(xtns=[xtn], xtn_details=xtn_details)
+        return
 
-    if len(details.keys()) > 0:
-        for k, v in details.iteritems():
-            x = XtnDetail(xtn_id=xtn_id, name=k, value=v)
-            session.add(x)
     try:
+        _insert(session.connection(), [xtn], xtn_details, None)
         session.commit()
     except Exception, e:  # pragma: no cover
         session.rollback()
@@ -186,13 +399,15 @@ def start_xtn(session, xtn_id, username, command, is_readonly, details,
 def end_xtn(session, xtn_id, return_code, results=None):
     """ Take an audit message and commit the transaction completion. """
 
-    session.add(XtnEnd(xtn_id=xtn_id, return_code=return_code))
-    if results:
-        for name, value in results:
-            session.add(XtnDetail(xtn_id=xtn_id, name='__RESULT__:' + str(name),
-                                  value=str(value)))
+    (xtn_end, xtn_details) = _end_rows(xtn_id, return_code, results)
+
+    writer = get_audit_writer(session.bind)
+    if writer:
+        writer.submit(xtn_details=xtn_details, xtn_ends=[xtn_end])
+        return
 
     try:
+        _insert(session.connection(), None, xtn_details, [xtn_end])
         session.commit()
     except Exception, e:  # pragma: no cover
         session.rollback()
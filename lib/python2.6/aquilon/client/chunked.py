@@ -34,6 +34,10 @@ class ChunkedHTTPResponse(httplib.HTTPResponse):
 
         if chunk_left is None:
             line = self.fp.readline()
+            if not line:
+                # The server dropped the connection in the middle of the
+                # response
+                raise httplib.IncompleteRead(value)
             i = line.find(';')
             if i >= 0:
                 line = line[:i]  # strip chunk-extensions
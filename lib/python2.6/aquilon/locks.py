@@ -17,13 +17,25 @@
 
 
 import logging
-from threading import Condition
+from threading import Lock, Condition
+from time import time
 
 from aquilon.exceptions_ import InternalError
 
 LOGGER = logging.getLogger('aquilon.locks')
 
 
+class LockNode(object):
+    """A node in the index of queued keys, one per key prefix."""
+
+    __slots__ = ('children', 'keys')
+
+    def __init__(self):
+        self.children = {}
+        # Keys having a leaf that ends at this node
+        self.keys = set()
+
+
 class LockQueue(object):
     """Provide a layered (namespaced?) locking mechanism.
 
@@ -33,28 +45,58 @@ class LockQueue(object):
     granted once there are no conflicting lock requests preceeding
     it in the queue.
 
+    Queued keys are indexed in a trie on their components, so finding
+    the keys that conflict with a new request only touches the part of
+    the queue sharing a prefix with it.  Since only earlier requests can
+    block a key, the set of blockers is fixed when the key is queued and
+    only ever shrinks; a waiter is woken just when one of its own blockers
+    is released.
+
     As a convenience, ignore undefined keys.  This essentially
     equates a key of None with a no-op request.
 
     """
 
     def __init__(self):
-        self.queue_condition = Condition()
+        self.queue_lock = Lock()
         self.queue = []
+        self.index = LockNode()
+        # Statistics about how long it took to get the locks
+        self.acquired_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
 
     def acquire(self, key):
         if key is None:
             return
         key.transition("acquiring", debug=True)
-        with self.queue_condition:
-            if key in self.queue:
+        key.requested = time()
+        key.acquired = None
+        with self.queue_lock:
+            if key.queued:
                 raise InternalError("Duplicate attempt to aquire %s with the "
                                     "same key." % key)
+            key.blockers = self.conflicts(key)
+            key.blocker_count = len(key.blockers)
+            if key.blockers:
+                key.condition = Condition(self.queue_lock)
+                for blocker in key.blockers:
+                    blocker.waiters.add(key)
             self.queue.append(key)
-            while self.blocked(key):  # pragma: no cover
+            self.add_to_index(key)
+            key.queued = True
+            while key.blockers:  # pragma: no cover
+                key.blocker_count = len(key.blockers)
                 key.log("requesting %s with %s others waiting",
                         key, key.blocker_count)
-                self.queue_condition.wait()
+                key.condition.wait()
+            key.condition = None
+            key.acquired = time()
+            wait = key.acquired - key.requested
+            self.acquired_count += 1
+            self.total_wait += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
             key.transition("acquired")
 
     def blocked(self, key):
@@ -66,28 +108,78 @@ class LockQueue(object):
         """
         if key is None:
             return False
-        key.reset_blockers()
-        is_blocked = False
-        for k in self.queue:
-            if k == key:
-                return is_blocked
-            if k.blocks(key):
+        with self.queue_lock:
+            if key.queued:
+                blockers = key.blockers
+            else:
+                # The key is not in the queue - seems like a valid
+                # theoretical question to ask - in which case the method
+                # is "would queued keys block this one?"
+                blockers = self.conflicts(key)
+            key.reset_blockers()
+            for k in blockers:
                 key.register_blocker(k)
-                is_blocked = True
-        # Can only get here if the key is not in the queue - seems
-        # like a valid theoretical question to ask - in which case
-        # the method is "would queued keys block this one?"
-        return is_blocked
+            return bool(blockers)
 
     def release(self, key):
         if key is None:
             return
         key.transition("releasing")
-        with self.queue_condition:
+        with self.queue_lock:
             self.queue.remove(key)
-            self.queue_condition.notifyAll()
+            self.remove_from_index(key)
+            key.queued = False
+            for waiter in key.waiters:
+                waiter.blockers.discard(key)
+                waiter.condition.notify()
+            key.waiters = set()
         key.transition("released", debug=True)
 
+    def conflicts(self, key):
+        """Return the set of queued keys conflicting with the given key.
+
+        Must be called with the queue lock held.
+
+        """
+        found = set()
+        for leaf in key.leaves:
+            node = self.index
+            found.update(node.keys)
+            for component in leaf:
+                node = node.children.get(component)
+                if node is None:
+                    break
+                found.update(node.keys)
+            else:
+                # Everything below the leaf conflicts as well
+                stack = node.children.values()
+                while stack:
+                    node = stack.pop()
+                    found.update(node.keys)
+                    stack.extend(node.children.values())
+        found.discard(key)
+        return found
+
+    def add_to_index(self, key):
+        for leaf in key.leaves:
+            node = self.index
+            for component in leaf:
+                node = node.children.setdefault(component, LockNode())
+            node.keys.add(key)
+
+    def remove_from_index(self, key):
+        for leaf in key.leaves:
+            path = [self.index]
+            for component in leaf:
+                path.append(path[-1].children[component])
+            path[-1].keys.discard(key)
+            # Prune the nodes that became empty
+            for (component, parent, node) in reversed(zip(leaf, path[:-1],
+                                                          path[1:])):
+                if node.keys or node.children:
+                    break
+                del parent.children[component]
+
 
 class LockKey(object):
     """Create a key composed of an ordered list of components.
@@ -105,6 +197,13 @@ class LockKey(object):
         self.blocker_count = None
         self.lock_queue = lock_queue
         self.state = None
+        # Bookkeeping for the LockQueue
+        self.queued = False
+        self.blockers = set()
+        self.waiters = set()
+        self.condition = None
+        self.requested = None
+        self.acquired = None
         self.transition("initialized", debug=True)
 
     def __str__(self):
@@ -134,6 +233,15 @@ class LockKey(object):
         else:
             self.log('%s %s', state, self)
 
+    @property
+    def wait_time(self):
+        """Seconds spent waiting for the lock (so far, if still waiting)."""
+        if self.requested is None:
+            return None
+        if self.acquired is None:
+            return time() - self.requested
+        return self.acquired - self.requested
+
     def reset_blockers(self):
         self.blocker_count = 0
 
@@ -160,34 +268,100 @@ class LockKey(object):
 
         """
 
+        if isinstance(key, LockSet):
+            return key.blocks(self)
         for (a, b) in zip(self.components, key.components):
             if a != b:
                 return False
         return True
 
+    @property
+    def leaves(self):
+        """The set of component tuples covered by this key."""
+        return set([tuple(self.components)])
+
     @staticmethod
     def merge(keylist):
-        """Find the common root of a list of keys and make a new key.
+        """Combine a list of keys into a single key.
 
-        The new key will be in the LockKey class.  Returning a key of
-        the same class as the list (assuming they're all the same) is
-        possible but more work for little gain.
+        The result covers exactly the union of the input keys.  Leaves
+        which are already covered by a shorter key in the list are
+        dropped.  If a single leaf remains, then the result is a plain
+        LockKey, otherwise it is a LockSet.  Returning a key of the same
+        class as the list (assuming they're all the same) is possible but
+        more work for little gain.
 
         """
         keylist = [key for key in keylist if key is not None]
         if not keylist:
             return None
-        components = []
         # Assume logger/loglevel is consistent across the list.
         logger = keylist[0].logger
         loglevel = keylist[0].loglevel
         lock_queue = keylist[0].lock_queue
-        for position in zip(*[key.components for key in keylist]):
-            unique_elements = set(position)
-            if len(unique_elements) == 1:
-                components.append(unique_elements.pop())
-            else:
-                return LockKey(components, logger=logger, loglevel=loglevel,
-                               lock_queue=lock_queue)
-        return LockKey(components, logger=logger, loglevel=loglevel,
+        leaves = set()
+        for key in keylist:
+            leaves.update(key.leaves)
+        # Shortest first, so covering keys are seen before what they cover
+        reduced = set()
+        for leaf in sorted(leaves, key=len):
+            if not any(leaf[:i] in reduced for i in range(len(leaf))):
+                reduced.add(leaf)
+        if len(reduced) == 1:
+            return LockKey(list(reduced.pop()), logger=logger,
+                           loglevel=loglevel, lock_queue=lock_queue)
+        return LockSet(reduced, logger=logger, loglevel=loglevel,
                        lock_queue=lock_queue)
+
+
+class LockSet(LockKey):
+    """A key composed of several independent leaves.
+
+    Each leaf is a tuple of components, as used by LockKey.  Two keys
+    conflict if any leaf of one is a prefix of (or equal to) a leaf of
+    the other, so the check can be done with set intersections rather
+    than by collapsing the leaves to their common root.
+
+    The components attribute is set to the common root of the leaves for
+    the benefit of code that only looks at the components.
+
+    """
+
+    def __init__(self, leaves, logger=LOGGER, loglevel=logging.INFO,
+                 lock_queue=None):
+        self._leaves = frozenset(tuple(leaf) for leaf in leaves)
+        self.prefixes = frozenset(leaf[:i] for leaf in self._leaves
+                                  for i in range(len(leaf) + 1))
+        components = []
+        for position in zip(*self._leaves):
+            if len(set(position)) != 1:
+                break
+            components.append(position[0])
+        LockKey.__init__(self, components, logger=logger, loglevel=loglevel,
+                         lock_queue=lock_queue)
+
+    def __str__(self):
+        names = sorted("/".join(leaf) for leaf in self._leaves)
+        if len(names) > 5:
+            names[5:] = ["%d more" % (len(names) - 5)]
+        return 'locks for %s' % ", ".join(names)
+
+    @property
+    def leaves(self):
+        return self._leaves
+
+    def blocks(self, key):
+        """Determine if this key blocks another.
+
+        A leaf of the other key must either be a prefix of one of our
+        leaves, or have one of our leaves as a prefix.
+
+        """
+        other_leaves = key.leaves
+        if self.prefixes.intersection(other_leaves):
+            return True
+        for leaf in other_leaves:
+            for i in range(len(leaf)):
+                if leaf[:i] in self._leaves:
+                    return True
+        return False
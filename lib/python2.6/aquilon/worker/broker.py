@@ -34,8 +34,9 @@ from aquilon.worker.logger import RequestLogger
 from aquilon.aqdb.db_factory import DbFactory
 from aquilon.aqdb.model.xtn import start_xtn, end_xtn
 from aquilon.worker.formats.formatters import ResponseFormatter
+from aquilon.worker.streaming import ResponseStream
 from aquilon.worker.dbwrappers.user_principal import (
-        get_or_create_user_principal)
+        get_cached_user_principal)
 from aquilon.worker.dbwrappers.resources import add_resource, del_resource
 from aquilon.locks import LockKey
 from aquilon.worker.templates.base import Plenary, PlenaryCollection
@@ -267,8 +268,7 @@ class BrokerCommand(object):
                     # before this point which might be used later.
                     self._record_xtn(session, logger.get_status())
 
-                    dbuser = get_or_create_user_principal(session, principal,
-                                                          commitoncreate=True)
+                    dbuser = get_cached_user_principal(session, principal)
                     kwargs["dbuser"] = dbuser
 
                     if self.requires_azcheck:
@@ -292,7 +292,15 @@ class BrokerCommand(object):
                 retval = command(*args, **kwargs)
                 if self.requires_format:
                     style = kwargs.get("style", None)
-                    retval = self.formatter.format(style, retval, request)
+                    chunks = self.formatter.format_stream(style, retval,
+                                                          request)
+                    if chunks is not None:
+                        # The session must stay open while formatting
+                        stream = ResponseStream(request)
+                        stream.write(chunks)
+                        retval = stream
+                    else:
+                        retval = self.formatter.format(style, retval, request)
                 if "session" in kwargs:
                     session.commit()
                 return retval
@@ -68,7 +68,8 @@ def del_cluster(session, logger, dbcluster, config):
                     logger=logger)
         resources.remove(locked=True)
 
-    build_index(config, session, profiles, logger=logger)
+    build_index(config, session, profiles, logger=logger,
+                only=["clusters/" + cluster])
 
     return
 
@@ -143,6 +143,7 @@ class CommandDelHost(BrokerCommand):
                 bindings.write(locked=True)
                 resources.remove(locked=True)
 
-            build_index(self.config, session, profiles, logger=logger)
+            build_index(self.config, session, profiles, logger=logger,
+                        only=[fqdn])
 
         return
@@ -19,13 +19,13 @@
 
 import os
 import re
-from tempfile import mkdtemp
 
 from aquilon.exceptions_ import (ProcessException, ArgumentError,
                                  AuthorizationException)
 from aquilon.aqdb.model import Domain, Branch, Sandbox
 from aquilon.worker.broker import BrokerCommand  # pylint: disable=W0611
-from aquilon.worker.processes import run_git, remove_dir, sync_domain
+from aquilon.worker.processes import run_git, git_is_ancestor, sync_domain
+from aquilon.worker.workspaces import get_workspace_pool
 from aquilon.worker.logger import CLIENT_INFO
 
 TCM_RE = re.compile(r"^tcm=([0-9]+)$", re.IGNORECASE)
@@ -90,24 +90,16 @@ class CommandDeploy(BrokerCommand):
         if isinstance(dbsource, Sandbox):
             domainsdir = self.config.get('broker', 'domainsdir')
             targetdir = os.path.join(domainsdir, dbtarget.name)
-            filterre = re.compile('^' + dbsource.base_commit + '$')
-            found = run_git(['rev-list', 'HEAD'], path=targetdir,
-                            logger=logger, filterre=filterre)
-            if not found:
+            if not git_is_ancestor(dbsource.base_commit, path=targetdir,
+                                   logger=logger):
                 raise ArgumentError("You're trying to deploy a sandbox to a "
                                     "domain that does not contain the commit "
                                     "where the sandbox was branched from.")
 
-        kingdir = self.config.get("broker", "kingdir")
-        rundir = self.config.get("broker", "rundir")
-
-        tempdir = mkdtemp(prefix="deploy_", suffix="_%s" % dbsource.name,
-                          dir=rundir)
-        try:
-            run_git(["clone", "--shared", "--branch", dbtarget.name,
-                     kingdir, dbtarget.name],
-                    path=tempdir, logger=logger)
-            temprepo = os.path.join(tempdir, dbtarget.name)
+        workspace = get_workspace_pool(self.config).checkout(
+            dbtarget.name, fetch=[dbsource.name], logger=logger)
+        with workspace:
+            temprepo = workspace.path
 
             # We could try to use fmt-merge-msg but its usage is so obscure that
             # faking it is easier
@@ -140,14 +132,13 @@ class CommandDeploy(BrokerCommand):
 
             run_git(["push", "origin", dbtarget.name],
                     path=temprepo, logger=logger)
-        finally:
-            remove_dir(tempdir, logger=logger)
 
         # What to do about errors here and below... rolling back
         # doesn't seem appropriate as there's something more
         # fundamentally wrong with the repos.
         try:
-            sync_domain(dbtarget, logger=logger)
+            # Only the target branch changed, no need to fetch everything
+            sync_domain(dbtarget, logger=logger, branch_only=True)
         except ProcessException, e:
             logger.warn("Error syncing domain %s: %s" % (dbtarget.name, e))
 
@@ -51,4 +51,5 @@ class CommandDumpDns(BrokerCommand):
             # evicted from the session's cache
             dns_domains = session.query(DnsDomain).all()
 
-        return DnsDump(q.all(), dns_domains)
+        # The records are loaded in batches while the output is being sent
+        return DnsDump(q, dns_domains)
@@ -19,11 +19,13 @@
 
 from collections import defaultdict
 from operator import attrgetter
+from threading import Thread, Lock
+from time import time
 
 from sqlalchemy.orm import joinedload, subqueryload, lazyload, contains_eager
 from sqlalchemy.orm.attributes import set_committed_value
 
-from aquilon.exceptions_ import PartialError, IncompleteError
+from aquilon.exceptions_ import ArgumentError, PartialError, IncompleteError
 from aquilon.aqdb.model import (Service, Machine, Chassis, Host,
                                 Personality, Cluster, City, Rack, Resource,
                                 ResourceHolder, HostResource, ClusterResource,
@@ -36,15 +38,90 @@ from aquilon.worker.templates.base import Plenary
 from aquilon.worker.locks import CompileKey
 
 
+class PlenaryWriter(object):
+    """Write out plenary templates using a pool of threads.
+
+    Generating the content of the templates needs the database session, so
+    it is done in the calling thread.  Reading back the old content,
+    comparing it with the new one and writing out the files are handed over
+    to the thread pool, in batches to limit the memory used by the pending
+    content.
+
+    """
+
+    def __init__(self, logger, threads, batch_size=1000):
+        self.logger = logger
+        self.threads = threads
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = Lock()
+        self.written = 0
+        self.failed = []
+        self.generate_time = 0.0
+        self.write_time = 0.0
+
+    def add(self, plenary, description):
+        """Generate the content of the plenary, and queue it for writing.
+
+        Errors generating the content are raised to the caller, while
+        errors writing the files are collected in self.failed.
+
+        """
+        start = time()
+        try:
+            for plen in plenary.prepare_write():
+                self.pending.append((plen, description))
+        finally:
+            self.generate_time += time() - start
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _write(self, batch):
+        written = 0
+        failed = []
+        for plenary, description in batch:
+            try:
+                written += plenary.write(locked=True)
+            except Exception, e:
+                failed.append("%s failed: %s" % (description, e))
+        with self.lock:
+            self.written += written
+            self.failed.extend(failed)
+
+    def flush(self):
+        """Write out all pending plenaries."""
+        if not self.pending:
+            return
+        start = time()
+        batch = self.pending
+        self.pending = []
+        workers = []
+        for i in range(1, min(self.threads, len(batch))):
+            worker = Thread(target=self._write, args=(batch[i::self.threads],))
+            worker.start()
+            workers.append(worker)
+        # The current thread takes its share of the work as well
+        self._write(batch[0::self.threads])
+        for worker in workers:
+            worker.join()
+        self.write_time += time() - start
+
+
 class CommandFlush(BrokerCommand):
 
     def render(self, session, logger,
                services, personalities, machines, clusters, hosts,
-               locations, resources, switches, all,
+               locations, resources, switches, all, parallel,
                **arguments):
         success = []
         failed = []
-        written = 0
+
+        if parallel is None:
+            parallel = self.config.getint("broker", "flush_threads")
+        if parallel < 1:
+            raise ArgumentError("The value of --parallel must be a positive "
+                                "integer.")
+        writer = PlenaryWriter(logger, parallel)
 
         # Caches for keeping preloaded data pinned in memory, since the SQLA
         # session holds a weak reference only
@@ -69,6 +146,7 @@ class CommandFlush(BrokerCommand):
 
         with CompileKey(logger=logger):
             logger.client_info("Loading data.")
+            start = time()
 
             # When flushing clusters/hosts, loading the resource holder is done
             # as the query that loads those objects. But when flushing resources
@@ -170,15 +248,17 @@ class CommandFlush(BrokerCommand):
                               subqueryload("parents"))
                 racks = q.all()
 
+            load_time = time() - start
+
             if locations:
                 logger.client_info("Flushing locations.")
                 for dbloc in session.query(City).all():
                     try:
                         plenary = Plenary.get_plenary(dbloc, logger=logger)
-                        written += plenary.write(locked=True)
+                        writer.add(plenary, "City %s" % dbloc)
                     except Exception, e:
                         failed.append("City %s failed: %s" %
-                                      dbloc, e)
+                                      (dbloc, e))
                         continue
 
             if services:
@@ -189,7 +269,7 @@ class CommandFlush(BrokerCommand):
                     try:
                         plenary_info = Plenary.get_plenary(dbservice,
                                                            logger=logger)
-                        written += plenary_info.write(locked=True)
+                        writer.add(plenary_info, "Service %s" % dbservice.name)
                     except Exception, e:
                         failed.append("Service %s failed: %s" %
                                       (dbservice.name, e))
@@ -199,7 +279,9 @@ class CommandFlush(BrokerCommand):
                         try:
                             plenary_info = Plenary.get_plenary(dbinst,
                                                                logger=logger)
-                            written += plenary_info.write(locked=True)
+                            writer.add(plenary_info,
+                                       "Service %s instance %s" %
+                                       (dbservice.name, dbinst.name))
                         except Exception, e:
                             failed.append("Service %s instance %s failed: %s" %
                                           (dbservice.name, dbinst.name, e))
@@ -211,7 +293,8 @@ class CommandFlush(BrokerCommand):
                     try:
                         plenary_info = Plenary.get_plenary(persona,
                                                            logger=logger)
-                        written += plenary_info.write(locked=True)
+                        writer.add(plenary_info,
+                                   "Personality %s" % persona.name)
                     except Exception, e:
                         failed.append("Personality %s failed: %s" %
                                       (persona.name, e))
@@ -278,7 +361,7 @@ class CommandFlush(BrokerCommand):
                     try:
                         plenary_info = Plenary.get_plenary(machine,
                                                            logger=logger)
-                        written += plenary_info.write(locked=True)
+                        writer.add(plenary_info, "Machine %s" % machine.label)
                     except Exception, e:
                         label = machine.label
                         if machine.host:
@@ -329,7 +412,8 @@ class CommandFlush(BrokerCommand):
 
                     try:
                         plenary_host = Plenary.get_plenary(h, logger=logger)
-                        written += plenary_host.write(locked=True)
+                        writer.add(plenary_host,
+                                   "{0} in {1:l}".format(h, h.branch))
                     except IncompleteError, e:
                         pass
                         #logger.client_info("Not flushing host: %s" % e)
@@ -357,7 +441,7 @@ class CommandFlush(BrokerCommand):
                                            (idx, cnt))
                     try:
                         plenary = Plenary.get_plenary(clus, logger=logger)
-                        written += plenary.write(locked=True)
+                        writer.add(plenary, format(clus))
                     except Exception, e:
                         failed.append("{0} failed: {1}".format(clus, e))
 
@@ -374,7 +458,7 @@ class CommandFlush(BrokerCommand):
                                            (idx, cnt))
                     try:
                         plenary = Plenary.get_plenary(dbresource, logger=logger)
-                        written += plenary.write(locked=True)
+                        writer.add(plenary, format(dbresource))
                     except Exception, e:
                         failed.append("{0} failed: {1}".format(dbresource, e))
 
@@ -383,10 +467,21 @@ class CommandFlush(BrokerCommand):
                 for dbswitch in session.query(Switch).all():
                     try:
                         plenary = Plenary.get_plenary(dbswitch, logger=logger)
-                        written += plenary.write(locked=True)
+                        writer.add(plenary, format(dbswitch))
                     except Exception, e:
                         failed.append("{0} failed: {1}".format(dbswitch, e))
 
+            writer.flush()
+            written = writer.written
+            failed.extend(writer.failed)
+
+            logger.client_info("Loading data took %.1f seconds, generating "
+                               "templates took %.1f seconds, writing "
+                               "templates using %d threads took %.1f "
+                               "seconds." %
+                               (load_time, writer.generate_time, parallel,
+                                writer.write_time))
+
             # written + len(failed) isn't actually the total that should
             # have been done, but it's the easiest to implement for this
             # count and should be reasonably close... :)
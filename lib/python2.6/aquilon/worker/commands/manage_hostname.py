@@ -16,7 +16,6 @@
 # limitations under the License.
 
 import os
-import re
 
 from aquilon.exceptions_ import IncompleteError, ArgumentError
 from aquilon.worker.broker import BrokerCommand  # pylint: disable=W0611
@@ -24,7 +23,7 @@ from aquilon.worker.dbwrappers.branch import get_branch_and_author
 from aquilon.worker.dbwrappers.host import hostname_to_host
 from aquilon.worker.templates.host import PlenaryHost
 from aquilon.worker.locks import lock_queue, CompileKey
-from aquilon.worker.processes import run_git
+from aquilon.worker.processes import run_git, git_is_ancestor
 from aquilon.aqdb.model import Sandbox
 from aquilon.worker.formats.branch import AuthoredSandbox
 from aquilon.exceptions_ import ProcessException
@@ -79,16 +78,7 @@ def validate_branch_commits(dbsource, dbsource_author,
                             "published to template-king yet.".format(dbsource))
 
     # check if target branch has the latest source commit
-    try:
-        filterre = re.compile('^' + dbsource_commit + '$')
-        found = run_git(['rev-list', 'HEAD'], filterre=filterre,
-                        path=target_path, logger=logger)
-    except ProcessException as pe:
-        if pe.code != 128:
-            raise
-        else:
-            found = None
-    if not found:
+    if not git_is_ancestor(dbsource_commit, path=target_path, logger=logger):
         raise ArgumentError("The target {0:l} does not contain the latest "
                             "commit from source {1:l}.".format(dbtarget,
                                                                dbsource))
@@ -22,6 +22,7 @@ from tempfile import NamedTemporaryFile
 from aquilon.exceptions_ import ArgumentError, NotFoundException
 from aquilon.worker.broker import BrokerCommand  # pylint: disable=W0611
 from aquilon.worker.dbwrappers.host import (hostname_to_host,
+                                            hostnames_to_hosts,
                                             get_host_bound_service,
                                             check_hostlist_size)
 from aquilon.worker.processes import run_command
@@ -62,9 +63,13 @@ class CommandPxeswitchList(BrokerCommand):
         servers = dict()
         groups = dict()
         failed = []
+        found = hostnames_to_hosts(session, list)
         for host in list:
             try:
-                dbhost = hostname_to_host(session, host)
+                if host in found:
+                    dbhost = found[host]
+                else:
+                    dbhost = hostname_to_host(session, host)
 
                 if arguments.get("install", None) and (dbhost.status.name == "ready" or
                                                        dbhost.status.name == "almostready"):
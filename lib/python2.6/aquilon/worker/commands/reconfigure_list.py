@@ -25,7 +25,8 @@ from aquilon.aqdb.model import (Archetype, Personality,
                                 OperatingSystem, HostLifecycle)
 from aquilon.worker.templates.domain import TemplateDomain
 from aquilon.worker.locks import lock_queue, CompileKey
-from aquilon.worker.services import Chooser
+from aquilon.worker.services import (Chooser, ClientCountCache,
+                                     ServiceMapResolver)
 
 
 class CommandReconfigureList(BrokerCommand):
@@ -172,19 +173,34 @@ class CommandReconfigureList(BrokerCommand):
         session.flush()
 
         logger.client_info("Verifying service bindings.")
+        # Share the client counts and the service maps, so they are looked
+        # up only once
+        client_counts = ClientCountCache(session)
+        service_maps = ServiceMapResolver(session)
         for dbhost in dbhosts:
             if dbhost.archetype.is_compileable:
                 if arguments.get("keepbindings", None):
                     chooser = Chooser(dbhost, logger=logger,
-                                      required_only=False)
+                                      required_only=False,
+                                      client_counts=client_counts,
+                                      service_maps=service_maps)
                 else:
                     chooser = Chooser(dbhost, logger=logger,
-                                      required_only=True)
+                                      required_only=True,
+                                      client_counts=client_counts,
+                                      service_maps=service_maps)
                 choosers.append(chooser)
-                try:
-                    chooser.set_required()
-                except ArgumentError, e:
-                    failed.append(str(e))
+        required_services = set()
+        for chooser in choosers:
+            required_services.update(chooser.required_services)
+        service_maps.prefetch([(chooser.personality, chooser.location,
+                                chooser.network) for chooser in choosers],
+                              required_services)
+        for chooser in choosers:
+            try:
+                chooser.set_required()
+            except ArgumentError, e:
+                failed.append(str(e))
         if failed:
             raise ArgumentError("The following hosts failed service "
                                 "binding:\n%s" % "\n".join(failed))
@@ -198,20 +214,27 @@ class CommandReconfigureList(BrokerCommand):
 
         # Optimize so that duplicate service plenaries are not re-written
         templates = set()
+        # Only the profiles affected by this change need to be compiled: the
+        # hosts themselves, and the servers of any service instance that has
+        # gained or lost a client.
+        profiles = set()
         for chooser in choosers:
             # chooser.plenaries is a PlenaryCollection - this flattens
             # that top level.
             templates.update(chooser.plenaries.plenaries)
+            profiles.add(str(chooser.dbhost.fqdn))
+            profiles.update(chooser.changed_server_fqdns())
 
         # Don't bother locking until every possible check before the
         # actual writing and compile is done.  This will allow for fast
         # turnaround on errors (no need to wait for a lock if there's
         # a missing service map entry or something).
-        # The lock must be over at least the domain, but could be over
-        # all if (for example) service plenaries need to change.
+        # The lock must cover at least the profiles being compiled, but could
+        # be over all if (for example) service plenaries need to change.
         key = CompileKey.merge([p.get_write_key() for p in templates] +
                                [CompileKey(domain=dbbranch.name,
-                                           logger=logger)])
+                                           profile=profile, logger=logger)
+                                for profile in profiles])
         try:
             lock_queue.acquire(key)
             logger.client_info("Writing %s plenary templates.", len(templates))
@@ -222,7 +245,7 @@ class CommandReconfigureList(BrokerCommand):
                 logger.debug("Writing %s", template)
                 template.write(locked=True)
             td = TemplateDomain(dbbranch, dbauthor, logger=logger)
-            td.compile(session, locked=True)
+            td.compile(session, only=profiles, locked=True)
         except:
             logger.client_info("Restoring plenary templates.")
             for template in templates:
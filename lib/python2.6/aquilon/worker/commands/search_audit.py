@@ -24,6 +24,7 @@ from aquilon.exceptions_ import ArgumentError
 from aquilon.worker.broker import BrokerCommand  # pylint: disable=W0611
 from aquilon.worker.formats.transaction_info import TransactionList
 from aquilon.aqdb.model import Xtn, XtnDetail, XtnEnd
+from aquilon.aqdb.model.xtn import flush_audit
 
 _IGNORED_COMMANDS = ('show_active_locks', 'show_active_commands', 'cat',
                      'search_audit')
@@ -33,8 +34,15 @@ class CommandSearchAudit(BrokerCommand):
 
     required_parameters = []
 
-    def render(self, session, keyword, argument, username, command, before,
-               after, return_code, limit, reverse_order, **arguments):
+    def render(self, session, logger, keyword, argument, username, command,
+               before, after, return_code, limit, reverse_order, **arguments):
+
+        # Make sure the records of the commands run so far are visible
+        timeout = self.config.getfloat('database', 'audit_flush_timeout')
+        if not flush_audit(timeout):
+            logger.warning("The audit records of the most recent commands "
+                           "were not written in %s seconds, they may be "
+                           "missing from the results." % timeout)
 
         q = session.query(Xtn)
 
@@ -34,7 +34,7 @@ class CommandSearchDnsDomainMap(BrokerCommand):
         q = q.options(undefer('comments'))
         if dblocation:
             if include_parents:
-                location_ids = [parent.id for parent in dblocation.parents]
+                location_ids = dblocation.ancestor_ids()
                 location_ids.append(dblocation.id)
                 q = q.filter(DnsMap.location_id.in_(location_ids))
             else:
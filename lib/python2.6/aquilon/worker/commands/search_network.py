@@ -20,14 +20,15 @@ from sqlalchemy.sql import exists
 from sqlalchemy.orm import undefer
 
 from aquilon.worker.broker import BrokerCommand  # pylint: disable=W0611
-from aquilon.exceptions_ import ArgumentError
+from aquilon.exceptions_ import ArgumentError, NotFoundException
 from aquilon.aqdb.model import (Network, Machine, VlanInfo, ObservedVlan,
                                 Cluster, ARecord, DynamicStub,
                                 NetworkEnvironment)
 from aquilon.aqdb.model.dns_domain import parse_fqdn
 from aquilon.worker.dbwrappers.location import get_location
 from aquilon.worker.formats.network import ShortNetworkList
-from aquilon.aqdb.model.network import get_net_id_from_ip
+from aquilon.aqdb.model.network import (get_net_id_from_ip,
+                                        get_networks_from_ips)
 
 
 class CommandSearchNetwork(BrokerCommand):
@@ -89,8 +90,14 @@ class CommandSearchNetwork(BrokerCommand):
             dnsq = dnsq.join(ARecord.fqdn)
             dnsq = dnsq.filter_by(name=short)
             dnsq = dnsq.filter_by(dns_domain=dbdns_domain)
-            networks = [get_net_id_from_ip(session, addr.ip, dbnet_env).id
-                        for addr in dnsq.all()]
+            ips = [addr.ip for addr in dnsq.all()]
+            ip_to_net = get_networks_from_ips(session, ips, dbnet_env)
+            for ip in ips:
+                if ip not in ip_to_net:
+                    # Same error as get_net_id_from_ip()
+                    raise NotFoundException("Could not determine network "
+                                            "containing IP address %s." % ip)
+            networks = [dbnetwork.id for dbnetwork in ip_to_net.values()]
             q = q.filter(Network.id.in_(networks))
         if cluster:
             dbcluster = Cluster.get_unique(session, cluster, compel=True)
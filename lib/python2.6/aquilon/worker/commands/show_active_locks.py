@@ -37,5 +37,16 @@ class CommandShowActiveLocks(BrokerCommand):
                 status = key.logger.get_status()
                 if status and status.description:
                     description = status.description + ' '
-            retval.append("%s%s %s" % (description, key.state, key))
+            if key.acquired is None:
+                timing = "waiting for %.1fs" % key.wait_time
+            else:
+                timing = "waited %.1fs" % key.wait_time
+            retval.append("%s%s %s (%s)" % (description, key.state, key,
+                                            timing))
+        if lock_queue.acquired_count:
+            retval.append("Locks acquired: %d, average wait: %.3fs, "
+                          "maximum wait: %.3fs" %
+                          (lock_queue.acquired_count,
+                           lock_queue.total_wait / lock_queue.acquired_count,
+                           lock_queue.max_wait))
         return str("\n".join(retval))
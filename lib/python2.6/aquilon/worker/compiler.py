@@ -0,0 +1,247 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Backends running the targets of build.xml to compile profiles.
+
+By default, every compile starts a new ant process, paying the startup
+cost of the JVM and of ant every time.  If the compile_worker option is
+set, compiles are handed to a pool of long-running worker processes
+instead.  There is a separate pool for every version of the compiler, and
+workers are started when they are first needed.
+
+The workers read jobs from their standard input, and write the results to
+their standard output.  A job looks like:
+
+    buildfile /path/to/build.xml
+    target compile.object.profile
+    property domain=prod
+    property object.profile=host1.example.com host2.example.com
+    run
+
+The worker answers with any number of "out <text>" and "err <text>"
+lines, followed by "done <return code>".  etc/compile_worker.js implements
+the protocol by running ant inside jrunscript, and
+tests/fakebin/fake_compile_worker implements it without needing Java.
+
+"""
+
+import os
+import logging
+from subprocess import Popen, PIPE
+from threading import Lock, Condition
+
+from aquilon.config import Config
+from aquilon.exceptions_ import ProcessException, InternalError
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _command_env(env):
+    # Same as run_command()
+    shell_env = env.copy() if env else {}
+    for envname, envvalue in os.environ.items():
+        if envname.startswith("KRB") or envname.startswith("AQTEST"):
+            shell_env[envname] = envvalue
+    if "PATH" not in shell_env and "PATH" in os.environ:
+        shell_env["PATH"] = os.environ["PATH"]
+    return shell_env
+
+
+class AntBackend(object):
+    """Start a new ant process for every compile."""
+
+    def __init__(self, ant, buildfile):
+        self.ant = ant
+        self.buildfile = buildfile
+
+    def compile(self, compiler, target, properties, env, path, logger,
+                loglevel):
+        # Imported here to avoid a circular import
+        from aquilon.worker.processes import run_command
+
+        args = [self.ant, "--noconfig", "-f", self.buildfile]
+        args.extend(["-D%s=%s" % (name, value)
+                     for name, value in properties])
+        args.append(target)
+        return run_command(args, env=env, logger=logger, path=path,
+                           loglevel=loglevel)
+
+
+class CompileWorker(object):
+    """A single long-running compile worker process."""
+
+    def __init__(self, args, env, path):
+        self.args = args
+        self.jobs = 0
+        self.process = Popen(args=args, stdin=PIPE, stdout=PIPE,
+                             cwd=path, env=_command_env(env),
+                             close_fds=True)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, buildfile, target, properties, logger, loglevel):
+        """Run a job, and return the return code and the output."""
+        self.jobs += 1
+        request = ["buildfile %s\n" % buildfile, "target %s\n" % target]
+        for name, value in properties:
+            value = str(value)
+            if "\n" in value:
+                raise InternalError("Invalid value for property %s: %r" %
+                                    (name, value))
+            request.append("property %s=%s\n" % (name, value))
+        request.append("run\n")
+        self.process.stdin.write("".join(request))
+        self.process.stdin.flush()
+
+        out = []
+        err = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise IOError("Compile worker exited unexpectedly")
+            (kind, sep, text) = line.rstrip("\n").partition(" ")
+            if kind == "done":
+                return (int(text), "".join(out), "".join(err))
+            elif kind == "out":
+                out.append(text + "\n")
+            elif kind == "err":
+                err.append(text + "\n")
+            else:
+                # Something the worker did not mean to send us
+                logger.info("Unexpected output from compile worker: %s" %
+                            line.rstrip("\n"))
+                continue
+            logger.log(loglevel, "%s", text)
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except IOError:  # pragma: no cover
+            pass
+        try:
+            self.process.wait()
+        except OSError:  # pragma: no cover
+            pass
+
+
+class WorkerBackend(object):
+    """Hand compiles to a pool of long-running worker processes."""
+
+    def __init__(self, command, buildfile, workers=2, max_jobs=100):
+        self.command = command
+        self.buildfile = buildfile
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.lock = Lock()
+        self.available = Condition(self.lock)
+        # compiler -> list of idle workers
+        self.idle = {}
+        # compiler -> number of workers, idle or busy
+        self.count = {}
+
+    def _acquire(self, compiler, env, path, logger):
+        with self.lock:
+            while True:
+                idle = self.idle.setdefault(compiler, [])
+                while idle:
+                    worker = idle.pop()
+                    if worker.alive():
+                        return worker
+                    self.count[compiler] -= 1
+                if self.count.get(compiler, 0) < self.workers:
+                    self.count[compiler] = self.count.get(compiler, 0) + 1
+                    break
+                self.available.wait()
+
+        args = self.command.split()
+        logger.info("Starting compile worker: %s" % " ".join(args))
+        try:
+            return CompileWorker(args, env, path)
+        except OSError, e:
+            self._release(compiler, None)
+            raise ProcessException(command=" ".join(args), err=str(e))
+
+    def _release(self, compiler, worker):
+        with self.lock:
+            if worker and worker.alive() and worker.jobs < self.max_jobs:
+                self.idle[compiler].append(worker)
+                worker = None
+            else:
+                self.count[compiler] -= 1
+            self.available.notify()
+        if worker:
+            worker.stop()
+
+    def compile(self, compiler, target, properties, env, path, logger,
+                loglevel):
+        worker = self._acquire(compiler, env, path, logger)
+        description = "compile worker %s" % target
+        logger.info("Running %s" % description)
+        try:
+            try:
+                (code, out, err) = worker.run(self.buildfile, target,
+                                              properties, logger, loglevel)
+            except (IOError, ValueError), e:
+                # Don't reuse a worker in an unknown state
+                worker.stop()
+                raise ProcessException(command=description,
+                                       err="Compile worker failed: %s" % e)
+        finally:
+            self._release(compiler, worker)
+        if code != 0:
+            raise ProcessException(command=description, out=out, err=err,
+                                   code=code)
+        return out
+
+    def shutdown(self):
+        with self.lock:
+            workers = []
+            for idle in self.idle.values():
+                workers.extend(idle)
+                del idle[:]
+            for compiler in self.count.keys():
+                self.count[compiler] = 0
+        for worker in workers:
+            worker.stop()
+
+
+_backend = None
+_backend_lock = Lock()
+
+
+def get_backend(config=None):
+    """Return the compile backend selected by the configuration."""
+    global _backend
+
+    with _backend_lock:
+        if _backend:
+            return _backend
+        if not config:
+            config = Config()
+        buildfile = os.path.join(config.get("broker", "compiletooldir"),
+                                 "build.xml")
+        command = None
+        if config.has_option("broker", "compile_worker"):
+            command = config.get("broker", "compile_worker").strip()
+        if command:
+            _backend = WorkerBackend(
+                command, buildfile,
+                workers=config.getint("broker", "compile_workers"),
+                max_jobs=config.getint("broker", "compile_worker_max_jobs"))
+        else:
+            _backend = AntBackend(config.get("broker", "ant"), buildfile)
+        return _backend
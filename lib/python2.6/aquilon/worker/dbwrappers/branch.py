@@ -26,6 +26,7 @@ from aquilon.aqdb.model import Domain, Sandbox, Branch
 from aquilon.worker.dbwrappers.user_principal import get_user_principal
 from aquilon.worker.processes import remove_dir, run_git
 from aquilon.worker.locks import CompileKey
+from aquilon.worker.workspaces import get_workspace_pool
 from aquilon.worker.templates.domain import TemplateDomain
 
 VERSION_RE = re.compile(r'^[-_.a-zA-Z0-9]*$')
@@ -83,6 +84,8 @@ def remove_branch(config, logger, dbbranch):
         for dir in domain.directories():
             remove_dir(dir, logger=logger)
 
+    get_workspace_pool(config).remove(dbbranch.name, logger=logger)
+
     kingdir = config.get("broker", "kingdir")
     try:
         run_git(["branch", "-D", dbbranch.name],
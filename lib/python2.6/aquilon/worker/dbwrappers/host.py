@@ -17,10 +17,18 @@
 """Wrappers to make getting and using hosts simpler."""
 
 
+from collections import defaultdict
+
+from sqlalchemy.orm import contains_eager
+
 from aquilon.exceptions_ import NotFoundException, ArgumentError
-from aquilon.aqdb.model import Machine
+from aquilon.aqdb.model import (Machine, DnsRecord, Fqdn, DnsDomain,
+                                DnsEnvironment)
 from aquilon.aqdb.model.dns_domain import parse_fqdn
 
+# Oracle does not allow more than 1000 elements in an IN-list
+MAX_IN_LIST = 1000
+
 
 def hostname_to_host(session, hostname):
     # When the user asked for a host, returning "machine not found" does not
@@ -39,10 +47,68 @@ def hostname_to_host(session, hostname):
     return dbmachine.host
 
 
+def hostnames_to_hosts(session, hostnames):
+    """Look up the hosts of many host names using a few bulk queries.
+
+    Returns a dict mapping the host names to Host objects. Names that do not
+    belong to a host are left out; call hostname_to_host() for those to get
+    the right error message.
+
+    """
+    shortnames = defaultdict(set)
+    for hostname in hostnames:
+        (short, dot, dns_domain) = hostname.partition(".")
+        if short and dns_domain:
+            shortnames[dns_domain.lower()].add(short.lower())
+    if not shortnames:
+        return {}
+
+    dbdns_env = DnsEnvironment.get_unique_or_default(session)
+
+    dbdns_domains = []
+    domain_names = sorted(shortnames.keys())
+    for start in range(0, len(domain_names), MAX_IN_LIST):
+        q = session.query(DnsDomain)
+        q = q.filter(DnsDomain.name.in_(domain_names[start:start +
+                                                     MAX_IN_LIST]))
+        dbdns_domains.extend(q.all())
+
+    found = {}
+    for dbdns_domain in dbdns_domains:
+        names = sorted(shortnames.get(dbdns_domain.name.lower(), []))
+        for start in range(0, len(names), MAX_IN_LIST):
+            q = session.query(Machine)
+            q = q.join((DnsRecord, Machine.primary_name_id == DnsRecord.id),
+                       (Fqdn, DnsRecord.fqdn_id == Fqdn.id))
+            q = q.options(contains_eager('primary_name'),
+                          contains_eager('primary_name.fqdn'))
+            q = q.filter(Fqdn.dns_environment == dbdns_env)
+            q = q.filter(Fqdn.dns_domain == dbdns_domain)
+            q = q.filter(Fqdn.name.in_(names[start:start + MAX_IN_LIST]))
+            for dbmachine in q:
+                if dbmachine.host:
+                    key = "%s.%s" % (dbmachine.primary_name.fqdn.name,
+                                     dbdns_domain.name)
+                    found[key.lower()] = dbmachine.host
+
+    result = {}
+    for hostname in hostnames:
+        dbhost = found.get(hostname.lower())
+        if dbhost:
+            result[hostname] = dbhost
+    return result
+
+
 def hostlist_to_hosts(session, hostlist):
     dbhosts = []
     failed = []
+    # Resolve the list in bulk, and fall back to looking up the remaining
+    # names one by one to produce the proper error messages
+    found = hostnames_to_hosts(session, hostlist)
     for host in hostlist:
+        if host in found:
+            dbhosts.append(found[host])
+            continue
         try:
             dbhosts.append(hostname_to_host(session, host))
         except NotFoundException, nfe:
@@ -20,6 +20,7 @@ To an extent, this has become a dumping ground for any common ip methods.
 
 """
 
+from bisect import bisect_left, insort
 from ipaddr import IPv4Address
 import re
 
@@ -159,41 +160,7 @@ def generate_ip(session, logger, dbinterface, ip=None, ipfromip=None,
     # COMMIT or ROLLBACK.
     dbnetwork.lock_row()
 
-    startip = dbnetwork.first_usable_host
-
-    used_ips = session.query(ARecord.ip)
-    used_ips = used_ips.filter_by(network=dbnetwork)
-    used_ips = used_ips.filter(ARecord.ip >= startip)
-
-    full_set = set(range(int(startip), int(dbnetwork.broadcast)))
-    used_set = set([int(item.ip) for item in used_ips])
-    free_set = full_set - used_set
-
-    if not free_set:
-        raise ArgumentError("No available IP addresses found on "
-                            "network %s." % str(dbnetwork.network))
-
-    if ipalgorithm is None or ipalgorithm == 'lowest':
-        # Select the lowest available address
-        ip = IPv4Address(min(free_set))
-    elif ipalgorithm == 'highest':
-        # Select the highest available address
-        ip = IPv4Address(max(free_set))
-    elif ipalgorithm == 'max':
-        # Return the max. used address + 1
-        if not used_set:
-            # Avoids ValueError being thrown when used_set is empty
-            ip = IPv4Address(min(free_set))
-        else:
-            next = max(used_set)
-            if not next + 1 in free_set:
-                raise ArgumentError("Failed to find an IP that is suitable "
-                                    "for --ipalgorithm=max.  Try an other "
-                                    "algorithm as there are still some free "
-                                    "addresses.")
-            ip = IPv4Address(next + 1)
-    else:
-        raise ArgumentError("Unknown algorithm %s." % ipalgorithm)
+    ip = IPAllocator(session, dbnetwork).allocate(1, ipalgorithm)[0]
 
     if audit_results is not None:
         if dbinterface:
@@ -206,6 +173,137 @@ def generate_ip(session, logger, dbinterface, ip=None, ipfromip=None,
     return ip
 
 
+class IPAllocator(object):
+    """ Find free addresses on a network without enumerating all of them
+
+        Only the addresses already in use are loaded, as a sorted list of
+        integers, and free addresses are found by walking the gaps between
+        them.  Reserved offsets are treated as being in use, and so are the
+        addresses of dynamic ranges, since their stubs are A records.
+
+        The caller is expected to hold the lock of the network.  Allocated
+        addresses are marked as used, so several calls on the same allocator
+        return different addresses.
+    """
+
+    def __init__(self, session, dbnetwork):
+        self.network = dbnetwork
+        self.start = int(dbnetwork.first_usable_host)
+        # The broadcast address is never handed out
+        self.end = int(dbnetwork.broadcast)
+
+        q = session.query(ARecord.ip)
+        q = q.filter_by(network=dbnetwork)
+        q = q.filter(ARecord.ip >= dbnetwork.first_usable_host)
+        records = set([int(item.ip) for item in q])
+
+        # Highest address of an existing record, for --ipalgorithm=max
+        self.max_used = max(records) if records else None
+
+        used = set([addr for addr in records
+                    if self.start <= addr < self.end])
+        if dbnetwork.network.numhosts >= 8:
+            # Same condition as in check_ip_restrictions()
+            base = int(dbnetwork.ip)
+            used.update([base + offset
+                         for offset in dbnetwork.reserved_offsets
+                         if offset >= 0 and
+                         self.start <= base + offset < self.end])
+        self.used = sorted(used)
+
+    @property
+    def free_count(self):
+        return max(self.end - self.start - len(self.used), 0)
+
+    def _ascending(self, start):
+        """ Yield the free addresses starting at start, in increasing order """
+        addr = max(start, self.start)
+        idx = bisect_left(self.used, addr)
+        while addr < self.end:
+            if idx < len(self.used) and self.used[idx] == addr:
+                idx += 1
+            else:
+                yield addr
+            addr += 1
+
+    def _descending(self):
+        """ Yield the free addresses in decreasing order """
+        addr = self.end - 1
+        idx = len(self.used) - 1
+        while addr >= self.start:
+            if idx >= 0 and self.used[idx] == addr:
+                idx -= 1
+            else:
+                yield addr
+            addr -= 1
+
+    def _is_used(self, addr):
+        idx = bisect_left(self.used, addr)
+        return idx < len(self.used) and self.used[idx] == addr
+
+    def _take(self, addresses, count):
+        result = []
+        for addr in addresses:
+            result.append(addr)
+            if len(result) >= count:
+                break
+        return result
+
+    def allocate(self, count=1, ipalgorithm=None):
+        """ Return a list of count free addresses
+
+            The algorithm can be 'lowest' (the default), 'highest', or 'max',
+            which returns the addresses following the highest address in use.
+        """
+        if not self.free_count:
+            raise ArgumentError("No available IP addresses found on "
+                                "network %s." % str(self.network.network))
+        if count > self.free_count:
+            raise ArgumentError("Requested %d IP addresses, but only %d are "
+                                "available on network %s." %
+                                (count, self.free_count,
+                                 str(self.network.network)))
+
+        if ipalgorithm is None or ipalgorithm == 'lowest':
+            # Select the lowest available addresses
+            addrs = self._take(self._ascending(self.start), count)
+        elif ipalgorithm == 'highest':
+            # Select the highest available addresses
+            addrs = self._take(self._descending(), count)
+        elif ipalgorithm == 'max':
+            # Return the max. used address + 1
+            if self.max_used is None:
+                addrs = self._take(self._ascending(self.start), count)
+            else:
+                addrs = range(self.max_used + 1, self.max_used + 1 + count)
+                if addrs[0] < self.start or addrs[-1] >= self.end or \
+                   [addr for addr in addrs if self._is_used(addr)]:
+                    raise ArgumentError("Failed to find an IP that is "
+                                        "suitable for --ipalgorithm=max.  Try "
+                                        "an other algorithm as there are "
+                                        "still some free addresses.")
+        else:
+            raise ArgumentError("Unknown algorithm %s." % ipalgorithm)
+
+        for addr in addrs:
+            insort(self.used, addr)
+            if self.max_used is None or addr > self.max_used:
+                self.max_used = addr
+        return [IPv4Address(addr) for addr in addrs]
+
+
+def allocate_ips(session, dbnetwork, count, ipalgorithm=None):
+    """ Allocate a number of addresses on a network in one go
+
+        Meant for building racks, where allocating the addresses one by one
+        would scan the network once for every host.  The addresses are
+        returned in the order of the algorithm.
+    """
+    # See the comment in generate_ip()
+    dbnetwork.lock_row()
+    return IPAllocator(session, dbnetwork).allocate(count, ipalgorithm)
+
+
 def describe_interface(session, interface):
     description = ["%s interface %s has MAC address %s and boot=%s" %
                    (interface.interface_type, interface.name, interface.mac,
@@ -17,6 +17,8 @@
 """ Helper functions for managing parameters. """
 
 import re
+from collections import defaultdict
+
 from aquilon.exceptions_ import NotFoundException, ArgumentError
 from aquilon.utils import (force_json_dict, force_int, force_float,
                            force_boolean)
@@ -27,6 +29,7 @@ from aquilon.aqdb.model import (Personality, Parameter,
                                 ParamDefinition,
                                 ArchetypeParamDef,
                                 PersonalityParameter)
+from aquilon.aqdb.model.parameter import parameter_index
 from aquilon.worker.formats.parameter_definition import ParamDefinitionFormatter
 
 
@@ -231,8 +234,20 @@ def get_parameters(session, archetype=None, personality=None):
                                         auto_include=False)
     if param_holder is None:
         return []
-    q = session.query(Parameter).filter_by(holder=param_holder)
-    return q.all()
+    # The relation is loaded only once per session, which matters when
+    # generating the plenaries of features
+    return list(param_holder.parameters)
+
+
+def get_parameter_paths(session, archetype=None, personality=None):
+    """ Return the indexed paths of the parameters of a personality """
+
+    param_holder = get_parameter_holder(session, archetype=archetype,
+                                        personality=personality,
+                                        auto_include=False)
+    if param_holder is None:
+        return []
+    return parameter_index.get(session, [param_holder])[param_holder]
 
 
 def get_paramdef_for_parameter(session, path, param_holder, dbfeaturelink=None):
@@ -274,12 +289,13 @@ def validate_required_parameter(param_definitions, parameters, dbfeaturelink=Non
         if (not param_def.required) or param_def.default:
             continue
 
+        if dbfeaturelink:
+            path = Parameter.feature_path(dbfeaturelink, param_def.path)
+        else:
+            path = param_def.path
         value = None
-        for param in parameters:
-            if dbfeaturelink:
-                value = param.get_feature_path(dbfeaturelink, param_def.path, compel=False)
-            else:
-                value = param.get_path(param_def.path, compel=False)
+        for paths in parameters:
+            value = parameter_index.lookup(paths, path)
             if value:
                 break
             ## ignore if value is specified
@@ -293,34 +309,33 @@ def search_path_in_personas(session, path, paramdef_holder):
 
     q = session.query(PersonalityParameter)
     q = q.join(Personality)
+    links = defaultdict(list)
     if isinstance(paramdef_holder, ArchetypeParamDef):
         q = q.filter_by(archetype=paramdef_holder.archetype)
     else:
         q = q.join(FeatureLink)
         q = q.filter_by(feature=paramdef_holder.feature)
 
+        # Load the feature links of all personalities at once
+        lq = session.query(FeatureLink)
+        lq = lq.filter_by(feature=paramdef_holder.feature)
+        for link in lq:
+            links[link.personality_id].append(link)
+    q = q.options(subqueryload('parameters'))
+
     holder = {}
-    trypath = []
-    if isinstance(paramdef_holder, ArchetypeParamDef):
-        trypath.append(path)
     for param_holder in q.all():
-        try:
-            if not isinstance(paramdef_holder, ArchetypeParamDef):
-                trypath = []
-                q = session.query(FeatureLink)
-                q = q.filter_by(feature=paramdef_holder.feature,
-                                personality=param_holder.personality)
-
-                for link in q.all():
-                    trypath.append(Parameter.feature_path(link, path))
-
-            for tpath in trypath:
-                for param in param_holder.parameters:
-                    value = param.get_path(tpath)
-                    if value:
-                        holder[param_holder] = {path: value}
-        except NotFoundException:
-            pass
+        if isinstance(paramdef_holder, ArchetypeParamDef):
+            trypath = [path]
+        else:
+            trypath = [Parameter.feature_path(link, path)
+                       for link in links[param_holder.personality_id]]
+
+        for tpath in trypath:
+            for param in param_holder.parameters:
+                value = param.get_path(tpath, compel=False)
+                if value:
+                    holder[param_holder] = {path: value}
     return holder
 
 
@@ -343,7 +358,7 @@ def validate_personality_config(session, archetype, personality):
     error = []
     ## validate parameters
     param_definitions = []
-    parameters = get_parameters(session, personality=dbpersonality)
+    parameters = get_parameter_paths(session, personality=dbpersonality)
     if dbarchetype.paramdef_holder:
         param_definitions = dbarchetype.paramdef_holder.param_definitions
         error += validate_required_parameter(param_definitions, parameters)
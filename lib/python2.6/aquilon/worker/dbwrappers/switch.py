@@ -30,7 +30,8 @@ from aquilon.exceptions_ import (InternalError, NotFoundException,
 from aquilon.aqdb.model import (Service, ServiceInstance, NetworkEnvironment,
                                 AddressAssignment, ARecord, Model,
                                 RouterAddress)
-from aquilon.aqdb.model.network import get_net_id_from_ip
+from aquilon.aqdb.model.network import (get_net_id_from_ip,
+                                        get_networks_from_ips)
 from aquilon.worker.processes import run_command
 from aquilon.worker.dbwrappers.dns import delete_dns_record, grab_address
 from aquilon.worker.dbwrappers.interface import (get_or_create_interface,
@@ -269,14 +270,17 @@ def discover_switch(session, logger, config, dbswitch, dryrun):
     # Build a lookup table of discovered IP addresses
     ip_to_iface = {}
     networks = []
+    discovered_ips = [IPv4Address(ipstr)
+                      for params in data["interfaces"].values()
+                      for ipstr in params["ip"].keys()]
+    ip_to_net = get_networks_from_ips(session, discovered_ips, dbnet_env)
     for ifname, params in data["interfaces"].items():
         for ipstr, label in params["ip"].items():
             ip = IPv4Address(ipstr)
-            try:
-                dbnetwork = get_net_id_from_ip(session, ip, dbnet_env)
+            if ip in ip_to_net:
                 ip_to_iface[ip] = {"name": ifname, "label": label}
-                networks.append(dbnetwork)
-            except NotFoundException:
+                networks.append(ip_to_net[ip])
+            else:
                 warning("Skipping IP address %s: network not found." % ip)
 
                 # Avoid creating the interface if there are no valid IPs
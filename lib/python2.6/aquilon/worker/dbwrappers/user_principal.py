@@ -19,9 +19,15 @@
 
 import re
 import logging
+from itertools import chain
+from threading import Lock
+from time import time
 
+from sqlalchemy import event
 from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.orm.session import Session
 
+from aquilon.config import Config
 from aquilon.exceptions_ import ArgumentError, InternalError, NotFoundException
 from aquilon.aqdb.model import Role, Realm, UserPrincipal
 from aquilon.worker.dbwrappers.host import hostname_to_host
@@ -108,3 +114,124 @@ def get_user_principal(session, user):
     if len(dbusers) == 0:
         raise NotFoundException("User '%s' not found." % user)
     return dbusers[0]
+
+
+class PrincipalCache(object):
+    """Cache of the user principals of the clients, with their roles.
+
+    The principal of the client has to be looked up for every command.
+    Detached copies of the principals are cached for at most ttl seconds,
+    and are merged into the session of the command without going to the
+    database. The whole cache is dropped whenever a principal or a role
+    changes, e.g. by aq permission.
+
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = Lock()
+        # principal -> (detached UserPrincipal, expiry time)
+        self.entries = {}
+        # Bumped by clear(), to avoid caching a principal loaded before the
+        # change
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session, principal):
+        """Return the principal merged into session, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(principal)
+            if entry and entry[1] > time():
+                self.hits += 1
+            else:
+                self.misses += 1
+                return None
+        return session.merge(entry[0], load=False)
+
+    def store(self, session, principal, dbuser):
+        with self.lock:
+            generation = self.generation
+        # Make sure everything needed is loaded, and take a copy not bound
+        # to the session of the command
+        dbuser.name, dbuser.role.name, dbuser.realm.name
+        copy_session = Session(bind=session.bind)
+        try:
+            copy = copy_session.merge(dbuser, load=False)
+            copy_session.expunge_all()
+        finally:
+            copy_session.close()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[principal] = (copy, time() + self.ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+_principal_cache = None
+_principal_cache_lock = Lock()
+
+
+def get_principal_cache():
+    global _principal_cache
+
+    with _principal_cache_lock:
+        if _principal_cache is None:
+            config = Config()
+            _principal_cache = PrincipalCache(
+                ttl=config.getint("broker", "principal_cache_ttl"))
+        return _principal_cache
+
+
+def get_cached_user_principal(session, principal):
+    """Same as get_or_create_user_principal(), but use the cache.
+
+    This is meant to be used for authenticating the client. The principal
+    is created if it does not exist yet, and the creation is committed.
+
+    """
+    if principal is None:
+        return None
+    cache = get_principal_cache()
+    if cache.ttl <= 0:
+        return get_or_create_user_principal(session, principal,
+                                            commitoncreate=True)
+
+    dbuser = cache.get(session, principal)
+    if dbuser:
+        # Don't let a cached principal outlive the host it belongs to
+        m = principal_re.match(principal)
+        m = m and host_re.match(m.group(1))
+        if m:
+            hostname_to_host(session, m.group(1))
+        return dbuser
+
+    dbuser = get_or_create_user_principal(session, principal,
+                                          commitoncreate=True)
+    cache.store(session, principal, dbuser)
+    return dbuser
+
+
+def _principals_changed(session, flush_context):
+    for obj in chain(session.dirty, session.deleted):
+        if isinstance(obj, (UserPrincipal, Role, Realm)):
+            session._aq_principals_changed = True
+            if _principal_cache:
+                _principal_cache.clear()
+            return
+
+
+def _after_commit(session):
+    # Clear again, in case another command cached the old state before the
+    # commit
+    if getattr(session, "_aq_principals_changed", False):
+        session._aq_principals_changed = False
+        if _principal_cache:
+            _principal_cache.clear()
+
+
+event.listen(Session, "after_flush", _principals_changed)
+event.listen(Session, "after_commit", _after_commit)
@@ -18,6 +18,7 @@
 
 
 from aquilon.worker.formats.formatters import ObjectFormatter
+from aquilon.worker.formats.list import QueryBatches
 from aquilon.aqdb.model import (DnsRecord, DynamicStub, ARecord, Alias,
                                 ReservedName, SrvRecord)
 
@@ -83,12 +84,12 @@ def nstr(text):
     return "".join(str8(p) for p in (text + ".").split('.'))
 
 
-class DnsDump(list):
-    def __init__(self, records, dns_domains):
+class DnsDump(QueryBatches):
+    def __init__(self, query, dns_domains):
         # Store a reference to the DNS domains to prevent them being evicted
         # from the session's cache
         self.dns_domains = dns_domains
-        super(DnsDump, self).__init__(records)
+        super(DnsDump, self).__init__(query)
 
 
 class DnsDumpFormatter(ObjectFormatter):
@@ -96,6 +97,10 @@ class DnsDumpFormatter(ObjectFormatter):
     # always enough to decide how to dump it, so we don't use the individual
     # record formatters.
 
+    stream_formats = ("raw", "djb")
+    # Records may have no output at all
+    stream_line_based = True
+
     def format_raw(self, dump, indent=""):
         result = []
         # The output is not the most readable as we don't make use of $ORIGIN,
@@ -49,6 +49,60 @@ class ResponseFormatter(object):
         m = getattr(self, "format_" + str(style).lower(), self.format_raw)
         return str(m(result, request))
 
+    def format_stream(self, style, result, request):
+        """Return an iterator over the chunks of the formatted result.
+
+        Returns None if the result should rather be formatted in one go by
+        format(): if the formatter of the result does not support streaming,
+        or if the result is small enough.  The size of the chunks is set by
+        the stream_chunk_size option of the broker.
+
+        """
+        style = str(style).lower()
+        handler = ObjectFormatter.handlers.get(result.__class__,
+                                               ObjectFormatter.default_handler)
+        if not handler.can_stream(style):
+            return None
+        chunk_size = ObjectFormatter.config.getint("broker",
+                                                   "stream_chunk_size")
+        if chunk_size <= 0:
+            return None
+        if hasattr(result, "iter_batches"):
+            # Results backed by a query are never loaded as a whole
+            parts = result.iter_batches(chunk_size)
+        elif isinstance(result, list) and len(result) > chunk_size:
+            # Slicing a list subclass returns a plain list, so the handler
+            # of the original result has to be called directly
+            parts = (result[start:start + chunk_size]
+                     for start in xrange(0, len(result), chunk_size))
+        else:
+            return None
+        return self.iter_chunks(style, handler, parts)
+
+    def iter_chunks(self, style, handler, parts):
+        separator = ""
+        for part in parts:
+            if style == "csv":
+                yield str(handler.format_csv(part))
+            elif style == "proto":
+                # Concatenating serialized messages of the same type gives a
+                # message with the repeated fields merged, so the client
+                # does not notice the difference
+                res = handler.format_proto(part, None)
+                if hasattr(res, "SerializeToString"):
+                    res = res.SerializeToString()
+                yield str(res)
+            else:
+                if style == "djb":
+                    text = str(handler.format_djb(part))
+                else:
+                    text = str(handler.format_raw(part, ""))
+                # Joining the chunks must give the same result as joining all
+                # the elements, even if some chunk has no output
+                if text or not handler.stream_line_based:
+                    yield separator + text
+                    separator = "\n"
+
     def format_raw(self, result, request, indent=""):
         return ObjectFormatter.redirect_raw(result)
 
@@ -122,6 +176,27 @@ class ObjectFormatter(object):
 
     """
 
+    stream_formats = ()
+    stream_line_based = False
+
+    """ Formatters of large lists may list the formats in stream_formats, to
+        allow the response to be sent while it is being formatted, a chunk
+        of elements at a time.  This is only correct if formatting the list
+        gives the same result as formatting consecutive slices of it and
+        concatenating them (raw and djb output joined by newlines).  If
+        stream_line_based is set, slices with no raw or djb output are
+        skipped when joining, otherwise they count as an empty line.
+
+        stream_formats is not inherited, see can_stream().
+
+    """
+
+    @classmethod
+    def can_stream(cls, style):
+        # A subclass overriding a format_* method may well produce output
+        # that is not element-wise, so every formatter has to opt in itself
+        return style in cls.__dict__.get("stream_formats", ())
+
     mako_dir = os.path.join(config.get("broker", "srcdir"), "lib", "python2.6",
                             "aquilon", "worker", "formats", "mako")
     # Be careful about using the module_directory and cache!
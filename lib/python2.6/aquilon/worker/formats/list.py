@@ -27,6 +27,9 @@ from aquilon.worker.formats.formatters import ObjectFormatter
 
 
 class ListFormatter(ObjectFormatter):
+    # Not proto: some element formatters ignore the skeleton they are given
+    stream_formats = ("raw", "csv", "djb")
+
     def format_raw(self, result, indent=""):
         if hasattr(self, "template_raw"):
             return ObjectFormatter.format_raw(self, result, indent)
@@ -82,6 +85,60 @@ ObjectFormatter.handlers[Query] = ListFormatter()
 ObjectFormatter.handlers[InstrumentedList] = ListFormatter()
 
 
+class QueryBatches(object):
+    """Iterate over the results of a query in batches.
+
+    The query is executed using yield_per(), and the objects loaded while
+    processing a batch are expunged from the session before the next batch
+    is fetched, so the memory used does not grow with the number of
+    results. Objects already present in the session when the iteration
+    starts are left alone.
+
+    The query must not eagerly load collections, and the session must not
+    have pending changes.
+
+    """
+
+    batch_size = 1000
+
+    def __init__(self, query, batch_size=None):
+        self.query = query
+        if batch_size:
+            self.batch_size = batch_size
+
+    def iter_batches(self, batch_size=None):
+        if not batch_size:
+            batch_size = self.batch_size
+        session = self.query.session
+        keep = set(session.identity_map.keys())
+
+        batch = []
+        for obj in self.query.yield_per(batch_size):
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+                self._expunge(session, keep)
+        if batch:
+            yield batch
+            self._expunge(session, keep)
+
+    def _expunge(self, session, keep):
+        for key in session.identity_map.keys():
+            if key in keep:
+                continue
+            obj = session.identity_map.get(key)
+            if obj is not None:
+                session.expunge(obj)
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for obj in batch:
+                yield obj
+
+ObjectFormatter.handlers[QueryBatches] = ListFormatter()
+
+
 class StringList(list):
     pass
 
@@ -89,6 +146,8 @@ class StringList(list):
 class StringListFormatter(ListFormatter):
     """ Format a list of object as strings, regardless of type """
 
+    stream_formats = ("raw", "csv")
+
     def format_raw(self, objects, indent=""):
         return "\n".join([indent + str(obj) for obj in objects])
 
@@ -177,6 +177,8 @@ class SimpleNetworkList(list):
 class SimpleNetworkListFormatter(ListFormatter):
     protocol = "aqdnetworks_pb2"
     fields = ["Network", "IP", "Netmask", "Sysloc", "Country", "Side", "Network Type", "Discoverable", "Discovered", "Comments"]
+    # The raw output has a header
+    stream_formats = ("csv", "proto")
 
     def format_raw(self, nlist, indent=""):
         details = [indent + "\t".join(self.fields)]
@@ -140,6 +140,7 @@ class SimpleParameterList(list):
 
 class SimpleParameterListFormatter(ListFormatter):
     protocol = "aqdsystems_pb2"
+    stream_formats = ("raw", "csv")
 
     def format_raw(self, hlist, indent=""):
         ret = []
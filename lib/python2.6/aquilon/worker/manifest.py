@@ -0,0 +1,259 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent manifest of content digests for generated files.
+
+The broker rewrites a generated file only if its content has changed.
+Reading back every file just to compare it with the new content is
+expensive when flushing lots of templates, so the digest of the content
+of every file written by write_file() is recorded in a manifest kept in
+the same directory.  As long as the size, mtime and inode of the file
+still match the recorded values, the digest can be trusted without
+reading the file.
+
+The manifest is a journal: every update appends a line, and the file is
+compacted when it grows too large compared to the number of live entries.
+The manifest is only a cache - if it is missing, damaged or stale, the
+file itself is read.
+
+Only directories under the roots registered with track_directory() have
+manifests.  At most MAX_CACHED_MANIFESTS of them are kept in memory; the
+ones not used recently are dropped, and loaded again from disk when
+needed.
+
+"""
+
+import os
+import logging
+from hashlib import sha1
+from threading import Lock
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".aqd_manifest"
+MAX_CACHED_MANIFESTS = 1000
+
+_roots = []
+# dirname -> FileManifest
+_manifests = {}
+# dirname -> value of _use_counter when the manifest was last used
+_last_used = {}
+_use_counter = 0
+_manifests_lock = Lock()
+
+
+def content_digest(content):
+    return sha1(content).hexdigest()
+
+
+class FileManifest(object):
+    """Digests of the files in a single directory."""
+
+    def __init__(self, dirname, logger=LOGGER):
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, MANIFEST_NAME)
+        self.logger = logger
+        self.lock = Lock()
+        # name -> (digest, size, mtime, inode)
+        self.entries = {}
+        self.journal_lines = 0
+        self.load()
+
+    def load(self):
+        try:
+            lines = open(self.filename).readlines()
+        except IOError:
+            return
+        if lines and not lines[-1].endswith("\n"):
+            # The broker probably died while writing it - even if it
+            # parses, the name may be truncated, so don't trust it
+            lines.pop()
+        for line in lines:
+            self.journal_lines += 1
+            fields = line.rstrip("\n").split(" ", 4)
+            try:
+                if fields[0] == "-":
+                    self.entries.pop(fields[1], None)
+                else:
+                    (digest, size, mtime, inode, name) = fields
+                    self.entries[name] = (digest, int(size), float(mtime),
+                                          int(inode))
+            except (IndexError, ValueError):
+                # Garbage - ignore it
+                continue
+
+    def lookup(self, name, st):
+        """Return the recorded digest if it is still valid for stat st."""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry and entry[1:] == (st.st_size, st.st_mtime, st.st_ino):
+            return entry[0]
+        return None
+
+    def update(self, name, digest, st):
+        entry = (digest, st.st_size, st.st_mtime, st.st_ino)
+        with self.lock:
+            if self.entries.get(name) == entry:
+                return
+            self.entries[name] = entry
+            self._append("%s %d %r %d %s\n" % (digest, st.st_size,
+                                               st.st_mtime, st.st_ino, name))
+
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is None:
+                return
+            if self.entries:
+                self._append("- %s\n" % name)
+                return
+            # Don't keep the directory alive just because of the manifest
+            try:
+                os.remove(self.filename)
+                self.journal_lines = 0
+            except OSError, e:
+                self.logger.info("Could not remove manifest %s: %s" %
+                                 (self.filename, e))
+
+    def _append(self, line):
+        # Must be called with the lock held
+        if self.journal_lines > 2 * len(self.entries) + 100:
+            self._compact()
+            return
+        try:
+            with open(self.filename, "a+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != "\n":
+                        # Don't glue the new entry to an incomplete line
+                        line = "\n" + line
+                    # Switching from reading to writing needs a seek
+                    f.seek(0, os.SEEK_END)
+                f.write(line)
+            self.journal_lines += 1
+        except IOError, e:
+            self.logger.info("Could not update manifest %s: %s" %
+                             (self.filename, e))
+
+    def _compact(self):
+        # Must be called with the lock held
+        lines = ["%s %d %r %d %s\n" % (entry[0], entry[1], entry[2], entry[3],
+                                       name)
+                 for name, entry in self.entries.items()]
+        tmpname = "%s.%d" % (self.filename, os.getpid())
+        try:
+            with open(tmpname, "w") as f:
+                f.writelines(lines)
+            os.rename(tmpname, self.filename)
+            self.journal_lines = len(lines)
+        except (IOError, OSError), e:
+            self.logger.info("Could not compact manifest %s: %s" %
+                             (self.filename, e))
+
+
+def track_directory(root):
+    """Maintain manifests for all directories below root."""
+    root = os.path.realpath(root)
+    with _manifests_lock:
+        if root not in _roots:
+            _roots.append(root)
+
+
+def _is_tracked(dirname):
+    path = os.path.realpath(dirname)
+    for root in _roots:
+        if path == root or path.startswith(root + os.sep):
+            return True
+    return False
+
+
+def _expire_manifests():
+    # Must be called with _manifests_lock held.  Drop the least recently
+    # used quarter of the cache, so this does not run on every miss.
+    by_age = sorted(_last_used.keys(), key=_last_used.get)
+    for dirname in by_age[:len(by_age) // 4 + 1]:
+        del _manifests[dirname]
+        del _last_used[dirname]
+
+
+def get_manifest(dirname):
+    """Return the manifest of the directory, if it is tracked."""
+    global _use_counter
+
+    with _manifests_lock:
+        _use_counter += 1
+        manifest = _manifests.get(dirname)
+        if manifest is None:
+            # Untracked directories are not remembered, so writing files
+            # all over the place does not grow the cache
+            if not _roots or not _is_tracked(dirname):
+                return None
+            if len(_manifests) >= MAX_CACHED_MANIFESTS:
+                _expire_manifests()
+            manifest = FileManifest(dirname)
+            _manifests[dirname] = manifest
+        _last_used[dirname] = _use_counter
+        return manifest
+
+
+def forget_directory(dirname):
+    """Drop the cached manifests of a directory tree that got removed."""
+    prefix = os.path.join(dirname, "")
+    with _manifests_lock:
+        for path in _manifests.keys():
+            if path == dirname or path.startswith(prefix):
+                del _manifests[path]
+                del _last_used[path]
+
+
+def lookup_digest(filename, st):
+    """Return the digest of the file if it is known and still valid."""
+    (dirname, basename) = os.path.split(filename)
+    manifest = get_manifest(dirname)
+    if manifest is None:
+        return None
+    return manifest.lookup(basename, st)
+
+
+def record_file(filename, content, st=None):
+    """Record the digest of the content just written into the file.
+
+    Returns the digest, or None if the directory is not tracked.
+
+    """
+    (dirname, basename) = os.path.split(filename)
+    manifest = get_manifest(dirname)
+    if manifest is None:
+        return None
+    if st is None:
+        st = os.stat(filename)
+    digest = content_digest(content)
+    manifest.update(basename, digest, st)
+    return digest
+
+
+def forget_file(filename):
+    (dirname, basename) = os.path.split(filename)
+    manifest = get_manifest(dirname)
+    if manifest is None:
+        return
+    manifest.remove(basename)
+    if not manifest.entries:
+        # Nothing left to remember about this directory
+        with _manifests_lock:
+            if _manifests.get(dirname) is manifest:
+                del _manifests[dirname]
+                del _last_used[dirname]
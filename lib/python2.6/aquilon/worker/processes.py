@@ -30,7 +30,7 @@ import logging
 import gzip
 from subprocess import Popen, PIPE
 from tempfile import mkstemp
-from threading import Thread
+from threading import Thread, Lock
 from cStringIO import StringIO
 import yaml
 
@@ -40,6 +40,7 @@ from aquilon.exceptions_ import (ProcessException, AquilonError, ArgumentError,
                                  InternalError)
 from aquilon.config import Config
 from aquilon.worker.locks import lock_queue, CompileKey
+from aquilon.worker.manifest import record_file, forget_file, forget_directory
 
 LOGGER = logging.getLogger(__name__)
 
@@ -175,6 +176,90 @@ def run_git(args, env=None, path=".",
                        logger=logger, loglevel=loglevel, filterre=filterre)
 
 
+def git_resolve(refs, path=".", logger=LOGGER):
+    """Return the commit IDs the given refs point to.
+
+    Raises ProcessException if any of the refs cannot be resolved.
+
+    """
+    out = run_git(["rev-parse"] + ["%s^{commit}" % ref for ref in refs],
+                  path=path, logger=logger)
+    return out.split()
+
+
+class GitAncestryCache(object):
+    """Memoize the ancestry of commits.
+
+    Whether a commit is an ancestor of another one never changes, so the
+    results can be kept as long as the broker runs. The keys are commit IDs
+    rather than branch names, so moving a branch does not need any
+    invalidation.
+
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.lock = Lock()
+        # (commit, head) -> bool
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, commit, head):
+        with self.lock:
+            result = self.results.get((commit, head))
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def store(self, commit, head, result):
+        with self.lock:
+            if len(self.results) >= self.max_size:
+                self.results.clear()
+            self.results[(commit, head)] = result
+
+
+git_ancestry_cache = GitAncestryCache()
+
+
+def git_is_ancestor(commit, ref="HEAD", path=".", logger=LOGGER):
+    """Check if commit is reachable from ref in the repository at path.
+
+    This replaces filtering the output of "git rev-list <ref>", which has
+    to walk the whole history. Instead, commit is an ancestor of ref if it
+    is the merge base of the two. A commit unknown to the repository is not
+    an ancestor of anything. Other errors raise ProcessException.
+
+    """
+    try:
+        (commit, head) = git_resolve([commit, ref], path=path, logger=logger)
+    except ProcessException, e:
+        # Either the commit or the ref does not exist
+        if e.code != 128:
+            raise
+        return False
+
+    if commit == head:
+        return True
+    result = git_ancestry_cache.get(commit, head)
+    if result is not None:
+        return result
+
+    try:
+        base = run_git(["merge-base", commit, head], path=path,
+                       logger=logger).strip()
+    except ProcessException, e:
+        # merge-base exits with 1 if the commits have nothing in common
+        if e.code != 1:
+            raise
+        base = None
+    result = base == commit
+    git_ancestry_cache.store(commit, head, result)
+    return result
+
+
 def remove_dir(dir, logger=LOGGER):
     """Remove a directory.  Could have been implemented as a call to rm -rf."""
     for root, dirs, files in os.walk(dir, topdown=False):
@@ -200,6 +285,7 @@ def remove_dir(dir, logger=LOGGER):
         os.rmdir(dir)
     except OSError, e:
         logger.info("Failed to remove '%s': %s" % (dir, e))
+    forget_directory(dir)
     return
 
 
@@ -227,7 +313,11 @@ def write_file(filename, content, mode=None, logger=LOGGER, compress=None):
     memory before writing.  The only compression currently supported
     is gzip.
 
+    If the file lives in a directory tracked by a manifest, the digest
+    of the uncompressed content is recorded there.
+
     """
+    digest_content = content
     if compress == 'gzip':
         config = Config()
         buffer = StringIO()
@@ -254,6 +344,7 @@ def write_file(filename, content, mode=None, logger=LOGGER, compress=None):
     finally:
         if os.path.exists(fpath):
             os.remove(fpath)
+    record_file(filename, digest_content)
 
 
 def read_file(path, filename, logger=LOGGER):
@@ -271,6 +362,8 @@ def remove_file(filename, logger=LOGGER):
     except OSError, e:
         if e.errno != errno.ENOENT:
             logger.info("Could not remove file '%s': %s" % (filename, e))
+            return
+    forget_file(filename)
 
 
 def cache_version(config, logger=LOGGER):
@@ -301,13 +394,16 @@ def cache_version(config, logger=LOGGER):
         config.set("broker", "version", "Unknown")
 
 
-def sync_domain(dbdomain, logger=LOGGER, locked=False):
+def sync_domain(dbdomain, logger=LOGGER, locked=False, branch_only=False):
     """Update templates on disk to match contents of branch in template-king.
 
     If this domain is tracking another, first update the branch in
     template-king with the latest from the tracking branch.  Also save
     the current (previous) commit as a potential rollback point.
 
+    If branch_only is set, only the branch of the domain is fetched, instead
+    of all the branches of template-king.
+
     """
     config = Config()
     session = object_session(dbdomain)
@@ -320,9 +416,16 @@ def sync_domain(dbdomain, logger=LOGGER, locked=False):
         run_command(["git", "push", ".",
                      "%s:%s" % (dbdomain.tracked_branch.name, dbdomain.name)],
                     path=kingdir, env=git_env, logger=logger)
-    run_command(["git", "fetch", "--prune"], path=domaindir, env=git_env, logger=logger)
+    if branch_only:
+        refspec = "+refs/heads/%s:refs/remotes/origin/%s" % (dbdomain.name,
+                                                            dbdomain.name)
+        run_command(["git", "fetch", "origin", refspec], path=domaindir,
+                    env=git_env, logger=logger)
+    else:
+        run_command(["git", "fetch", "--prune"], path=domaindir, env=git_env,
+                    logger=logger)
     if dbdomain.tracked_branch:
-        out = run_command(["git", "rev-list", "-n", "1", "HEAD"],
+        out = run_command(["git", "rev-parse", "HEAD"],
                           path=domaindir, env=git_env, logger=logger)
         rollback_commit = out.strip()
     try:
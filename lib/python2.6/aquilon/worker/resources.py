@@ -219,7 +219,18 @@ class ResponsePage(resource.Resource):
         return self.formatter.format(style, result, request)
 
     def finishRender(self, result, request):
-        if result:
+        stream = getattr(request, "aq_stream", None)
+        if stream:
+            # The body has been sent already by the command thread
+            if result is not stream:
+                # Something went wrong after part of the response was sent,
+                # so it is too late to report the error. Drop the
+                # connection without terminating the chunked response, so
+                # the client notices that the output is incomplete.
+                log.msg("Aborting response after %d bytes: %s" %
+                        (stream.bytes_sent, result))
+                request.transport.loseConnection()
+        elif result:
             request.setHeader('content-length', str(len(result)))
             # TODO: When disconnected, why doesn't write() fail?
             request.write(result)
@@ -228,7 +239,7 @@ class ResponsePage(resource.Resource):
         # TODO: As documented in the twisted http module, should
         # instead register a notifyFinish callback to track clients
         # disconnecting.
-        if not request._disconnected:
+        if not request._disconnected and (not stream or result is stream):
             request.finish()
         if hasattr(request, 'aq_audit_id'):
             if request._disconnected:
@@ -17,20 +17,238 @@
 """Provides various utilities around services."""
 
 
-from itertools import chain
+from itertools import chain, product
 from random import choice
+from collections import defaultdict
 
-from sqlalchemy.orm import undefer
+from sqlalchemy.orm import undefer, contains_eager
 from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql import or_
 
 from aquilon.exceptions_ import ArgumentError, InternalError
 from aquilon.aqdb.model import (Host, Cluster, Service, ServiceInstance,
-                                MetaCluster, EsxCluster, Archetype, Personality)
+                                MetaCluster, EsxCluster, Archetype, Personality,
+                                ServiceMap, PersonalityServiceMap)
 from aquilon.worker.templates import (Plenary, PlenaryCollection,
                                       PlenaryServiceInstanceServer)
 
+# Oracle does not allow more than 1000 elements in an IN-list
+MAX_IN_LIST = 1000
+
+
+def _in_list_chunks(ids):
+    return [ids[start:start + MAX_IN_LIST]
+            for start in range(0, len(ids), MAX_IN_LIST)]
+
+
+class ClientCountCache(object):
+    """Client counts of service instances, shared by several choosers.
+
+    Looking up the client count of service instances one by one is
+    expensive, and needs to be done for every candidate instance of every
+    required service of every host being reconfigured. This class loads the
+    counts of all the candidate instances at once, and keeps them up to date
+    in memory as the choosers sharing it bind and unbind clients.
+
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.counts = {}
+        self.aligned = {}
+
+    def load(self, instances):
+        """Fetch the counts of all the instances not known yet."""
+        missing = [si for si in instances if si not in self.counts]
+        if not missing:
+            return
+        services = set([si.service for si in missing])
+        new_services = [dbservice for dbservice in services
+                        if dbservice.id not in self.aligned]
+        if new_services:
+            aligned = ServiceInstance.get_aligned_personalities(self.session,
+                                                                new_services)
+            for dbservice in new_services:
+                self.aligned[dbservice.id] = aligned.get(dbservice.id, None)
+        aligned = dict((dbservice.id, self.aligned[dbservice.id])
+                       for dbservice in services
+                       if self.aligned[dbservice.id])
+        self.counts.update(ServiceInstance.get_client_counts(self.session,
+                                                             missing,
+                                                             aligned))
+
+    def get(self, instance):
+        if instance not in self.counts:
+            self.load([instance])
+        return self.counts[instance]
+
+    def host_footprint(self, instance, dbhost):
+        """Return how much binding the host changes the client count."""
+        aligned = self.aligned.get(instance.service.id, None)
+        if aligned and dbhost.cluster and \
+           dbhost.cluster.personality_id in aligned:
+            # The cluster is counted instead of its members
+            return 0
+        return 1
+
+    def adjust(self, instance, delta):
+        if instance in self.counts:
+            self.counts[instance] += delta
+
+
+class ServiceMapResolver(object):
+    """Service map lookups for a batch of objects.
+
+    ServiceInstance.get_mapped_instance_cache() queries the maps of a single
+    personality/location/network combination. When binding lots of objects,
+    this class loads the maps for all of them up front using prefetch(), and
+    answers lookup() from memory. Objects sharing the same personality and
+    location share the result as well.
+
+    lookup() returns the same results as get_mapped_instance_cache(), and
+    loads any maps not covered by prefetch() on demand.
+
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # (personality ID or None, service ID, "location" or "network",
+        #  location or network ID) -> list of instances
+        self.maps = defaultdict(list)
+        # Keys of self.maps which have been loaded from the DB
+        self.loaded = set()
+        # Memoized results of lookup()
+        self.results = {}
+
+    def _location_ids(self, dblocation):
+        location_ids = [dblocation.id]
+        location_ids.extend(reversed(dblocation.ancestor_ids()))
+        return location_ids
+
+    def _keys(self, dbpersonality, location_ids, dbnetwork, service_ids):
+        personality_ids = [None]
+        if dbpersonality:
+            personality_ids.append(dbpersonality.id)
+        for personality_id in personality_ids:
+            for service_id in service_ids:
+                for location_id in location_ids:
+                    yield (personality_id, service_id, "location", location_id)
+                if dbnetwork:
+                    yield (personality_id, service_id, "network", dbnetwork.id)
+
+    def prefetch(self, targets, dbservices):
+        """Load the maps for several objects at once.
+
+        targets is a list of (personality, location, network) tuples.
+
+        """
+        service_ids = set([dbservice.id for dbservice in dbservices])
+        location_ids = set()
+        network_ids = set()
+        personality_ids = set()
+        wanted = set()
+        for dbpersonality, dblocation, dbnetwork in targets:
+            ids = self._location_ids(dblocation)
+            for key in self._keys(dbpersonality, ids, dbnetwork, service_ids):
+                if key not in self.loaded:
+                    wanted.add(key)
+                    # Only query for the missing pieces
+                    if key[2] == "location":
+                        location_ids.add(key[3])
+                    else:
+                        network_ids.add(key[3])
+                    if key[0] is not None:
+                        personality_ids.add(key[0])
+        if not wanted:
+            return
+
+        service_ids = sorted(set([key[1] for key in wanted]))
+        personality_ids = sorted(personality_ids)
+        # A map has either a location or a network, so they can be queried
+        # separately
+        target_chunks = [(column, chunk) for column, ids in
+                         (("location_id", sorted(location_ids)),
+                          ("network_id", sorted(network_ids)))
+                         for chunk in _in_list_chunks(ids)]
+        for map_type in (ServiceMap, PersonalityServiceMap):
+            if map_type == PersonalityServiceMap:
+                if not personality_ids:
+                    continue
+                personality_chunks = _in_list_chunks(personality_ids)
+            else:
+                personality_chunks = [None]
+            chunks = product(_in_list_chunks(service_ids), personality_chunks,
+                             target_chunks)
+            for service_chunk, personality_chunk, target in chunks:
+                (column, target_chunk) = target
+                q = self.session.query(map_type)
+                q = q.join('service_instance')
+                q = q.filter(ServiceInstance.service_id.in_(service_chunk))
+                q = q.options(contains_eager('service_instance'),
+                              undefer('service_instance._client_count'))
+                if personality_chunk is not None:
+                    q = q.filter(map_type.personality_id.in_(
+                        personality_chunk))
+                q = q.filter(getattr(map_type, column).in_(target_chunk))
+                self._add_maps(map_type, q, wanted)
+        self.loaded.update(wanted)
+
+    def _add_maps(self, map_type, query, wanted):
+        for service_map in query:
+            if map_type == PersonalityServiceMap:
+                personality_id = service_map.personality_id
+            else:
+                personality_id = None
+            service_id = service_map.service_instance.service_id
+            if service_map.location_id:
+                key = (personality_id, service_id, "location",
+                       service_map.location_id)
+            else:
+                key = (personality_id, service_id, "network",
+                       service_map.network_id)
+            if key in wanted:
+                self.maps[key].append(service_map.service_instance)
+
+    def lookup(self, dbpersonality, dblocation, dbservices, dbnetwork=None):
+        """Returns dict of requested services to closest mapped instances."""
+        memo_key = (dbpersonality and dbpersonality.id, dblocation.id,
+                    dbnetwork and dbnetwork.id,
+                    frozenset([dbservice.id for dbservice in dbservices]))
+        if memo_key not in self.results:
+            self.prefetch([(dbpersonality, dblocation, dbnetwork)],
+                          dbservices)
+            self.results[memo_key] = self._resolve(dbpersonality, dblocation,
+                                                   dbservices, dbnetwork)
+        # Callers modify the lists, so return copies
+        return dict((dbservice, instances[:]) for dbservice, instances in
+                    self.results[memo_key].items())
+
+    def _resolve(self, dbpersonality, dblocation, dbservices, dbnetwork):
+        # Same logic as ServiceInstance.get_mapped_instance_cache()
+        location_ids = self._location_ids(dblocation)
+        cache = {}
+        personality_ids = []
+        if dbpersonality:
+            personality_ids.append(dbpersonality.id)
+        personality_ids.append(None)
+        for personality_id in personality_ids:
+            for dbservice in dbservices:
+                if cache.get(dbservice):
+                    continue
+                if dbnetwork:
+                    key = (personality_id, dbservice.id, "network",
+                           dbnetwork.id)
+                    if self.maps.get(key):
+                        cache[dbservice] = self.maps[key]
+                        continue
+                for lid in location_ids:
+                    key = (personality_id, dbservice.id, "location", lid)
+                    if self.maps.get(key):
+                        cache[dbservice] = self.maps[key]
+                        break
+        return cache
+
 
 class Chooser(object):
     """Helper for choosing services for an object."""
@@ -54,12 +272,18 @@ class Chooser(object):
                        "required_services", "original_service_instances",
                        "apply_changes"]
 
-    def __init__(self, dbobj, logger, required_only=False):
+    def __init__(self, dbobj, logger, required_only=False,
+                 client_counts=None, service_maps=None):
         """Initialize the chooser.
 
         To clear out bindings that are not required, pass in
         required_only=True.
 
+        Choosers running in the same transaction may share a ClientCountCache
+        passed in as client_counts, to avoid looking up the client counts of
+        the same service instances again and again. Similarly, they may share
+        a ServiceMapResolver passed in as service_maps.
+
         Several staging areas and caches are set up within this object.
         The general flow is that potential service instance choices
         are kept in staging_services (dictionary of service to list of
@@ -87,6 +311,11 @@ class Chooser(object):
         # Cache of the service maps
         self.mapped_services = {}
 
+        if client_counts is None:
+            client_counts = ClientCountCache(self.session)
+        self.client_counts = client_counts
+        self.service_map_resolver = service_maps
+
         # Stores interim service instance lists
         self.staging_services = {}
 
@@ -196,6 +425,10 @@ class Chooser(object):
         self.check_errors()
 
     def cache_service_maps(self, dbservices):
+        if self.service_map_resolver:
+            self.service_maps = self.service_map_resolver.lookup(
+                self.personality, self.location, dbservices, self.network)
+            return
         self.service_maps = ServiceInstance.get_mapped_instance_cache(
             self.personality, self.location, dbservices, self.network)
 
@@ -249,9 +482,10 @@ class Chooser(object):
 
         """
         maxed_out_instances = set()
+        self.client_counts.load(self.staging_services[dbservice])
         for instance in self.staging_services[dbservice][:]:
             max_clients = instance.enforced_max_clients
-            current_clients = instance.client_count
+            current_clients = self.client_counts.get(instance)
             if self.instance_full(instance, max_clients, current_clients):
                 self.staging_services[dbservice].remove(instance)
                 maxed_out_instances.add(instance)
@@ -366,8 +600,9 @@ class Chooser(object):
         """Choose a service instance based on load."""
         least_clients = None
         least_loaded = []
+        self.client_counts.load(self.staging_services[dbservice])
         for instance in self.staging_services[dbservice]:
-            client_count = instance.client_count
+            client_count = self.client_counts.get(instance)
             if not least_loaded or client_count < least_clients:
                 least_clients = client_count
                 least_loaded = [instance]
@@ -575,12 +810,18 @@ class HostChooser(Chooser):
                                     self.description,
                                     instance.service.name, instance.name)
             self.dbhost.services_used.append(instance)
+            self.client_counts.adjust(instance,
+                                      self.client_counts.host_footprint(
+                                          instance, self.dbhost))
         for instance in self.instances_unbound:
             self.logger.client_info("%s removing binding for "
                                     "service %s instance %s",
                                     self.description,
                                     instance.service.name, instance.name)
             self.dbhost.services_used.remove(instance)
+            self.client_counts.adjust(instance,
+                                      -self.client_counts.host_footprint(
+                                          instance, self.dbhost))
 
     def prestash_primary(self):
         plenary_host = Plenary.get_plenary(self.dbhost, logger=self.logger)
@@ -652,6 +893,8 @@ class ClusterChooser(Chooser):
                                     instance.service.name, instance.name)
             if instance in self.dbcluster.service_bindings:
                 self.dbcluster.service_bindings.remove(instance)
+                self.client_counts.adjust(instance,
+                                          -self.get_footprint(instance))
             else:
                 self.error("Internal Error: Could not unbind "
                            "service %s instance %s" %
@@ -662,10 +905,12 @@ class ClusterChooser(Chooser):
                                     self.description,
                                     instance.service.name, instance.name)
             self.dbcluster.service_bindings.append(instance)
+            self.client_counts.adjust(instance, self.get_footprint(instance))
             self.flush_changes()
             for h in self.dbcluster.hosts:
                 host_chooser = Chooser(h, logger=self.logger,
-                                       required_only=False)
+                                       required_only=False,
+                                       client_counts=self.client_counts)
                 host_chooser.set_single(instance.service, instance, force=True)
                 host_chooser.flush_changes()
                 # Note, host plenary will be written later.
@@ -0,0 +1,97 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Send responses to the client while they are being formatted."""
+
+
+from threading import Event
+
+from twisted.internet import reactor
+
+# Collect formatted chunks up to this size before handing them to the
+# reactor
+BUFFER_SIZE = 65536
+
+
+class ResponseStream(object):
+    """Write the response of a request from a worker thread.
+
+    The response is written without a Content-Length header, so Twisted
+    uses chunked transfer encoding.  The stream registers itself as a
+    streaming producer of the request, so formatting is paused while the
+    client is not keeping up with the data.
+
+    The object is also returned to ResponsePage.finishRender() as the result
+    of the command, to indicate that the response body has been sent
+    already.
+
+    """
+
+    def __init__(self, request, buffer_size=BUFFER_SIZE):
+        self.request = request
+        self.buffer_size = buffer_size
+        self.resumed = Event()
+        self.resumed.set()
+        self.stopped = False
+        self.bytes_sent = 0
+
+    # The IPushProducer interface, called by the reactor
+    def pauseProducing(self):
+        self.resumed.clear()
+
+    def resumeProducing(self):
+        self.resumed.set()
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumed.set()
+
+    def write(self, chunks):
+        """Send the chunks to the client.
+
+        Must be called from a worker thread, not from the reactor. Returns
+        early if the client goes away.
+
+        """
+        # Once this is set, errors cannot be reported to the client anymore
+        self.request.aq_stream = self
+        reactor.callFromThread(self.request.registerProducer, self, True)
+        try:
+            buf = []
+            size = 0
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= self.buffer_size:
+                    if not self._flush(buf):
+                        return
+                    buf = []
+                    size = 0
+            if buf:
+                self._flush(buf)
+        finally:
+            reactor.callFromThread(self.request.unregisterProducer)
+
+    def _flush(self, buf):
+        self.resumed.wait()
+        if self.stopped or self.request._disconnected:
+            return False
+        data = "".join(buf)
+        self.bytes_sent += len(data)
+        reactor.callFromThread(self.request.write, data)
+        return True
@@ -18,12 +18,15 @@
 
 
 import os
+import errno
 import logging
 
 from aquilon.exceptions_ import InternalError, IncompleteError
 from aquilon.config import Config
 from aquilon.worker.locks import lock_queue, CompileKey
 from aquilon.worker.processes import write_file, read_file, remove_file
+from aquilon.worker.manifest import (track_directory, content_digest,
+                                     lookup_digest, record_file)
 from aquilon.worker.templates.panutils import pan_assign, pan_variable
 from mako.lookup import TemplateLookup
 from aquilon.worker.formats.formatters import ObjectFormatter
@@ -33,6 +36,11 @@ LOGGER = logging.getLogger(__name__)
 _config = Config()
 TEMPLATE_EXTENSION = _config.get("panc", "template_extension")
 
+# Keep track of the content of the plenaries, so unchanged templates can be
+# detected without reading them back
+track_directory(_config.get("broker", "plenarydir"))
+track_directory(_config.get("broker", "builddir"))
+
 
 class Plenary(object):
 
@@ -71,7 +79,8 @@ class Plenary(object):
 
         self.new_content = None
         # The following attributes are for stash/restore_stash
-        self.old_content = None
+        self._old_content = None
+        self.old_digest = None
         self.old_mtime = None
         self.stashed = False
         self.removed = False
@@ -134,7 +143,7 @@ class Plenary(object):
         self.stash()
         if not self.new_content:
             self.new_content = self._generate_content()
-        return self.old_content != self.new_content
+        return self.old_digest != content_digest(self.new_content)
 
     def get_write_key(self):
         if self.will_change():
@@ -194,10 +203,7 @@ class Plenary(object):
 
         """
 
-        if self.template_type == "object" and \
-           hasattr(self.dbobj, "personality") and \
-           self.dbobj.personality and \
-           not self.dbobj.personality.archetype.is_compileable:
+        if self._skip_write():
             return 0
 
         if content is None:
@@ -206,7 +212,8 @@ class Plenary(object):
             content = self.new_content
 
         self.stash()
-        if self.old_content == content and \
+        digest = content_digest(content)
+        if self.old_digest == digest and \
            not self.removed and not self.changed:
             # optimise out the write (leaving the mtime good for ant)
             # if nothing is actually changed
@@ -218,10 +225,17 @@ class Plenary(object):
                 key = self.get_write_key()
                 lock_queue.acquire(key)
             if not os.path.exists(self.plenary_directory):
-                os.makedirs(self.plenary_directory)
+                try:
+                    os.makedirs(self.plenary_directory)
+                except OSError, e:
+                    # Someone else (e.g. a parallel flush) may have been
+                    # faster
+                    if e.errno != errno.EEXIST:
+                        raise
+            self.save_old_content()
             write_file(self.plenary_file, content, logger=self.logger)
             self.removed = False
-            if self.old_content != content:
+            if self.old_digest != digest:
                 self.changed = True
         except Exception, e:
             if not locked:
@@ -233,6 +247,26 @@ class Plenary(object):
 
         return 1
 
+    def _skip_write(self):
+        """Object templates of non-compileable archetypes are not written."""
+        return self.template_type == "object" and \
+            hasattr(self.dbobj, "personality") and \
+            self.dbobj.personality and \
+            not self.dbobj.personality.archetype.is_compileable
+
+    def prepare_write(self):
+        """Generate the content of the template without writing it out.
+
+        Returns the list of plenaries that should be written afterwards by
+        calling write(), which will not need to touch the database any more.
+
+        """
+        if self._skip_write():
+            return []
+        if not self.new_content:
+            self.new_content = self._generate_content()
+        return [self]
+
     def read(self):
         return read_file("", self.plenary_file, logger=self.logger)
 
@@ -247,6 +281,7 @@ class Plenary(object):
                 key = self.get_remove_key()
                 lock_queue.acquire(key)
             self.stash()
+            self.save_old_content()
             remove_file(self.plenary_file, logger=self.logger)
             try:
                 os.removedirs(self.plenary_directory)
@@ -298,6 +333,7 @@ class Plenary(object):
                                        "profiles", self.plenary_core)
                 mainfile = os.path.join(maindir, self.plenary_template +
                                         TEMPLATE_EXTENSION)
+                self.save_old_content()
                 remove_file(mainfile, logger=self.logger)
                 try:
                     os.removedirs(maindir)
@@ -324,13 +360,41 @@ class Plenary(object):
         """
         if self.stashed:
             return
+        self._old_content = None
+        self.old_digest = None
         try:
-            self.old_content = self.read()
-            self.old_mtime = os.stat(self.plenary_file).st_atime
-        except IOError:
-            self.old_content = None
+            st = os.stat(self.plenary_file)
+            self.old_mtime = st.st_atime
+            # The content itself is only loaded if the file is going to be
+            # modified, see save_old_content()
+            self.old_digest = lookup_digest(self.plenary_file, st)
+            if self.old_digest is None:
+                self._old_content = self.read()
+                self.old_digest = record_file(self.plenary_file,
+                                              self._old_content, st) or \
+                        content_digest(self._old_content)
+        except (IOError, OSError):
+            self._old_content = None
+            self.old_digest = None
         self.stashed = True
 
+    def save_old_content(self):
+        """Load the stashed content before the file gets modified.
+
+        This should be called before overwriting or removing the file, so
+        restore_stash() has something to restore.
+
+        """
+        if self.stashed and self._old_content is None and \
+           self.old_digest is not None:
+            self._old_content = self.read()
+
+    @property
+    def old_content(self):
+        """The content of the template at the time of stash()."""
+        self.save_old_content()
+        return self._old_content
+
     def restore_stash(self):
         """Restore previous state of plenary.
 
@@ -344,7 +408,7 @@ class Plenary(object):
         # Should this optimization be in use?
         # if not self.changed and not self.removed:
         #    return
-        if (self.old_content is None):
+        if self.old_digest is None:
             self.remove(locked=True)
         else:
             self.write(locked=True, content=self.old_content)
@@ -478,6 +542,16 @@ class PlenaryCollection(object):
                 lock_queue.release(key)
         return total
 
+    def prepare_write(self):
+        plenaries = []
+        for plen in self.plenaries:
+            # Same as in write() above
+            try:
+                plenaries.extend(plen.prepare_write())
+            except IncompleteError, err:
+                self.logger.client_info("Warning: %s" % err)
+        return plenaries
+
     def remove(self, locked=False):
         self.stash()
         key = None
@@ -20,11 +20,11 @@
 import os
 from os import environ as os_environ
 import logging
-import re
 
 from aquilon.config import Config
 from aquilon.exceptions_ import ArgumentError, ProcessException, InternalError
-from aquilon.worker.processes import run_command, run_git
+from aquilon.worker.processes import git_resolve, git_is_ancestor
+from aquilon.worker.compiler import get_backend
 from aquilon.worker.templates.index import build_index
 from aquilon.worker.locks import lock_queue, CompileKey
 from aquilon.aqdb.model import (Host, Cluster, Fqdn, DnsRecord, HardwareEntity,
@@ -155,44 +155,40 @@ class TemplateDomain(object):
         if config.has_option("broker", "ant_options"):
             panc_env["ANT_OPTS"] = config.get("broker", "ant_options")
 
-        args = [config.get("broker", "ant")]
-        args.append("--noconfig")
-        args.append("-f")
-        args.append("%s/build.xml" %
-                    config.get("broker", "compiletooldir"))
-        args.append("-Dbasedir=%s" % config.get("broker", "quattordir"))
-        args.append("-Dpanc.jar=%s" % self.domain.compiler)
-        args.append("-Dpanc.formatter=%s" %
-                    config.get("panc", "formatter"))
-        args.append("-Dpanc.template_extension=%s" %
-                    config.get("panc", "template_extension"))
-        args.append("-Ddomain=%s" % self.domain.name)
-        args.append("-Ddistributed.profiles=%s" % outputdir)
-        args.append("-Dpanc.batch.size=%s" %
-                    config.get("panc", "batch_size"))
-        args.append("-Dant-contrib.jar=%s" %
-                    config.get("broker", "ant_contrib_jar"))
-        args.append("-Dgzip.output=%s" %
-                    config.get("panc", "gzip_output"))
+        properties = []
+        properties.append(("basedir", config.get("broker", "quattordir")))
+        properties.append(("panc.jar", self.domain.compiler))
+        properties.append(("panc.formatter",
+                           config.get("panc", "formatter")))
+        properties.append(("panc.template_extension",
+                           config.get("panc", "template_extension")))
+        properties.append(("domain", self.domain.name))
+        properties.append(("distributed.profiles", outputdir))
+        properties.append(("panc.batch.size",
+                           config.get("panc", "batch_size")))
+        properties.append(("ant-contrib.jar",
+                           config.get("broker", "ant_contrib_jar")))
+        properties.append(("gzip.output",
+                           config.get("panc", "gzip_output")))
         if self.domain.branch_type == 'sandbox':
-            args.append("-Ddomain.templates=%s" % sandboxdir)
+            properties.append(("domain.templates", sandboxdir))
         if only:
             # Use -Dforce.build=true?
             # TODO: pass the list in a temp file
-            args.append("-Dobject.profile=%s" % " ".join(only))
-            args.append("compile.object.profile")
+            properties.append(("object.profile", " ".join(only)))
+            target = "compile.object.profile"
         else:
             # Technically this is the default, but being explicit
             # doesn't hurt.
-            args.append("compile.domain.profiles")
+            target = "compile.domain.profiles"
         if panc_debug_include is not None:
-            args.append("-Dpanc.debug.include=%s" % panc_debug_include)
+            properties.append(("panc.debug.include", panc_debug_include))
         if panc_debug_exclude is not None:
-            args.append("-Dpanc.debug.exclude=%s" % panc_debug_exclude)
+            properties.append(("panc.debug.exclude", panc_debug_exclude))
         if cleandeps:
             # Cannot send a false value - the test in build.xml is for
             # whether or not the property is defined at all.
-            args.append("-Dclean.dep.files=%s" % cleandeps)
+            properties.append(("clean.dep.files", cleandeps))
 
         out = ''
         try:
@@ -207,9 +203,12 @@ class TemplateDomain(object):
                 lock_queue.acquire(key)
             self.logger.info("starting compile")
             try:
-                out = run_command(args, env=panc_env, logger=self.logger,
-                                  path=config.get("broker", "quattordir"),
-                                  loglevel=CLIENT_INFO)
+                backend = get_backend(config)
+                out = backend.compile(self.domain.compiler, target,
+                                      properties, env=panc_env,
+                                      logger=self.logger,
+                                      path=config.get("broker", "quattordir"),
+                                      loglevel=CLIENT_INFO)
             except ProcessException, e:
                 raise ArgumentError("\n%s%s" % (e.out, e.err))
         finally:
@@ -217,8 +216,9 @@ class TemplateDomain(object):
                 lock_queue.release(key)
 
         # No need for a lock here - there is only a single file written
-        # and it is swapped into place atomically.
-        build_index(config, session, outputdir, logger=self.logger)
+        # and it is swapped into place atomically.  If only some profiles
+        # were compiled, then only those need to be checked.
+        build_index(config, session, outputdir, logger=self.logger, only=only)
         return out
 
     def sandbox_has_latest(self, config, sandboxdir):
@@ -226,19 +226,18 @@ class TemplateDomain(object):
         prod_domain = config.get('broker', 'default_domain_start')
         proddir = os.path.join(domainsdir, prod_domain)
         try:
-            prod_commit = run_git(['rev-list', '-n', '1', 'HEAD'],
-                                  path=proddir, logger=self.logger).strip()
-        except ProcessException:
+            prod_commit = git_resolve(['HEAD'], path=proddir,
+                                      logger=self.logger)[0]
+        except (ProcessException, IndexError):
             prod_commit = ''
         if not prod_commit:
             raise InternalError("Error finding top commit for %s" %
                                 prod_domain)
-        filterre = re.compile('^' + prod_commit + '$')
         try:
-            found_latest = run_git(['rev-list', 'HEAD'], path=sandboxdir,
-                                   logger=self.logger, filterre=filterre)
+            found_latest = git_is_ancestor(prod_commit, path=sandboxdir,
+                                           logger=self.logger)
         except ProcessException:
             self.logger.warn("Failed to run git command in sandbox %s." %
                              sandboxdir)
-            found_latest = ''
-        return bool(found_latest)
+            found_latest = False
+        return found_latest
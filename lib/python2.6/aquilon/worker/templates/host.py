@@ -26,6 +26,7 @@ from aquilon.exceptions_ import IncompleteError, InternalError
 from aquilon.aqdb.model import (Host, VlanInterface, BondingInterface,
                                 BridgeInterface)
 from aquilon.worker.locks import CompileKey
+from aquilon.worker.manifest import content_digest
 from aquilon.worker.templates.base import Plenary, PlenaryCollection
 from aquilon.worker.templates.cluster import PlenaryClusterClient
 from aquilon.worker.templates.panutils import (StructureTemplate, PanValue,
@@ -112,6 +113,15 @@ class PlenaryHost(PlenaryCollection):
             total += plenary.write(locked=locked, content=content)
         return total
 
+    def prepare_write(self):
+        if not self.dbobj.archetype.is_compileable:
+            return []
+
+        plenaries = []
+        for plenary in self.plenaries:
+            plenaries.extend(plenary.prepare_write())
+        return plenaries
+
 
 Plenary.handlers[Host] = PlenaryHost
 
@@ -325,8 +335,8 @@ class PlenaryToplevelHost(Plenary):
             except IncompleteError:
                 # Attempting to have IncompleteError thrown later by
                 # not caching the return
-                return self.old_content is None
-        return self.old_content != self.new_content
+                return self.old_digest is None
+        return self.old_digest != content_digest(self.new_content)
 
     def get_key(self):
         # Going with self.name instead of self.plenary_template_name seems like
@@ -21,6 +21,8 @@ import time
 import socket
 import logging
 import gzip
+from collections import deque
+from threading import Lock, Condition, Thread
 
 import xml.etree.ElementTree as ET
 
@@ -41,8 +43,131 @@ except:  # pragma: no cover
     CDPPORT = 7777
 
 
+class ProfileIndex(object):
+    """In-memory copy of a profile index.
+
+    The index file on disk is the persistent form of the mapping from
+    profile names to mtimes.  It is parsed only once, and kept in memory as
+    long as nobody else touches the file.
+
+    """
+
+    def __init__(self, index_path, gzip_index):
+        self.index_path = index_path
+        self.gzip_index = gzip_index
+        self.lock = Lock()
+        self.mtimes = None
+        # Identity of the index file when it was last read or written
+        self.stamp = None
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def load(self, logger=LOGGER):
+        """Return the mapping of profiles to mtimes.
+
+        Must be called with the lock held.
+
+        """
+        stamp = self._file_stamp()
+        if self.mtimes is not None and stamp == self.stamp:
+            return self.mtimes
+
+        self.mtimes = {}
+        self.stamp = stamp
+        if stamp is None:
+            return self.mtimes
+
+        source = None
+        try:
+            if self.gzip_index:
+                source = gzip.open(self.index_path)
+            else:
+                source = open(self.index_path)
+            tree = ET.parse(source)
+            for profile in tree.getiterator("profile"):
+                if not profile.text or "mtime" not in profile.attrib:
+                    continue
+                mtime = int(profile.attrib["mtime"])
+
+                obj = profile.text.strip()
+                if not obj:
+                    continue
+
+                for ext in [".xml", ".xml.gz"]:
+                    if obj.endswith(ext):
+                        obj = obj[:-len(ext)]
+                        break
+
+                self.mtimes[obj] = mtime
+        except Exception, e:  # pragma: no cover
+            logger.info("Error processing %s, continuing: %s" %
+                        (self.index_path, e))
+        finally:
+            if source:
+                source.close()
+        return self.mtimes
+
+    def save(self, mtimes, advertise_suffix, logger=LOGGER):
+        """Write out the index.
+
+        Must be called with the lock held.
+
+        """
+        def render():
+            yield "<?xml version='1.0' encoding='utf-8'?>"
+            yield "<profiles>"
+            for obj in sorted(mtimes.keys()):
+                yield "<profile mtime='%d'>%s%s</profile>" % (mtimes[obj], obj,
+                                                             advertise_suffix)
+            yield "</profiles>"
+
+        compress = None
+        if self.gzip_index:
+            compress = 'gzip'
+        write_file(self.index_path, "\n".join(render()), logger=logger,
+                   compress=compress)
+        self.mtimes = mtimes
+        self.stamp = self._file_stamp()
+
+
+_profile_indexes = {}
+_profile_indexes_lock = Lock()
+
+
+def get_profile_index(index_path, gzip_index):
+    with _profile_indexes_lock:
+        if index_path not in _profile_indexes:
+            _profile_indexes[index_path] = ProfileIndex(index_path, gzip_index)
+        return _profile_indexes[index_path]
+
+
+def _profile_names(config, only):
+    """Return the names the profiles of the given objects may have.
+
+    Host profiles may be written both to the top level, and to a directory
+    named after the DNS domain of the host, so the index may have either or
+    both.
+
+    """
+    namespaced = config.getboolean("broker", "namespaced_host_profiles")
+    names = []
+    for obj in only:
+        obj = str(obj)
+        names.append(obj)
+        if namespaced and "/" not in obj:
+            (_short, _sep, dns_domain) = obj.partition(".")
+            if dns_domain:
+                names.append("%s/%s" % (dns_domain, obj))
+    return names
+
+
 def build_index(config, session, profilesdir, clientNotify=True,
-                logger=LOGGER):
+                logger=LOGGER, only=None):
     '''
     Create an index of what profiles are available
 
@@ -58,6 +183,10 @@ def build_index(config, session, profilesdir, clientNotify=True,
     unconditionally. Only if the broker config allows will the
     clientNotify be checked.
 
+    If 'only' is given, then it should be the list of profiles that may
+    have been changed (compiled or removed), and only those profiles are
+    checked.  Otherwise, the whole profilesdir is scanned.
+
     '''
     gzip_output = config.getboolean('panc', 'gzip_output')
     transparent_gzip = config.getboolean('panc', 'transparent_gzip')
@@ -82,86 +211,59 @@ def build_index(config, session, profilesdir, clientNotify=True,
     if gzip_index:
         profile_index += '.gz'
 
-    old_object_index = {}
     index_path = os.path.join(profilesdir, profile_index)
-    source = None
-    if os.path.exists(index_path):
-        try:
-            if gzip_index:
-                source = gzip.open(index_path)
-            else:
-                source = open(index_path)
-            tree = ET.parse(source)
-            for profile in tree.getiterator("profile"):
-                if not profile.text or "mtime" not in profile.attrib:
-                    continue
-                mtime = int(profile.attrib["mtime"])
-
-                obj = profile.text.strip()
-                if not obj:
-                    continue
-
-                for ext in [".xml", ".xml.gz"]:
-                    if obj.endswith(ext):
-                        obj = obj[:-len(ext)]
-                        break
-
-                old_object_index[obj] = mtime
-        except Exception, e:  # pragma: no cover
-            logger.info("Error processing %s, continuing: %s" %
-                        (index_path, e))
-        finally:
-            if source:
-                source.close()
+    index = get_profile_index(index_path, gzip_index)
 
     # modified_index stores the subset of namespaced names that
     # have changed since the last index. The values are unused.
     modified_index = {}
 
-    content = []
-    content.append("<?xml version='1.0' encoding='utf-8'?>")
-    content.append("<profiles>")
+    with index.lock:
+        old_object_index = index.load(logger=logger)
 
-    for root, _dirs, files in os.walk(profilesdir):
-        for profile in files:
-            if profile == profile_index:
-                continue
-            if not profile.endswith(profile_suffix):
-                continue
-            obj = os.path.join(root, profile[:-len(profile_suffix)])
-            # Remove the common prefix: our profilesdir, so that the
-            # remaining object name is relative to that root (+1 in order
-            # to remove the slash separator)
-            obj = obj[len(profilesdir) + 1:]
-            # This operation is not done with a lock, and it's possible
-            # that the file has been removed since calling os.walk().
-            # If that's the case, no need to add it to the modified_index.
-            try:
-                mtime = os.path.getmtime(os.path.join(root, profile))
-            except OSError, e:
-                continue
-            if obj in old_object_index and mtime > old_object_index[obj]:
-                modified_index[obj] = mtime
-
-            content.append("<profile mtime='%d'>%s%s</profile>" %
-                           (mtime, obj, advertise_suffix))
-
-    content.append("</profiles>")
-
-    compress = None
-    if gzip_index:
-        compress = 'gzip'
-    write_file(index_path, "\n".join(content), logger=logger, compress=compress)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    if config.has_option("broker", "bind_address"):
-        bind_address = socket.gethostbyname(config.get("broker", "bind_address"))
-        if config.has_option("broker", "cdp_send_port"):  # pragma: no cover
-            port = config.get_int("broker", "cdp_send_port")
+        if only is not None:
+            object_index = old_object_index.copy()
+            for obj in _profile_names(config, only):
+                try:
+                    mtime = os.path.getmtime(os.path.join(profilesdir,
+                                                          obj + profile_suffix))
+                except OSError, e:
+                    # The profile was removed, or the compile did not
+                    # produce it
+                    object_index.pop(obj, None)
+                    continue
+                if obj in old_object_index and mtime > old_object_index[obj]:
+                    modified_index[obj] = mtime
+                object_index[obj] = mtime
         else:
-            port = 0
-        sock.bind((bind_address, port))
+            object_index = {}
+            for root, _dirs, files in os.walk(profilesdir):
+                for profile in files:
+                    if profile == profile_index:
+                        continue
+                    if not profile.endswith(profile_suffix):
+                        continue
+                    obj = os.path.join(root, profile[:-len(profile_suffix)])
+                    # Remove the common prefix: our profilesdir, so that the
+                    # remaining object name is relative to that root (+1 in
+                    # order to remove the slash separator)
+                    obj = obj[len(profilesdir) + 1:]
+                    # This operation is not done with a lock, and it's
+                    # possible that the file has been removed since calling
+                    # os.walk().  If that's the case, no need to add it to
+                    # the modified_index.
+                    try:
+                        mtime = os.path.getmtime(os.path.join(root, profile))
+                    except OSError, e:
+                        continue
+                    if obj in old_object_index and \
+                       mtime > old_object_index[obj]:
+                        modified_index[obj] = mtime
+                    object_index[obj] = mtime
+
+        index.save(object_index, advertise_suffix, logger=logger)
+
+    dispatcher = get_dispatcher(config)
 
     if config.has_option("broker", "server_notifications"):
         service_modules = {}
@@ -176,55 +278,186 @@ def build_index(config, session, profilesdir, clientNotify=True,
                 except Exception, e:
                     logger.info("failed to lookup up server module %s: %s" %
                                 (service, e))
-        count = send_notification(CDB_NOTIF, service_modules.keys(), sock=sock,
-                                  logger=logger)
+        count = dispatcher.notify(CDB_NOTIF, service_modules.keys())
         logger.log(CLIENT_INFO, "sent %d server notifications" % count)
 
     if (config.has_option("broker", "client_notifications")
         and config.getboolean("broker", "client_notifications")
         and clientNotify):  # pragma: no cover
-        count = send_notification(CCM_NOTIF, modified_index.keys(), sock=sock,
-                                  logger=logger)
+        count = dispatcher.notify(CCM_NOTIF, modified_index.keys())
         logger.log(CLIENT_INFO, "sent %d client notifications" % count)
 
-    sock.close()
 
+class NotificationDispatcher(object):
+    """Send CDP notifications in the background.
+
+    Notifications are queued by notify() and sent out by a separate thread,
+    so the caller does not have to wait for DNS lookups. If a notification
+    of the same type is already pending for a host, the two are coalesced.
+    Resolved addresses (and failed lookups) are cached for dns_ttl seconds,
+    lookups of a batch are done by resolver_threads threads in parallel, and
+    at most send_rate packets are sent per second (0 means no limit).
+
+    """
+
+    def __init__(self, bind_address=None, port=0, dns_ttl=300,
+                 resolver_threads=8, send_rate=0, batch_size=1000,
+                 logger=LOGGER):
+        self.logger = logger
+        self.dns_ttl = dns_ttl
+        self.resolver_threads = max(resolver_threads, 1)
+        self.send_rate = send_rate
+        self.batch_size = batch_size
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if bind_address:
+            self.sock.bind((bind_address, port))
+
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        # List of (ntype, host) tuples in arrival order, and the same
+        # tuples as a set for coalescing
+        self.pending = deque()
+        self.pending_set = set()
+        # host -> (ip or None, expiry)
+        self.addresses = {}
+        self.sent_count = 0
+        self.coalesced_count = 0
+
+        self.thread = Thread(target=self.run, name="cdp-notifications")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def notify(self, ntype, modified):
+        """Queue notifications of type ntype to the given objects.
+
+        ntype should be CCM_NOTIF or CDB_NOTIF. 'modified' is a list of
+        object names that may be namespaced. Returns the number of hosts
+        queued.
+
+        """
+        count = 0
+        with self.lock:
+            for obj in modified:
+                # We need to clean the name, since it might
+                # be namespaced. This (in effect) globalizes
+                # all names. Perhaps we might want to do some
+                # checks based on the namespace. Not for now.
+                (_ns, _sep, host) = obj.rpartition('/')
+                count += 1
+
+                item = (ntype, host)
+                if item in self.pending_set:
+                    self.coalesced_count += 1
+                    continue
+                self.pending_set.add(item)
+                self.pending.append(item)
+            if count:
+                self.condition.notify()
+        return count
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.condition.wait()
+                batch = []
+                while self.pending and len(batch) < self.batch_size:
+                    item = self.pending.popleft()
+                    self.pending_set.discard(item)
+                    batch.append(item)
 
-def send_notification(ntype, modified, sock=None, logger=LOGGER):
-    '''send CDP notification messages to a list of hosts.
+            try:
+                self.resolve(set([host for _ntype, host in batch]))
+                self.send(batch)
+            except Exception, e:  # pragma: no cover
+                self.logger.info("Error sending notifications: %s" % e)
+
+    def resolve(self, hosts):
+        now = time.time()
+        unknown = [host for host in hosts
+                   if host not in self.addresses or
+                   self.addresses[host][1] < now]
+        if not unknown:
+            return
+
+        def lookup(names):
+            for host in names:
+                try:
+                    # If you think it would be a good idea to look up the IP
+                    # address from the DB directly, then think about the case
+                    # when the IP address of a host changes: the DB contains
+                    # the new address, but the host still uses the old.
+                    # Relying on DNS here means that the notification goes to
+                    # the right place.
+                    ip = socket.gethostbyname(host)
+                except socket.gaierror:
+                    # This hostname is unknown, so we silently
+                    # discard the notification.
+                    ip = None
+                except Exception, e:
+                    self.logger.info("Error resolving %s: %s" % (host, e))
+                    ip = None
+                self.addresses[host] = (ip, time.time() + self.dns_ttl)
+
+        threads = []
+        for i in range(1, min(self.resolver_threads, len(unknown))):
+            thread = Thread(target=lookup,
+                            args=(unknown[i::self.resolver_threads],))
+            thread.start()
+            threads.append(thread)
+        lookup(unknown[0::self.resolver_threads])
+        for thread in threads:
+            thread.join()
+
+    def send(self, batch):
+        if self.send_rate > 0:
+            interval = 1.0 / self.send_rate
+        else:
+            interval = 0
+        next_send = time.time()
 
-    This are sent synchronously, but we don't wait (or care) for any
-    reply, so it shouldn't be a problem. type should be CCM_NOTIF or CDB_NOTIF.
-    'modified' is a dict of object names that may be namespaced. Object
-    names that cannot be looked up in DNS are silently ignored.
-    Returns the number of notifications that were sent.
-    '''
+        for ntype, host in batch:
+            ip = self.addresses.get(host, (None, 0))[0]
+            if not ip:
+                continue
 
-    success = 0
-    for obj in modified:
-        # We need to clean the name, since it might
-        # be namespaced. This (in effect) globalizes
-        # all names. Perhaps we might want to do some
-        # checks based on the namespace. Not for now.
-        (_ns, _sep, host) = obj.rpartition('/')
+            if interval:
+                delay = next_send - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send = max(next_send, time.time()) + interval
 
-        try:
-            # If you think it would be a good idea to look up the IP address
-            # from the DB directly, then think about the case when the IP
-            # address of a host changes: the DB contains the new address, but
-            # the host still uses the old. Relying on DNS here means that the
-            # notification goes to the right place.
-            ip = socket.gethostbyname(host)
             packet = NOTIFICATION_TYPES[ntype] + "\0" + str(int(time.time()))
-            sock.sendto(packet, (ip, CDPPORT))
-            success = success + 1
+            try:
+                self.sock.sendto(packet, (ip, CDPPORT))
+                self.sent_count += 1
+            except Exception, e:
+                self.logger.info("Error notifying %s: %s" % (host, e))
+
+
+_dispatcher = None
+_dispatcher_lock = Lock()
+
+
+def get_dispatcher(config):
+    global _dispatcher
 
-        except socket.gaierror:
-            # This hostname is unknown, so we silently
-            # discard the notification.
-            pass
+    with _dispatcher_lock:
+        if _dispatcher:
+            return _dispatcher
 
-        except Exception, e:
-            logger.info("Error notifying %s: %s" % (host, e))
+        bind_address = None
+        port = 0
+        if config.has_option("broker", "bind_address"):
+            bind_address = socket.gethostbyname(config.get("broker",
+                                                           "bind_address"))
+            if config.has_option("broker", "cdp_send_port"):  # pragma: no cover
+                port = config.getint("broker", "cdp_send_port")
 
-    return success
+        _dispatcher = NotificationDispatcher(
+            bind_address=bind_address, port=port,
+            dns_ttl=config.getint("broker", "cdp_dns_ttl"),
+            resolver_threads=config.getint("broker", "cdp_resolver_threads"),
+            send_rate=config.getint("broker", "cdp_send_rate"))
+        return _dispatcher
@@ -24,94 +24,130 @@ from numbers import Number
 _valid_id = re.compile(r"^[a-zA-Z_][\w.+\-]*$")
 
 
-def pan(obj, indent=0):
-    """pan(OBJ) -- return a string representing OBJ in the PAN language"""
+# Nlist keys which have already been validated, and their formatted value.
+# The set of distinct keys is small in practice, but do not let it grow
+# without bounds.
+_key_cache = {}
+_MAX_KEY_CACHE = 100000
+
+# Indentation strings for the common nesting levels
+_indents = ["  " * i for i in range(16)]
+
+
+def _indent(level):
+    if level < len(_indents):
+        return _indents[level]
+    return "  " * level
 
-    spaces = "  " * (indent + 1)
-    accumulator = list()
 
-    if isinstance(obj, basestring):
-        quote = '"'
-        if '"' in obj:
-            quote = "'"
-        accumulator.append("%s%s%s" % (quote, obj, quote))
+def _quote(value):
+    if '"' in value:
+        return "'%s'" % value
+    return '"%s"' % value
+
+
+def _format_key(key):
+    if isinstance(key, PanEscape):
+        return "%s" % key.format()
+    elif isinstance(key, basestring):
+        if not _valid_id.match(str(key)):  # pragma: no cover
+            raise ValueError("Invalid nlist key '%s'." % key)
+        formatted = _quote(key)
+        if type(key) is str and len(_key_cache) < _MAX_KEY_CACHE:
+            _key_cache[key] = formatted
+        return formatted
+    else:  # pragma: no cover
+        raise TypeError("The value of an nlist key must be a string, "
+                        "optionally escaped (it was: %r)" % key)
+
+
+def _write_entries(out, obj, indent, value_indent):
+    # Enforce a deterministic order to avoid recompilations due to change in
+    # ordering. This also helps with the testsuite.
+    spaces = "\n" + _indent(indent + 1)
+    separator = spaces
+    for key in sorted(obj.keys()):
+        if type(key) is str and key in _key_cache:
+            formatted = _key_cache[key]
+        else:
+            formatted = _format_key(key)
+        out.append(separator + formatted + ", ")
+        _write(out, obj[key], value_indent)
+        separator = "," + spaces
+
+
+def _write(out, obj, indent):
+    """Append the PAN representation of obj to the list out"""
+
+    # Fast path for the most common types
+    objtype = type(obj)
+    if objtype is str or objtype is unicode:
+        out.append(_quote(obj))
+    elif objtype is int:
+        out.append("%d" % obj)
+    elif objtype is bool:
+        out.append(obj and "true" or "false")
+
+    elif isinstance(obj, basestring):
+        out.append(_quote(obj))
 
     elif isinstance(obj, bool):
-        accumulator.append(str(obj).lower())
+        out.append(str(obj).lower())
 
     elif isinstance(obj, int):
-        accumulator.append("%d" % obj)
+        out.append("%d" % obj)
 
     elif isinstance(obj, PanObject):
-        accumulator.append(obj.format(indent))
+        obj.write(out, indent)
 
     elif isinstance(obj, Mapping):
-        accumulator.append("nlist(")
-        # Enforce a deterministic order to avoid recompilations due to change in
-        # ordering. This also helps with the testsuite.
-        for key in sorted(obj.keys()):
-            val = pan(obj[key], indent + 1)
-            if isinstance(key, PanEscape):
-                pass
-            elif isinstance(key, basestring):
-                if not _valid_id.match(str(key)):  # pragma: no cover
-                    raise ValueError("Invalid nlist key '%s'." % key)
-            else:  # pragma: no cover
-                raise TypeError("The value of an nlist key must be a string, "
-                                "optionally escaped (it was: %r)" % key)
-            accumulator.append("%s%s, %s," % (spaces, pan(key), val))
-        # remove the last comma
-        accumulator[-1] = accumulator[-1].rstrip(",")
-        accumulator.append("%s)" % ("  " * indent))
+        out.append("nlist(")
+        _write_entries(out, obj, indent, indent + 1)
+        out.append("\n" + _indent(indent) + ")")
 
     elif isinstance(obj, Iterable):
-        accumulator.append("list(")
+        out.append("list(")
+        spaces = "\n" + _indent(indent + 1)
+        separator = spaces
         for item in obj:
-            val = pan(item, indent + 1)
-            accumulator.append("%s%s," % (spaces, val))
-        # remove the last comma
-        accumulator[-1] = accumulator[-1].rstrip(",")
-        accumulator.append("%s)" % ("  " * indent))
+            out.append(separator)
+            _write(out, item, indent + 1)
+            separator = "," + spaces
+        out.append("\n" + _indent(indent) + ")")
 
     else:
-        accumulator.append(pan(str(obj)))
-
-    if (len(accumulator) == 1):
-        return accumulator[0]
+        out.append(_quote(str(obj)))
 
-    return "\n".join(("%s" % x) for x in accumulator)
 
-
-def pan_create(path, params=None, indent=0):
-    """ Return a PAN create() statement """
-
-    spaces = "  " * (indent + 1)
-    accumulator = list()
-    accumulator.append("create(%s," % pan(path))
-
-    # Enforce a deterministic order to avoid recompilations due to change in
-    # ordering. This also helps with the testsuite.
+def _write_create(out, quoted_path, params, indent):
+    out.append("create(")
+    out.append(quoted_path)
     if params:
-        for key in sorted(params.keys()):
-            val = pan(params[key], indent + 2)
-            if isinstance(key, PanEscape):
-                pass
-            elif isinstance(key, basestring):
-                if not _valid_id.match(str(key)):  # pragma: no cover
-                    raise ValueError("Invalid nlist key '%s'." % key)
-            else:  # pragma: no cover
-                raise TypeError("The value of an nlist key must be a string, "
-                                "optionally escaped (it was: %r)" % key)
-            accumulator.append("%s%s, %s," % (spaces, pan(key), val))
-        # remove the last comma
-        accumulator[-1] = accumulator[-1].rstrip(",")
-        accumulator.append("%s)" % ("  " * indent))
+        out.append(",")
+        _write_entries(out, params, indent, indent + 2)
+        out.append("\n" + _indent(indent) + ")")
     else:
         # If there are no parameters, keep the entire create() statement in a
         # single line
-        accumulator[-1] = accumulator[-1].rstrip(",") + ")"
+        out.append(")")
+
+
+def pan(obj, indent=0):
+    """pan(OBJ) -- return a string representing OBJ in the PAN language"""
 
-    return "\n".join(("%s" % x) for x in accumulator)
+    out = []
+    _write(out, obj, indent)
+    if len(out) == 1:
+        return out[0]
+    return "".join(out)
+
+
+def pan_create(path, params=None, indent=0):
+    """ Return a PAN create() statement """
+
+    out = []
+    _write_create(out, pan(path), params, indent)
+    return "".join(out)
 
 
 def pan_assign(lines, path, value):
@@ -158,6 +194,10 @@ class PanObject(object):
     def format(self, indent=0):
         pass
 
+    def write(self, out, indent=0):
+        """Append the formatted object to the list out"""
+        out.append("%s" % self.format(indent))
+
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__, self.format())
 
@@ -167,8 +207,24 @@ class StructureTemplate(PanObject):
         self.path = path
         self.params = params
 
+    @property
+    def path(self):
+        return self._path
+
+    @path.setter
+    def path(self, value):
+        # The same template is usually included many times, so render the
+        # path only once
+        self._path = value
+        self._quoted_path = pan(value)
+
     def format(self, indent=0):
-        return pan_create(self.path, self.params, indent)
+        out = []
+        self.write(out, indent)
+        return "".join(out)
+
+    def write(self, out, indent=0):
+        _write_create(out, self._quoted_path, self.params, indent)
 
 
 class PanMetric(PanObject):
@@ -19,13 +19,14 @@ import logging
 from collections import defaultdict
 
 from aquilon.aqdb.model import Personality, Parameter
+from aquilon.aqdb.model.parameter import parameter_index
 from aquilon.worker.templates.base import (Plenary, TemplateFormatter,
                                            PlenaryCollection)
 from aquilon.worker.templates.panutils import (pan_include, pan_variable,
                                                pan_assign, pan_append,
                                                pan_include_if_exists)
 from aquilon.worker.dbwrappers.parameter import (validate_value,
-                                                 get_parameters)
+                                                 get_parameter_paths)
 from sqlalchemy.orm import object_session
 from collections import defaultdict
 
@@ -43,14 +44,14 @@ def get_parameters_by_feature(dbfeaturelink):
         return ret
 
     param_definitions = paramdef_holder.param_definitions
-    parameters = get_parameters(object_session(dbfeaturelink),
-                                personality=dbfeaturelink.personality)
+    parameters = get_parameter_paths(object_session(dbfeaturelink),
+                                     personality=dbfeaturelink.personality)
 
     for param_def in param_definitions:
+        path = Parameter.feature_path(dbfeaturelink, param_def.path)
         value = None
-        for param in parameters:
-            value = param.get_feature_path(dbfeaturelink,
-                                           param_def.path, compel=False)
+        for paths in parameters:
+            value = parameter_index.lookup(paths, path)
             if not value and param_def.default:
                 value = validate_value("default for path=%s" % param_def.path,
                                        param_def.value_type, param_def.default)
@@ -101,12 +102,12 @@ def get_parameters_by_tmpl(dbpersonality):
         return ret
 
     param_definitions = paramdef_holder.param_definitions
-    parameters = get_parameters(session, personality=dbpersonality)
+    parameters = get_parameter_paths(session, personality=dbpersonality)
 
     for param_def in param_definitions:
         value = None
-        for param in parameters:
-            value = param.get_path(param_def.path, compel=False)
+        for paths in parameters:
+            value = parameter_index.lookup(paths, param_def.path)
             if (value is None) and param_def.default:
                 value = validate_value("default for path=%s" % param_def.path,
                                        param_def.value_type, param_def.default)
@@ -0,0 +1,200 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Working copies of template-king used for merging branches.
+
+Deploying a branch used to clone template-king into a temporary directory,
+merge, push, and throw the clone away.  Checking out a large repository
+over and over is expensive, so every target branch gets a persistent
+working copy under the merge_workspacedir directory instead.  Before being
+handed out, the working copy is reset to the current head of the branch in
+template-king, so nothing is left over from the previous merge, failed or
+not.
+
+A working copy is used by a single merge at a time.  If a second merge into
+the same branch comes along, it gets a temporary clone, just like before.
+
+"""
+
+import os
+import logging
+from tempfile import mkdtemp
+from threading import Lock
+
+from aquilon.config import Config
+from aquilon.exceptions_ import ProcessException
+from aquilon.worker.processes import run_git, remove_dir
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MergeWorkspace(object):
+    """A working copy with a branch checked out.
+
+    Use it in a with statement, or call release() when done.
+
+    """
+
+    def __init__(self, pool, branch, path, tempdir=None):
+        self.pool = pool
+        self.branch = branch
+        self.path = path
+        self.tempdir = tempdir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self, logger=LOGGER):
+        if self.tempdir:
+            remove_dir(self.tempdir, logger=logger)
+            self.tempdir = None
+        else:
+            self.pool._release(self.branch, logger=logger)
+
+
+class WorkspacePool(object):
+    """Hand out working copies of template-king."""
+
+    def __init__(self, kingdir, rundir, basedir=None):
+        self.kingdir = kingdir
+        self.rundir = rundir
+        self.basedir = basedir
+        self.lock = Lock()
+        # Branches whose working copy is in use
+        self.busy = set()
+        # Branches deleted while their working copy was in use
+        self.deleted = set()
+
+    def _release(self, branch, logger=LOGGER):
+        with self.lock:
+            if branch not in self.deleted:
+                self.busy.discard(branch)
+                return
+            self.deleted.discard(branch)
+
+        # The branch stays busy until the directory is gone, but the lock is
+        # not held, so deploys to other branches are not blocked
+        try:
+            path = os.path.join(self.basedir, branch)
+            if os.path.exists(path):
+                remove_dir(path, logger=logger)
+        finally:
+            with self.lock:
+                self.busy.discard(branch)
+
+    def _clone(self, branch, parent, logger, shared=False):
+        # A shared clone borrows the objects of template-king, which is fine
+        # for a clone thrown away after the merge.  Working copies kept
+        # around get their own (hardlinked) objects, so garbage collecting
+        # template-king cannot break them.
+        args = ["clone"]
+        if shared:
+            args.append("--shared")
+        args.extend(["--branch", branch, self.kingdir, branch])
+        run_git(args, path=parent, logger=logger)
+        return os.path.join(parent, branch)
+
+    def _reset(self, branch, path, fetch, logger):
+        refspecs = ["+refs/heads/%s:refs/remotes/origin/%s" % (name, name)
+                    for name in [branch] + fetch]
+        run_git(["fetch", "--prune", "origin"] + refspecs, path=path,
+                logger=logger)
+        # This also gets rid of any unfinished merge
+        run_git(["checkout", "-q", "-f", "-B", branch, "origin/%s" % branch],
+                path=path, logger=logger)
+        run_git(["clean", "-q", "-f", "-d", "-x"], path=path, logger=logger)
+
+    def checkout(self, branch, fetch=None, logger=LOGGER):
+        """Return a working copy with the head of branch checked out.
+
+        The branches listed in fetch are made available as origin/<name>,
+        up to date with template-king.
+
+        """
+        fetch = fetch or []
+        with self.lock:
+            reuse = bool(self.basedir) and branch not in self.busy
+            if reuse:
+                self.busy.add(branch)
+
+        if not reuse:
+            tempdir = mkdtemp(prefix="deploy_", suffix="_%s" % branch,
+                              dir=self.rundir)
+            try:
+                path = self._clone(branch, tempdir, logger, shared=True)
+            except:
+                remove_dir(tempdir, logger=logger)
+                raise
+            return MergeWorkspace(self, branch, path, tempdir=tempdir)
+
+        path = os.path.join(self.basedir, branch)
+        try:
+            # Working copies made by older versions used alternates
+            alternates = os.path.join(path, ".git", "objects", "info",
+                                      "alternates")
+            if os.path.exists(os.path.join(path, ".git")) and \
+               not os.path.exists(alternates):
+                try:
+                    self._reset(branch, path, fetch, logger)
+                    return MergeWorkspace(self, branch, path)
+                except ProcessException, e:
+                    logger.info("Failed to reset the working copy of %s, "
+                                "cloning it again: %s" % (branch, e))
+            if os.path.exists(path):
+                remove_dir(path, logger=logger)
+            if not os.path.exists(self.basedir):
+                os.makedirs(self.basedir)
+            self._clone(branch, self.basedir, logger)
+            return MergeWorkspace(self, branch, path)
+        except:
+            self._release(branch)
+            raise
+
+    def remove(self, branch, logger=LOGGER):
+        """Remove the working copy of a branch that is being deleted."""
+        if not self.basedir:
+            return
+        with self.lock:
+            self.deleted.add(branch)
+            if branch in self.busy:
+                # The current user removes it when done
+                return
+            self.busy.add(branch)
+        self._release(branch, logger)
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_workspace_pool(config=None):
+    global _pool
+
+    with _pool_lock:
+        if _pool:
+            return _pool
+        if not config:
+            config = Config()
+        basedir = None
+        if config.has_option("broker", "merge_workspacedir"):
+            basedir = config.get("broker", "merge_workspacedir").strip()
+        _pool = WorkspacePool(config.get("broker", "kingdir"),
+                              config.get("broker", "rundir"),
+                              basedir=basedir or None)
+        return _pool
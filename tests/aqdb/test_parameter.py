@@ -0,0 +1,160 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Test the shared index of parameter paths """
+from copy import deepcopy
+
+from utils import load_classpath, commit, add
+
+load_classpath()
+
+from aquilon.aqdb.db_factory import DbFactory
+from aquilon.aqdb.model import (Archetype, Personality, Parameter,
+                                PersonalityParameter)
+from aquilon.aqdb.model.parameter import index_paths, parameter_index
+
+from sqlalchemy import and_
+from sqlalchemy.orm import join
+
+db = DbFactory()
+sess = db.Session()
+
+PERSONALITY = 'aqdbtest-param'
+VALUE = {"espinfo": {"function": "development"},
+         "features": {"interface": {"myfeature": {"eth0": {"key": "val0"},
+                                                  "eth1": {"key": "val1"}}}}}
+PATH = "features/interface/myfeature/eth1/key"
+
+
+def setup():
+    clean_up()
+    generic = sess.query(Personality).select_from(
+        join(Personality, Archetype)).filter(
+        and_(Archetype.name == 'windows', Personality.name == 'generic')).one()
+    dbpersona = Personality(name=PERSONALITY, archetype=generic.archetype,
+                            owner_grn=generic.owner_grn,
+                            host_environment=generic.host_environment)
+    add(sess, dbpersona)
+    dbholder = PersonalityParameter(personality=dbpersona)
+    add(sess, Parameter(holder=dbholder, value=deepcopy(VALUE)))
+    commit(sess)
+
+
+def teardown():
+    clean_up()
+
+
+def clean_up():
+    dbpersona = get_persona()
+    if dbpersona:
+        sess.delete(dbpersona)
+        commit(sess)
+
+
+def get_persona():
+    q = sess.query(Personality).select_from(
+        join(Personality, Archetype)).filter(
+        and_(Archetype.name == 'windows', Personality.name == PERSONALITY))
+    return q.first()
+
+
+def lookup(dbholder, path):
+    indexed = parameter_index.get(sess, [dbholder])[dbholder]
+    assert len(indexed) == 1, "indexed %d parameters" % len(indexed)
+    return parameter_index.lookup(indexed[0], path)
+
+
+def cached(dbholder, path):
+    return parameter_index.lookup(parameter_index.holders[dbholder.id][0],
+                                  path)
+
+
+def test_index_paths():
+    """ test that every node of a value is indexed by its path """
+    paths = index_paths({"a": {"b": 1, "c/d": 2}, "e": [3]})
+    assert paths == {"a": {"b": 1, "c/d": 2}, "a/b": 1, "e": [3]}, paths
+
+
+def test_lookup():
+    """ test that the committed parameters are cached and shared """
+    dbholder = get_persona().paramholder
+    parameter_index.drop(dbholder.id)
+    assert lookup(dbholder, PATH) == "val1"
+    assert dbholder.id in parameter_index.holders
+
+    assert lookup(dbholder, "/espinfo/function/") == "development"
+    assert lookup(dbholder, "espinfo") == {"function": "development"}
+    assert lookup(dbholder, "espinfo/owner") is None
+
+    first = parameter_index.get(sess, [dbholder])[dbholder]
+    second = parameter_index.get(sess, [dbholder])[dbholder]
+    assert first is second, "cached entry was not reused"
+
+
+def test_uncommitted_set():
+    """ test that changes are seen at once, and cached after the commit """
+    dbholder = get_persona().paramholder
+    assert lookup(dbholder, PATH) == "val1"
+    dbparam = dbholder.parameters[0]
+    dbparam.set_path(PATH, "newval", compel=True)
+
+    assert lookup(dbholder, PATH) == "newval"
+    assert cached(dbholder, PATH) == "val1", \
+            "uncommitted value %s was cached" % cached(dbholder, PATH)
+
+    commit(sess)
+    assert dbholder.id not in parameter_index.holders
+    assert lookup(dbholder, PATH) == "newval"
+    assert cached(dbholder, PATH) == "newval"
+
+
+def test_flushed_set():
+    """ test that flushed values are not cached """
+    dbholder = get_persona().paramholder
+    parameter_index.drop(dbholder.id)
+    dbparam = dbholder.parameters[0]
+    dbparam.set_path("espinfo/function", "production", compel=True)
+    sess.flush()
+
+    assert lookup(dbholder, "espinfo/function") == "production"
+    assert dbholder.id not in parameter_index.holders
+
+    commit(sess)
+    assert lookup(dbholder, "espinfo/function") == "production"
+
+
+def test_del():
+    """ test that deleted paths disappear from the index """
+    dbholder = get_persona().paramholder
+    assert lookup(dbholder, PATH) == "newval"
+    dbholder.parameters[0].del_path(PATH)
+    assert lookup(dbholder, PATH) is None
+    assert lookup(dbholder, "features/interface/myfeature/eth0/key") == "val0"
+
+    commit(sess)
+    assert lookup(dbholder, PATH) is None
+    assert cached(dbholder, PATH) is None
+
+
+def test_rollback():
+    """ test that rolled back changes are not seen """
+    dbholder = get_persona().paramholder
+    assert lookup(dbholder, PATH) is None
+    dbholder.parameters[0].set_path(PATH, "rolledback")
+    assert lookup(dbholder, PATH) == "rolledback"
+
+    sess.rollback()
+    assert lookup(dbholder, PATH) is None
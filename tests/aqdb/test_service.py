@@ -225,3 +225,30 @@ def test_cascaded_delete2():
 if __name__ == "__main__":
     import nose
     nose.runmodule()
+
+
+class _FakeSession(object):
+    pass
+
+
+def test_client_roster_commit_replaces_list():
+    """ test that committing changes does not modify handed out lists """
+    from aquilon.aqdb.model.service_instance import ClientRoster
+
+    roster = ClientRoster()
+    names = [("aqdbtest.ms.com", "host1"), ("aqdbtest.ms.com", "host3")]
+    roster.rosters[1] = names
+    handed_out = roster.rosters[1]
+
+    session = _FakeSession()
+    session._aq_client_roster = {
+        "instances": {1: {}}, "invalid": False,
+        "resolved": {1: ([("aqdbtest.ms.com", "host2")],
+                         [("aqdbtest.ms.com", "host1")])}}
+    roster.after_commit(session)
+
+    assert handed_out == [("aqdbtest.ms.com", "host1"),
+                          ("aqdbtest.ms.com", "host3")], \
+            "cached list was modified in place: %s" % handed_out
+    assert roster.rosters[1] == [("aqdbtest.ms.com", "host2"),
+                                 ("aqdbtest.ms.com", "host3")]
@@ -0,0 +1,144 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Test writing the audit trail, inline and in the background """
+
+from uuid import uuid4
+
+from utils import load_classpath, commit
+load_classpath()
+
+from aquilon.config import Config
+from aquilon.aqdb.db_factory import DbFactory
+from aquilon.aqdb.model import Xtn, XtnDetail, XtnEnd
+from aquilon.aqdb.model import xtn as xtn_module
+from aquilon.aqdb.model.xtn import (AuditWriter, _start_rows, _end_rows,
+                                    start_xtn, end_xtn, flush_audit)
+
+db = DbFactory()
+sess = db.Session()
+
+XTN_IDS = []
+
+
+def teardown():
+    if not XTN_IDS:
+        return
+    for cls in (XtnDetail, XtnEnd, Xtn):
+        q = sess.query(cls).filter(cls.xtn_id.in_(XTN_IDS))
+        q.delete(synchronize_session=False)
+    commit(sess)
+
+
+def submit_command(writer, username="aqdbtest", return_code=200):
+    xtn_id = uuid4()
+    XTN_IDS.append(xtn_id)
+    (xtn, xtn_details) = _start_rows(xtn_id, username, "show_host", True,
+                                     {"hostname": "%s.aqdbtest.ms.com" %
+                                      xtn_id.hex})
+    writer.submit(xtns=[xtn], xtn_details=xtn_details)
+    (xtn_end, xtn_details) = _end_rows(xtn_id, return_code)
+    writer.submit(xtn_details=xtn_details, xtn_ends=[xtn_end])
+    return xtn_id
+
+
+def get_xtn(xtn_id):
+    sess.expire_all()
+    return sess.query(Xtn).filter_by(xtn_id=xtn_id).first()
+
+
+def test_batch():
+    """ test that queued commands show up after a flush """
+    writer = AuditWriter(db.engine, batch_size=100, flush_interval=0.5)
+    xtn_ids = [submit_command(writer, return_code=code)
+               for code in (200, 400, 500)]
+    assert writer.flush(30), "audit records were not written in time"
+    assert writer.written == 6, "wrote %d records" % writer.written
+    assert writer.failed == 0, "%d records failed" % writer.failed
+
+    for xtn_id, code in zip(xtn_ids, (200, 400, 500)):
+        xtn = get_xtn(xtn_id)
+        assert xtn, "command %s was not written" % xtn_id
+        assert xtn.end, "end of command %s was not written" % xtn_id
+        assert xtn.end.return_code == code
+        assert [arg.name for arg in xtn.args] == ["hostname"]
+
+
+def test_failed_batch():
+    """ test that a bad record does not take its batch down """
+    writer = AuditWriter(db.engine, batch_size=100, flush_interval=0.5)
+    good1 = submit_command(writer)
+    # username is not nullable
+    bad = submit_command(writer, username=None)
+    good2 = submit_command(writer)
+    assert writer.flush(30), "audit records were not written in time"
+
+    # The start of the bad command failed, and its end was not attempted
+    assert writer.written == 4, "wrote %d records" % writer.written
+    assert writer.failed == 2, "%d records failed" % writer.failed
+    assert not writer.lost, "%s are still marked as lost" % writer.lost
+    assert not get_xtn(bad), "bad command %s was written" % bad
+    for xtn_id in (good1, good2):
+        xtn = get_xtn(xtn_id)
+        assert xtn, "command %s was not written" % xtn_id
+        assert xtn.end, "end of command %s was not written" % xtn_id
+
+
+def run_command(return_code):
+    xtn_id = uuid4()
+    XTN_IDS.append(xtn_id)
+    start_xtn(sess, xtn_id, "aqdbtest", "reconfigure", False,
+              {"list": "host1.aqdbtest.ms.com\nhost2.aqdbtest.ms.com\n"},
+              options_to_split=["list"])
+    end_xtn(sess, xtn_id, return_code, [("count", 2)])
+    return xtn_id
+
+
+def check_command(xtn_id, return_code):
+    xtn = get_xtn(xtn_id)
+    assert xtn, "command %s was not written" % xtn_id
+    assert xtn.end, "end of command %s was not written" % xtn_id
+    assert xtn.end.return_code == return_code
+    assert sorted([(arg.name, arg.value) for arg in xtn.args]) == \
+            [("__RESULT__:count", "2"), ("list", "host1.aqdbtest.ms.com"),
+             ("list", "host2.aqdbtest.ms.com")]
+
+
+def test_sync_mode():
+    """ test that the records are committed before returning """
+    config = Config()
+    assert config.get("database", "audit_mode") == "sync"
+    assert xtn_module.get_audit_writer(db.engine) is None
+    xtn_id = run_command(200)
+    check_command(xtn_id, 200)
+
+
+def test_async_mode():
+    """ test that the records of async mode are visible after a flush """
+    config = Config()
+    old_mode = config.get("database", "audit_mode")
+    config.set("database", "audit_mode", "async")
+    try:
+        writer = xtn_module.get_audit_writer(db.engine)
+        assert writer, "no audit writer in async mode"
+        xtn_ids = [run_command(code) for code in (200, 400)]
+        assert flush_audit(30), "audit records were not written in time"
+        assert writer.failed == 0, "%d records failed" % writer.failed
+        for xtn_id, code in zip(xtn_ids, (200, 400)):
+            check_command(xtn_id, code)
+    finally:
+        config.set("database", "audit_mode", old_mode)
+        xtn_module._writer = None
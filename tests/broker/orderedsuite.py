@@ -134,6 +134,7 @@ from test_constraints_chooser import TestChooserConstraints
 from test_vulcan2 import TestVulcan20
 from test_flush import TestFlush
 from test_compile import TestCompile
+from test_compile_worker import TestCompileWorker
 from test_profile import TestProfile
 from test_bind_server import TestBindServer
 from test_add_filesystem import TestAddFilesystem
@@ -171,6 +172,7 @@ from test_search_hardware import TestSearchHardware
 from test_search_machine import TestSearchMachine
 from test_search_dns import TestSearchDns
 from test_dump_dns import TestDumpDns
+from test_stream import TestStream
 from test_search_system import TestSearchSystem
 from test_search_host import TestSearchHost
 from test_search_esx_cluster import TestSearchESXCluster
@@ -337,7 +339,7 @@ class BrokerTestSuite(unittest.TestSuite):
                 TestParameter, TestParameterFeature,
                 TestRefreshWindowsHosts,
                 TestChooserConstraints,
-                TestCompile,
+                TestCompile, TestCompileWorker,
                 TestProfile,
                 TestBindServer,
                 TestAddFilesystem, TestAddApplication, TestAddIntervention,
@@ -357,7 +359,7 @@ class BrokerTestSuite(unittest.TestSuite):
                 TestSearchRack,
                 TestShowSwitch, TestSearchSwitch,
                 TestSearchHardware, TestSearchMachine, TestShowMachine,
-                TestSearchDns, TestDumpDns,
+                TestSearchDns, TestDumpDns, TestStream,
                 TestSearchSystem, TestSearchHost, TestSearchESXCluster,
                 TestSearchClusterESX, TestSearchCluster,
                 TestSearchObservedMac, TestSearchNext, TestSearchNetwork,
@@ -0,0 +1,55 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Helper classes for service client testing """
+
+import re
+
+
+class VerifyClientsMixin(object):
+
+    clients_re = re.compile(r'"clients" = list\(([^)]*)\);')
+
+    def check_clients(self, service, instance):
+        """Check the clients of a service instance, and return them.
+
+        The server plenary must list the hosts bound to the instance, sorted
+        by DNS domain and then by short name, and show service must count
+        them.
+
+        """
+        command = ["search", "host", "--service", service,
+                   "--instance", instance]
+        out = self.commandtest(command)
+        expected = sorted(out.split(),
+                          key=lambda fqdn: tuple(reversed(fqdn.split(".", 1))))
+
+        command = ["cat", "--service", service, "--instance", instance,
+                   "--server"]
+        out = self.commandtest(command)
+        m = self.clients_re.search(out)
+        self.failUnless(m, "Client list not found in output:\n%s" % out)
+        clients = re.findall(r'"([^"]+)"', m.group(1))
+        self.failUnlessEqual(clients, expected,
+                             "Wrong list of clients for service %s instance "
+                             "%s: %s instead of %s" %
+                             (service, instance, clients, expected))
+
+        command = ["show", "service", "--service", service,
+                   "--instance", instance]
+        out = self.commandtest(command)
+        self.matchoutput(out, "Client Count: %d" % len(expected), command)
+        return clients
@@ -384,6 +384,27 @@ class TestAudit(TestBrokerCommand):
         out = self.badrequesttest(cmd)
         self.matchoutput(out, "Cannot set the limit higher than", cmd)
 
+    def test_820_previous_commands(self):
+        """ test that the commands run just before are all there """
+        keyword = "audit-check-%d" % time()
+        for limit in range(1, 4):
+            self.commandtest(["search_audit", "--keyword", keyword,
+                              "--limit", limit])
+        command = ["search_audit", "--keyword", keyword,
+                   "--command", "search_audit"]
+        out = self.commandtest(command)
+        commands = [m for m in AUDIT_RAW_RE.finditer(out)]
+        self.assertEqual(len(commands), 4,
+                         "Expected 4 commands, got %d:\n%s" %
+                         (len(commands), out))
+        # The end of the running command has not been written yet
+        self.assertEqual([m.group('returncode') for m in commands],
+                         ['200', '200', '200', '-'])
+        for m, limit in zip(commands, ['1', '2', '3', None]):
+            if limit:
+                self.assertTrue("--limit='%s'" % limit in m.group('args'),
+                                "Missing --limit=%s: %s" % (limit, m.group(0)))
+
     def test_900_empty_list_arg(self):
         """ test the output with an empty string as a list element """
         hosts = ["no_such_host.ut.com\n", "   \n", "another_non_host.ut.com\n"]
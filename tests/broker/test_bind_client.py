@@ -24,9 +24,10 @@ if __name__ == "__main__":
     utils.import_depends()
 
 from brokertest import TestBrokerCommand
+from servicetest import VerifyClientsMixin
 
 
-class TestBindClient(TestBrokerCommand):
+class TestBindClient(VerifyClientsMixin, TestBrokerCommand):
     """Testing manually binding client to services.
 
     Once a client has been bound, you can't use it to test
@@ -113,6 +114,12 @@ class TestBindClient(TestBrokerCommand):
         out = self.commandtest(command.split(" "))
         self.matchoutput(out, "Template: service/utsvc/utsi2", command)
 
+    def testverifyclients(self):
+        for (service, instance) in [("afs", "q.ny.ms.com"),
+                                    ("dns", "utdnsinstance"),
+                                    ("utsvc", "utsi1"), ("utsvc", "utsi2")]:
+            self.check_clients(service, instance)
+
     def testverifybinddns(self):
         command = "show host --hostname unittest02.one-nyp.ms.com"
         out = self.commandtest(command.split(" "))
@@ -135,6 +135,30 @@ class TestCompile(TestBrokerCommand):
         self.matchoutput(err, "0/1 object template(s) being processed",
                          command)
 
+    def test_310_compilehost_index(self):
+        # Compiling a single host must update its entry in the index, and
+        # leave the others alone
+        host = "unittest02.one-nyp.ms.com"
+        old_mtimes = self.get_profile_mtimes()
+        self.assertTrue(host in old_mtimes,
+                        "host %s missing from profiles-info" % host)
+
+        # The profile is up to date, so make it look newer instead of
+        # relying on the compiler to rewrite it
+        profile = os.path.join(self.config.get("broker", "profilesdir"),
+                               host + self.profile_suffix)
+        mtime = old_mtimes[host] + 10
+        os.utime(profile, (mtime, mtime))
+
+        command = ["compile", "--hostname", host]
+        self.successtest(command)
+
+        new_mtimes = self.get_profile_mtimes()
+        self.assertEqual(new_mtimes[host], mtime)
+        del old_mtimes[host]
+        del new_mtimes[host]
+        self.assertEqual(new_mtimes, old_mtimes)
+
     def test_400_addsandbox(self):
         command = "add_sandbox --sandbox=out_of_date --start=utsandbox"
         self.successtest(command.split())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python2.6
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the pool of persistent compile workers.
+
+The broker used by the other tests compiles with ant, so the worker backend
+is driven directly here, using the fake compile worker.
+
+"""
+
+import os
+import shutil
+import logging
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from brokertest import TestBrokerCommand
+from aquilon.exceptions_ import ProcessException
+from aquilon.worker.compiler import WorkerBackend
+
+COMPILER = "/fake/panc.jar"
+DOMAIN = "unittest-worker"
+LOGGER = logging.getLogger(__name__)
+
+
+class TestCompileWorker(TestBrokerCommand):
+
+    def setUp(self):
+        super(TestCompileWorker, self).setUp()
+        self.basedir = os.path.join(self.scratchdir, "compile_worker")
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        self.profiledir = os.path.join(self.basedir, "cfg", "domains",
+                                       DOMAIN, "profiles")
+        self.webdir = os.path.join(self.basedir, "web")
+        os.makedirs(self.profiledir)
+        self.profiles = ["host%d.aqd-unittest.ms.com" % i for i in range(3)]
+        for profile in self.profiles:
+            self.write_template(profile)
+
+        command = os.path.join(self.config.get("unittest", "srcdir"),
+                               "tests", "fakebin", "fake_compile_worker")
+        buildfile = os.path.join(self.config.get("broker", "compiletooldir"),
+                                 "build.xml")
+        self.backend = WorkerBackend(command, buildfile, workers=1,
+                                     max_jobs=3)
+
+    def tearDown(self):
+        self.backend.shutdown()
+        shutil.rmtree(self.basedir)
+        super(TestCompileWorker, self).tearDown()
+
+    def write_template(self, profile):
+        f = open(os.path.join(self.profiledir,
+                              profile + self.template_extension), "w")
+        f.write("object template %s;\n" % profile)
+        f.close()
+
+    def properties(self, only=None, cleandeps=False):
+        # Same as TemplateDomain.compile()
+        properties = [("basedir", self.basedir),
+                      ("panc.jar", COMPILER),
+                      ("panc.template_extension", self.template_extension),
+                      ("domain", DOMAIN),
+                      ("distributed.profiles", self.webdir),
+                      ("gzip.output", str(self.gzip_profiles).lower())]
+        if only:
+            properties.append(("object.profile", " ".join(only)))
+        if cleandeps:
+            properties.append(("clean.dep.files", True))
+        return properties
+
+    def compile(self, only=None, cleandeps=False):
+        if only:
+            target = "compile.object.profile"
+        else:
+            target = "compile.domain.profiles"
+        return self.backend.compile(COMPILER, target,
+                                    self.properties(only, cleandeps),
+                                    env={}, path=self.basedir, logger=LOGGER,
+                                    loglevel=logging.DEBUG)
+
+    def worker_pid(self):
+        idle = self.backend.idle[COMPILER]
+        self.assertEqual(len(idle), 1)
+        return idle[0].process.pid
+
+    def check_profile(self, profile):
+        builddir = os.path.join(self.basedir, "build", "xml", DOMAIN)
+        for dirname in (builddir, self.webdir):
+            filename = os.path.join(dirname, profile + self.profile_suffix)
+            self.assertTrue(os.path.exists(filename),
+                            "Profile %s is missing" % filename)
+        f = open(os.path.join(builddir, profile + ".xml.dep"))
+        self.assertEqual(f.read(),
+                         os.path.join(self.profiledir,
+                                      profile + self.template_extension) +
+                         "\n")
+        f.close()
+
+    def test_100_compile_flush_sequence(self):
+        out = self.compile(only=self.profiles[:1])
+        self.matchoutput(out, "compile.object.profile:", "compile")
+        self.matchoutput(out, "[panc] 1/1 template(s) written", "compile")
+        self.matchoutput(out, "BUILD SUCCESSFUL", "compile")
+        self.check_profile(self.profiles[0])
+        first_pid = self.worker_pid()
+
+        # A new object template shows up, as after a flush, and the whole
+        # domain gets recompiled by the same worker
+        self.profiles.append("host3.aqd-unittest.ms.com")
+        self.write_template(self.profiles[-1])
+        out = self.compile(cleandeps=True)
+        self.matchoutput(out, "compile.domain.profiles:", "compile")
+        self.matchoutput(out, "[panc] 4/4 template(s) written", "compile")
+        for profile in self.profiles:
+            self.check_profile(profile)
+        self.assertEqual(self.worker_pid(), first_pid)
+
+        # The third job is the last one of this worker
+        self.compile(only=self.profiles[-1:])
+        self.assertEqual(self.backend.idle[COMPILER], [])
+        self.assertEqual(self.backend.count[COMPILER], 0)
+
+        out = self.compile(only=self.profiles[1:3])
+        self.matchoutput(out, "[panc] 2/2 template(s) written", "compile")
+        self.assertNotEqual(self.worker_pid(), first_pid)
+        self.assertEqual(self.backend.count[COMPILER], 1)
+
+    def test_200_compile_failure(self):
+        self.compile(only=self.profiles[:1])
+        pid = self.worker_pid()
+        try:
+            self.compile(only=["no-such-host.aqd-unittest.ms.com"])
+            self.fail("Compiling a missing template did not fail")
+        except ProcessException, e:
+            self.matchoutput(e.err, "BUILD FAILED", "compile")
+            self.matchoutput(e.err, "file not found", "compile")
+        # A failed build does not make the worker unusable
+        self.assertEqual(self.worker_pid(), pid)
+        out = self.compile(only=self.profiles[1:2])
+        self.matchoutput(out, "BUILD SUCCESSFUL", "compile")
+        self.check_profile(self.profiles[1])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCompileWorker)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -55,6 +55,9 @@ class TestDelDomain(TestBrokerCommand):
         self.successtest(command)
         self.failIf(os.path.exists(os.path.join(
             self.config.get("broker", "domainsdir"), "deployable")))
+        # The working copy used by deploy must be gone, too
+        self.failIf(os.path.exists(os.path.join(
+            self.config.get("broker", "merge_workspacedir"), "deployable")))
 
     def test_verifydeldeployable(self):
         command = ["show_domain", "--domain=deployable"]
@@ -24,9 +24,10 @@ if __name__ == "__main__":
     utils.import_depends()
 
 from brokertest import TestBrokerCommand
+from servicetest import VerifyClientsMixin
 
 
-class TestDelHost(TestBrokerCommand):
+class TestDelHost(VerifyClientsMixin, TestBrokerCommand):
 
     def testdelunittest02(self):
         self.dsdb_expect_delete(self.net.unknown[0].usable[11])
@@ -39,6 +40,12 @@ class TestDelHost(TestBrokerCommand):
         command = "show host --hostname unittest02.one-nyp.ms.com"
         self.notfoundtest(command.split(" "))
 
+    def testverifydelunittest02clients(self):
+        # Deleting a client drops the build items without the usual events
+        clients = self.check_clients("afs", "q.ln.ms.com")
+        self.failIf("unittest02.one-nyp.ms.com" in clients,
+                    "Deleted host is still a client: %s" % clients)
+
     def testdelafsbynet(self):
         self.dsdb_expect_delete(self.net.netsvcmap.usable[0])
         command = "del host --hostname afs-by-net.aqd-unittest.ms.com"
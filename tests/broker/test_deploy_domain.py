@@ -17,6 +17,7 @@
 # limitations under the License.
 """Module for testing the deploy domain command."""
 
+import os
 import unittest
 
 if __name__ == "__main__":
@@ -122,10 +123,35 @@ class TestDeployDomain(TestBrokerCommand):
         command = ["deploy", "--source", "prod", "--target", "leftbehind"]
         self.successtest(command)
 
+    def check_workspace(self, branch):
+        """Check the working copy of a branch, and return its .git inode."""
+        path = os.path.join(self.config.get("broker", "merge_workspacedir"),
+                            branch)
+        gitdir = os.path.join(path, ".git")
+        self.assertTrue(os.path.isdir(gitdir),
+                        "Working copy %s is missing" % path)
+        self.assertFalse(os.path.exists(os.path.join(gitdir, "objects",
+                                                     "info", "alternates")),
+                         "Working copy %s uses alternates" % path)
+
+        kingdir = self.config.get("broker", "kingdir")
+        (king_head, err) = self.gitcommand(["rev-parse", branch], cwd=kingdir)
+        (head, err) = self.gitcommand(["rev-parse", "HEAD"], cwd=path)
+        self.assertEqual(head, king_head)
+        return os.stat(gitdir).st_ino
+
+    def test_325_verify_workspace(self):
+        global workspace_inode
+        workspace_inode = self.check_workspace("leftbehind")
+
     def test_330_deploy_again(self):
         command = ["deploy", "--source", "advanced", "--target", "leftbehind"]
         self.successtest(command)
 
+    def test_335_verify_workspace_reused(self):
+        self.assertEqual(self.check_workspace("leftbehind"), workspace_inode,
+                         "The working copy of leftbehind was cloned again")
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestDeployDomain)
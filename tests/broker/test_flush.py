@@ -17,6 +17,7 @@
 # limitations under the License.
 """Module for testing the flush command."""
 
+import os
 import unittest
 
 if __name__ == "__main__":
@@ -24,6 +25,7 @@ if __name__ == "__main__":
     utils.import_depends()
 
 from brokertest import TestBrokerCommand
+from aquilon.worker.manifest import MANIFEST_NAME, FileManifest, content_digest
 
 
 class TestFlush(TestBrokerCommand):
@@ -31,6 +33,49 @@ class TestFlush(TestBrokerCommand):
     def testflushunittest(self):
         (out, err) = self.successtest(["flush", "--all"])
 
+    def testflushparallel(self):
+        command = ["flush", "--personalities", "--services", "--parallel", "3"]
+        (out, err) = self.successtest(command)
+        self.matchoutput(err, "writing templates using 3 threads", command)
+        self.searchoutput(err, r"Flushed \d+/\d+ templates.", command)
+
+    def testflushbadparallel(self):
+        command = ["flush", "--personalities", "--parallel", "0"]
+        out = self.badrequesttest(command)
+        self.matchoutput(out, "The value of --parallel must be a positive "
+                         "integer.", command)
+
+    def testflushunchanged(self):
+        plenary = self.plenary_name("service", "afs", "client", "config")
+        before = os.stat(plenary)
+        self.successtest(["flush", "--services"])
+        after = os.stat(plenary)
+        self.assertEqual((before.st_ino, before.st_mtime),
+                         (after.st_ino, after.st_mtime),
+                         "%s was rewritten, although it did not change" %
+                         plenary)
+
+    def testflushstalemanifest(self):
+        plenary = self.plenary_name("service", "afs", "client", "config")
+        (dirname, basename) = os.path.split(plenary)
+        with open(plenary) as f:
+            content = f.read()
+        # The entry recorded in the manifest no longer matches the file
+        with open(plenary, "a") as f:
+            f.write("# Local change\n")
+        # As if the broker died while updating the manifest
+        with open(os.path.join(dirname, MANIFEST_NAME), "a") as f:
+            f.write("%s 12" % ("0" * 40))
+        self.successtest(["flush", "--services"])
+        with open(plenary) as f:
+            self.assertEqual(f.read(), content,
+                             "%s was not restored" % plenary)
+
+        # The incomplete line must not spoil the entry recorded after it
+        manifest = FileManifest(dirname)
+        self.assertEqual(manifest.lookup(basename, os.stat(plenary)),
+                         content_digest(content))
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestFlush)
@@ -443,6 +443,15 @@ class TestParameterFeature(TestBrokerCommand):
         cmd = DEL_CMD + ["--path=teststring", "--feature", INTERFACEFEATURE, "--interface=eth0"]
         self.noouttest(cmd)
 
+    def test_932_del_used_interface_paramdef(self):
+        # teststring is still set for eth1, although not for eth0
+        cmd = ["del_parameter_definition", "--feature", INTERFACEFEATURE,
+               "--type=interface", "--path=teststring"]
+        out = self.badrequesttest(cmd)
+        self.matchoutput(out, "Parameter with path teststring used by "
+                         "following and cannot be deleted", cmd)
+        self.matchoutput(out, "aquilon/%s" % PERSONALITY, cmd)
+
     def test_935_del_interface_feature(self):
         cmd = ["unbind_feature", "--feature", INTERFACEFEATURE,"--interface", "eth0",
                "--personality", PERSONALITY]
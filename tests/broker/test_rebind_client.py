@@ -24,9 +24,10 @@ if __name__ == "__main__":
     utils.import_depends()
 
 from brokertest import TestBrokerCommand
+from servicetest import VerifyClientsMixin
 
 
-class TestRebindClient(TestBrokerCommand):
+class TestRebindClient(VerifyClientsMixin, TestBrokerCommand):
 
     def testrebindafs(self):
         command = ["rebind", "client",
@@ -53,6 +54,10 @@ class TestRebindClient(TestBrokerCommand):
         out = self.commandtest(command)
         self.matchclean(out, "unittest02.one-nyp.ms.com", command)
 
+    def testverifyclients(self):
+        self.check_clients("afs", "q.ny.ms.com")
+        self.check_clients("afs", "q.ln.ms.com")
+
     def testverifyqln(self):
         command = ["cat", "--service", "afs", "--instance", "q.ln.ms.com",
                    "--server"]
@@ -28,9 +28,10 @@ if __name__ == "__main__":
 
 from broker.brokertest import TestBrokerCommand
 from broker.grntest import VerifyGrnsMixin
+from broker.servicetest import VerifyClientsMixin
 
 
-class TestReconfigure(VerifyGrnsMixin, TestBrokerCommand):
+class TestReconfigure(VerifyGrnsMixin, VerifyClientsMixin, TestBrokerCommand):
     # Note that some tests for reconfigure --list appear in
     # test_make_aquilon.py.
 
@@ -339,6 +340,30 @@ class TestReconfigure(VerifyGrnsMixin, TestBrokerCommand):
         self.failIf(results, "Found service plenary data that includes "
                              "aquilon93.aqd-unittest.ms.com")
 
+    def testmissingpersonalitytemplatekeepsclients(self):
+        # The bindings made by the failed command get rolled back, and so must
+        # the cached client lists
+        command = ["show", "service", "--all"]
+        before = self.commandtest(command)
+        hosts = ["aquilon93.aqd-unittest.ms.com\n"]
+        scratchfile = self.writescratch("missingtemplate", "".join(hosts))
+        self.badrequesttest(["reconfigure", "--list", scratchfile,
+                             "--archetype", "aquilon",
+                             "--personality", "badpersonality"])
+        after = self.commandtest(command)
+        self.assertEqual(before, after,
+                         "Client counts changed by a failed reconfigure:\n"
+                         "@@@\n%s\n@@@\n%s\n@@@" % (before, after))
+        self.check_clients("afs", "q.ny.ms.com")
+
+        self.successtest(["flush", "--services"])
+        servicedir = os.path.join(self.config.get("broker", "plenarydir"),
+                                  "servicedata")
+        results = self.grepcommand(["-rl", "aquilon93.aqd-unittest.ms.com",
+                                    servicedir])
+        self.failIf(results, "Found service plenary data that includes "
+                             "aquilon93.aqd-unittest.ms.com")
+
     def testmissingpersonality(self):
         command = ["reconfigure",
                    "--hostname", "aquilon62.aqd-unittest.ms.com",
@@ -634,6 +659,14 @@ class TestReconfigure(VerifyGrnsMixin, TestBrokerCommand):
         (out, err) = self.successtest(command)
         self.matchoutput(err, "1/1 object template", command)
 
+    def test_155_reconfigure_list_aquilon95(self):
+        # Only the listed host should be compiled, not the whole domain
+        hosts = ["aquilon95.aqd-unittest.ms.com\n"]
+        scratchfile = self.writescratch("onlyaquilon95", "".join(hosts))
+        command = ["reconfigure", "--list", scratchfile]
+        (out, err) = self.successtest(command)
+        self.matchoutput(err, "1/1 object template", command)
+
     def test_160_verify_machine_plenary(self):
         command = ["cat", "--machine=ut9s03p45"]
         out = self.commandtest(command)
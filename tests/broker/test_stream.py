@@ -0,0 +1,114 @@
+#!/usr/bin/env python2.6
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing that streamed responses match unstreamed ones.
+
+Lists longer than the stream_chunk_size option of the broker are sent in
+chunks.  Lists of a single element are never streamed, so the output of a
+streamed list must be the same as the output of its elements, one by one.
+
+"""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from brokertest import TestBrokerCommand
+
+
+class TestStream(TestBrokerCommand):
+
+    def setUp(self):
+        super(TestStream, self).setUp()
+        self.chunk_size = self.config.getint("broker", "stream_chunk_size")
+
+    def check_stream(self, command, single_commands):
+        self.assertTrue(len(single_commands) > self.chunk_size,
+                        "%s returns just %d elements, not enough for "
+                        "streaming in chunks of %d" %
+                        (command, len(single_commands), self.chunk_size))
+        streamed = self.commandtest(command)
+        expected = "".join([self.commandtest(single)
+                            for single in single_commands])
+        self.assertEqual(streamed, expected,
+                         "Streamed output of %s differs from the output of "
+                         "its elements:\n@@@\n%s\n@@@\nExpected:\n@@@\n%s\n@@@"
+                         % (command, streamed, expected))
+
+    def machines(self):
+        command = ["search", "machine", "--model", "hs21-8853l5u"]
+        out = self.commandtest(command)
+        # show machine sorts by label
+        return sorted(out.splitlines())
+
+    def test_100_machine_raw(self):
+        command = ["show", "machine", "--model", "hs21-8853l5u"]
+        singles = [["show", "machine", "--machine", label]
+                   for label in self.machines()]
+        self.check_stream(command, singles)
+
+    def test_100_machine_csv(self):
+        command = ["show", "machine", "--model", "hs21-8853l5u",
+                   "--format", "csv"]
+        singles = [["show", "machine", "--machine", label, "--format", "csv"]
+                   for label in self.machines()]
+        self.check_stream(command, singles)
+
+    def test_110_dns_djb(self):
+        net = self.net.unknown[0]
+        command = ["search", "dns", "--network", net.ip]
+        out = self.commandtest(command)
+        fqdns = []
+        for fqdn in out.splitlines():
+            if fqdn not in fqdns:
+                fqdns.append(fqdn)
+
+        command = ["search", "dns", "--network", net.ip, "--fullinfo",
+                   "--format", "djb"]
+        singles = [["search", "dns", "--network", net.ip, "--fqdn", fqdn,
+                    "--fullinfo", "--format", "djb"]
+                   for fqdn in fqdns]
+        self.check_stream(command, singles)
+
+    def networks(self):
+        command = ["show", "network", "--building", "ut", "--type", "tor_net"]
+        out = self.commandtest(command)
+        # Skip the header, the IP address is the second column
+        return [line.split("\t")[1] for line in out.splitlines()[1:]]
+
+    def test_120_network_csv(self):
+        command = ["show", "network", "--building", "ut", "--type", "tor_net",
+                   "--format", "csv"]
+        singles = [["show", "network", "--ip", ip, "--format", "csv"]
+                   for ip in self.networks()]
+        self.check_stream(command, singles)
+
+    def test_120_network_proto(self):
+        command = ["show", "network", "--building", "ut", "--type", "tor_net",
+                   "--format", "proto"]
+        singles = [["show", "network", "--ip", ip, "--format", "proto"]
+                   for ip in self.networks()]
+        self.check_stream(command, singles)
+        out = self.commandtest(command)
+        self.parse_netlist_msg(out, expect=len(singles))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStream)
+    unittest.TextTestRunner(verbosity=2).run(suite)
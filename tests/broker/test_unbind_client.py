@@ -24,9 +24,10 @@ if __name__ == "__main__":
     utils.import_depends()
 
 from brokertest import TestBrokerCommand
+from servicetest import VerifyClientsMixin
 
 
-class TestUnbindClient(TestBrokerCommand):
+class TestUnbindClient(VerifyClientsMixin, TestBrokerCommand):
 
     def test_100_bind_unmapped(self):
         command = ["bind_client", "--hostname=unittest02.one-nyp.ms.com",
@@ -58,6 +59,13 @@ class TestUnbindClient(TestBrokerCommand):
         out = self.internalerrortest(command)
         self.matchoutput(out, "No such file or directory", command)
 
+    def test_200_verify_bind_clients(self):
+        clients = self.check_clients("unmapped", "instance1")
+        # Bound in the opposite order
+        self.failUnless(clients.index("aquilon94.aqd-unittest.ms.com") <
+                        clients.index("unittest02.one-nyp.ms.com"),
+                        "Clients are not sorted: %s" % clients)
+
     def test_300_unbind_unmapped(self):
         command = ["unbind_client", "--hostname=unittest02.one-nyp.ms.com",
                    "--service=unmapped"]
@@ -79,6 +87,12 @@ class TestUnbindClient(TestBrokerCommand):
                    "--service=unmapped"]
         self.noouttest(command)
 
+    def test_400_verify_unbind_clients(self):
+        clients = self.check_clients("unmapped", "instance1")
+        self.failIf("aquilon94.aqd-unittest.ms.com" in clients or
+                    "unittest02.one-nyp.ms.com" in clients,
+                    "Unbound hosts are still clients: %s" % clients)
+
     def test_400_verify_unbind_search_unbuilt(self):
         command = ["search_host", "--hostname=aquilon94.aqd-unittest.ms.com",
                    "--service=unmapped"]
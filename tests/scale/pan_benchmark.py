@@ -0,0 +1,206 @@
+#!/usr/bin/env python2.6
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2013  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmark of the PAN serializer.
+
+Compares the output of pan() and pan_create() with the original recursive
+implementation, which is kept here as a reference, and reports the time
+taken by both on data resembling host and machine plenaries.
+
+"""
+
+import os
+import re
+import imp
+from collections import Iterable, Mapping
+from timeit import Timer
+
+_LIBDIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       "..", "..", "lib", "python2.6")
+# Load the module directly, to avoid pulling in the rest of the broker
+panutils = imp.load_source("panutils",
+                           os.path.join(_LIBDIR, "aquilon", "worker",
+                                        "templates", "panutils.py"))
+StructureTemplate = panutils.StructureTemplate
+PanEscape = panutils.PanEscape
+PanMetric = panutils.PanMetric
+PanValue = panutils.PanValue
+
+_valid_id = re.compile(r"^[a-zA-Z_][\w.+\-]*$")
+
+
+def reference_pan(obj, indent=0):
+    spaces = "  " * (indent + 1)
+    accumulator = list()
+
+    if isinstance(obj, basestring):
+        quote = '"'
+        if '"' in obj:
+            quote = "'"
+        accumulator.append("%s%s%s" % (quote, obj, quote))
+
+    elif isinstance(obj, bool):
+        accumulator.append(str(obj).lower())
+
+    elif isinstance(obj, int):
+        accumulator.append("%d" % obj)
+
+    elif isinstance(obj, StructureTemplate):
+        accumulator.append(reference_pan_create(obj.path, obj.params, indent))
+
+    elif isinstance(obj, PanEscape):
+        if _valid_id.match(obj.value) and "_" not in obj.value:
+            accumulator.append(reference_pan(obj.value))
+        else:
+            accumulator.append("escape(%s)" % reference_pan(obj.value))
+
+    elif isinstance(obj, panutils.PanObject):
+        accumulator.append(obj.format(indent))
+
+    elif isinstance(obj, Mapping):
+        accumulator.append("nlist(")
+        for key in sorted(obj.keys()):
+            val = reference_pan(obj[key], indent + 1)
+            accumulator.append("%s%s, %s," % (spaces, reference_pan(key), val))
+        accumulator[-1] = accumulator[-1].rstrip(",")
+        accumulator.append("%s)" % ("  " * indent))
+
+    elif isinstance(obj, Iterable):
+        accumulator.append("list(")
+        for item in obj:
+            val = reference_pan(item, indent + 1)
+            accumulator.append("%s%s," % (spaces, val))
+        accumulator[-1] = accumulator[-1].rstrip(",")
+        accumulator.append("%s)" % ("  " * indent))
+
+    else:
+        accumulator.append(reference_pan(str(obj)))
+
+    if (len(accumulator) == 1):
+        return accumulator[0]
+
+    return "\n".join(("%s" % x) for x in accumulator)
+
+
+def reference_pan_create(path, params=None, indent=0):
+    spaces = "  " * (indent + 1)
+    accumulator = list()
+    accumulator.append("create(%s," % reference_pan(path))
+
+    if params:
+        for key in sorted(params.keys()):
+            val = reference_pan(params[key], indent + 2)
+            accumulator.append("%s%s, %s," % (spaces, reference_pan(key), val))
+        accumulator[-1] = accumulator[-1].rstrip(",")
+        accumulator.append("%s)" % ("  " * indent))
+    else:
+        accumulator[-1] = accumulator[-1].rstrip(",") + ")"
+
+    return "\n".join(("%s" % x) for x in accumulator)
+
+
+def sample_host(num):
+    interfaces = {}
+    routers = {}
+    for i in range(4):
+        name = "eth%d" % i
+        interfaces[name] = {"bootproto": "static",
+                            "ip": "192.168.%d.%d" % (i, num % 250),
+                            "netmask": "255.255.255.0",
+                            "broadcast": "192.168.%d.255" % i,
+                            "gateway": "192.168.%d.1" % i,
+                            "fqdn": "host%d-%s.example.com" % (num, name),
+                            "network_type": "unknown",
+                            "network_environment": "internal",
+                            "aliases": ["alias%d.example.com" % j
+                                        for j in range(2)],
+                            "route": [{"address": "10.0.0.0",
+                                       "netmask": "255.0.0.0",
+                                       "gateway": "192.168.%d.1" % i}]}
+        routers[name] = ["192.168.%d.1" % i, "192.168.%d.2" % i]
+    return {"interfaces": interfaces,
+            "routers": routers,
+            "grns": {"eon_id_map": {"esp": [1, 2, 3], "atarget": [4]}},
+            "bootable": True,
+            "metadata": PanValue("/metadata"),
+            "quoted": 'say "hello"',
+            "empty": {},
+            "emptylist": []}
+
+
+def sample_machine(num):
+    disks = {}
+    for i in range(3):
+        disks[PanEscape("c0d%d" % i)] = StructureTemplate(
+            "hardware/harddisk/generic/cciss",
+            {"capacity": PanMetric(34, "GB"),
+             "interface": "cciss",
+             "boot": i == 0})
+    return {"ram": [StructureTemplate("hardware/ram/generic",
+                                      {"size": PanMetric(8192, "MB")})],
+            "cpu": [StructureTemplate("hardware/cpu/intel/xeon_2660")
+                    for i in range(2)],
+            "harddisks": disks,
+            "cards": {"nic": {"eth0": StructureTemplate(
+                "hardware/nic/generic/generic_nic",
+                {"hwaddr": "02:02:04:02:%02x:%02x" % (num / 256, num % 256),
+                 "boot": True})}}}
+
+
+def check(samples):
+    for sample in samples:
+        for indent in (0, 1, 3):
+            expected = reference_pan(sample, indent)
+            got = panutils.pan(sample, indent)
+            if expected != got:  # pragma: no cover
+                raise AssertionError("Output differs for %r at indent %d:\n"
+                                     "%s\n---\n%s" % (sample, indent,
+                                                      expected, got))
+    tpl = StructureTemplate("hostdata/foo", {"metadata": PanValue("/a")})
+    for params in (None, {}, tpl.params):
+        if reference_pan_create("x/y", params) != \
+           panutils.pan_create("x/y", params):  # pragma: no cover
+            raise AssertionError("pan_create() output differs for %r" %
+                                 params)
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-n", "--count", dest="count", type="int", default=200,
+                      help="Number of host and machine samples")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Number of times to repeat the measurement")
+    (options, args) = parser.parse_args()
+
+    samples = [sample_host(i) for i in range(options.count)]
+    samples.extend([sample_machine(i) for i in range(options.count)])
+    samples.extend(["plain", 'with "quotes"', 42, True, [], {},
+                    PanMetric(10, "GB"), PanValue("/system")])
+    check(samples)
+    print "Output of %d samples is identical" % len(samples)
+
+    for (label, func) in (("reference", reference_pan),
+                          ("current", panutils.pan)):
+        timer = Timer(lambda: [func(sample) for sample in samples])
+        best = min(timer.repeat(repeat=options.repeat, number=1))
+        print "%-10s %.3f seconds" % (label, best)
+
+
+if __name__ == '__main__':
+    main()